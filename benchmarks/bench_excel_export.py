@@ -0,0 +1,76 @@
+# benchmarks/bench_excel_export.py
+#
+# Compares exporting combined results with DataFrame.to_excel (the previous approach) against the streaming
+# ExcelExporter, on a synthetic season of results stored as Parquet. Run from the repository root:
+#
+#     python -m benchmarks.bench_excel_export --rows 100000
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_result_combining import create_leaflet_results
+from result_handling.excel_exporter import ExcelExporter
+from result_handling.result_saver import ResultSaver
+
+
+def create_season_results(num_rows: int) -> pd.DataFrame:
+    """
+    Builds combined results of many leaflets, with the supermarket of every leaflet.
+    """
+    results = create_leaflet_results(num_rows, seed=0)
+    rng = np.random.default_rng(0)
+    results["supermarket"] = rng.choice(["Aldi", "Coop", "Denner", "Lidl", "Migros", "Volg"], num_rows)
+    return results
+
+
+def export_to_excel(parquet_path: str, excel_path: str) -> None:
+    pd.read_parquet(parquet_path).to_excel(excel_path, index=False)
+
+
+def export_streaming(parquet_path: str, excel_path: str) -> None:
+    ExcelExporter().export_parquet(parquet_path, excel_path, sheet_by="supermarket")
+
+
+def _measure(export, parquet_path: str, excel_path: str, results) -> None:
+    start = time.perf_counter()
+    export(parquet_path, excel_path)
+    elapsed = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux
+    results.put((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024))
+
+
+def measure(export, parquet_path: str, excel_path: str):
+    """
+    Runs the export in a fresh process, so the peak memory of one approach doesn't hide the other's.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(export, parquet_path, excel_path, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the Excel export with DataFrame.to_excel against the streaming ExcelExporter.")
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        parquet_path = ResultSaver().save(create_season_results(args.rows), temp_dir)
+        print(f"Exporting {args.rows} rows")
+        for name, export in [("to_excel (openpyxl)", export_to_excel), ("streaming (xlsxwriter)", export_streaming)]:
+            excel_path = os.path.join(temp_dir, f"{export.__name__}.xlsx")
+            elapsed, peak = measure(export, parquet_path, excel_path)
+            print(f"{name:24} {elapsed:7.2f}s   peak RSS {peak:6.0f} MB   {os.path.getsize(excel_path) / 1024 ** 2:5.1f} MB file")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,78 @@
+# benchmarks/bench_page_previews.py
+#
+# Compares showing a leaflet page in the review sidebar from the full page image (the previous approach: decoding
+# it and encoding it again as PNG for the browser) against the cached WebP previews of PagePreviews, on synthetic
+# pages. Run from the repository root:
+#
+#     python -m benchmarks.bench_page_previews --pages 10
+
+import argparse
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+from PIL import Image, ImageDraw
+
+from leaflet_processing.page_previews import PagePreviews
+from leaflet_processing.page_store import read_page
+
+
+def create_page(path: str, seed: int, size=(1654, 2339)) -> None:
+    """
+    Draws a page like a leaflet: product tiles with photos (noise) and text, at 200 DPI A4.
+    """
+    rng = np.random.default_rng(seed)
+    image = Image.new("RGB", size, "white")
+    draw = ImageDraw.Draw(image)
+    for left in range(40, size[0] - 400, 530):
+        for top in range(40, size[1] - 500, 560):
+            photo = rng.integers(0, 255, (300, 450, 3), dtype=np.uint8)
+            image.paste(Image.fromarray(photo).resize((450, 300)), (left, top))
+            draw.text((left, top + 320), f"Product {left}/{top}  3.95 statt 4.95", fill="black")
+    image.save(path)
+
+
+def show_full_page(image_path: str) -> int:
+    image = Image.open(io.BytesIO(read_page(image_path)))
+    output = io.BytesIO()
+    image.save(output, format="PNG")
+    return output.tell()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares showing full page images in the review sidebar against the cached WebP previews.")
+    parser.add_argument("--pages", type=int, default=10)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        image_paths = [os.path.join(directory, f"{page}.png") for page in range(1, args.pages + 1)]
+        for seed, image_path in enumerate(image_paths):
+            create_page(image_path, seed)
+
+        start = time.perf_counter()
+        full_bytes = [show_full_page(image_path) for image_path in image_paths]
+        full_seconds = (time.perf_counter() - start) / args.pages
+
+        page_previews = PagePreviews()
+        start = time.perf_counter()
+        for image_path in image_paths:
+            page_previews.preview_path(image_path)
+        first_seconds = (time.perf_counter() - start) / args.pages
+
+        start = time.perf_counter()
+        preview_bytes = []
+        for image_path in image_paths:
+            with open(page_previews.preview_path(image_path), "rb") as preview_file:
+                preview_bytes.append(len(preview_file.read()))
+        cached_seconds = (time.perf_counter() - start) / args.pages
+
+    print(f"{args.pages} pages of 1654x2339 pixels, per page flip")
+    print(f"      Full page: {full_seconds * 1000:7.1f} ms, {np.mean(full_bytes) / 1024:6.0f} KB sent")
+    print(f"  First preview: {first_seconds * 1000:7.1f} ms (made once per page, or prefetched)")
+    print(f" Cached preview: {cached_seconds * 1000:7.1f} ms, {np.mean(preview_bytes) / 1024:6.0f} KB sent")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,90 @@
+# benchmarks/bench_rasterization.py
+#
+# Compares rendering a whole leaflet in memory with convert_from_path (the previous approach)
+# against the streaming LeafletReader.iter_pdf_pages, on a synthetic multi-page PDF.
+# Requires poppler. Run from the repository root:
+#
+#     python -m benchmarks.bench_rasterization --pages 60
+
+import argparse
+import multiprocessing
+import os
+import resource
+import tempfile
+import time
+
+from PIL import Image, ImageDraw
+from pdf2image import convert_from_path
+
+from leaflet_processing.leaflet_reader import LeafletReader
+
+
+def create_synthetic_pdf(path: str, num_pages: int) -> None:
+    """
+    Writes an A4 PDF whose pages are grids of coloured product tiles with prices, like a leaflet.
+    """
+    pages = []
+    for page_number in range(num_pages):
+        page = Image.new("RGB", (1240, 1754), "white")
+        draw = ImageDraw.Draw(page)
+        for row in range(5):
+            for column in range(3):
+                left, top = 40 + column * 400, 40 + row * 340
+                draw.rectangle([left, top, left + 360, top + 300], fill=((page_number * 40 + row * 60) % 255, 120, 60 + column * 60))
+                draw.text((left + 20, top + 20), f"Produkt {page_number}-{row}-{column}  Fr. {row + column}.95", fill="white")
+        pages.append(page)
+    pages[0].save(path, save_all=True, append_images=pages[1:], resolution=150)
+
+
+def render_in_memory(pdf_path: str, output_dir: str, dpi: int) -> None:
+    images = convert_from_path(pdf_path, dpi=dpi)
+    for i, image in enumerate(images):
+        image.save(os.path.join(output_dir, f"{i+1}.png"), format='PNG')
+
+
+def render_streaming(pdf_path: str, output_dir: str, dpi: int) -> None:
+    for _ in LeafletReader(download_url="").iter_pdf_pages(pdf_path, output_dir, dpi):
+        pass
+
+
+def _measure(render, pdf_path: str, dpi: int, results) -> None:
+    with tempfile.TemporaryDirectory() as output_dir:
+        start = time.perf_counter()
+        render(pdf_path, output_dir, dpi)
+        elapsed = time.perf_counter() - start
+    # ru_maxrss is in KB on Linux; children covers the pdftoppm processes
+    peak_self = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    peak_children = resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss / 1024
+    results.put((elapsed, peak_self, peak_children))
+
+
+def measure(render, pdf_path: str, dpi: int):
+    """
+    Runs the rendering in a fresh process, so the peak memory of one approach doesn't hide the other's.
+    """
+    results = multiprocessing.Queue()
+    process = multiprocessing.Process(target=_measure, args=(render, pdf_path, dpi, results))
+    process.start()
+    result = results.get()
+    process.join()
+    return result
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares rendering a leaflet in memory against streaming its pages with LeafletReader.")
+    parser.add_argument("--pages", type=int, default=60)
+    parser.add_argument("--dpi", type=int, default=150)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        pdf_path = os.path.join(temp_dir, "synthetic_leaflet.pdf")
+        create_synthetic_pdf(pdf_path, args.pages)
+        print(f"Rendering a synthetic {args.pages}-page PDF at {args.dpi} DPI")
+
+        for name, render in [("in memory (convert_from_path)", render_in_memory), ("streaming (iter_pdf_pages)", render_streaming)]:
+            elapsed, peak_self, peak_children = measure(render, pdf_path, args.dpi)
+            print(f"{name:32} {elapsed:7.2f}s   peak RSS python {peak_self:7.0f} MB, pdftoppm {peak_children:6.0f} MB")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,76 @@
+# benchmarks/bench_result_combining.py
+#
+# Compares combining the results of many leaflets from results.xlsx files with pd.read_excel (the previous
+# approach) against the Parquet files of ResultSaver, on synthetic results. Run from the repository root:
+#
+#     python -m benchmarks.bench_result_combining --leaflets 40 --rows 80
+
+import argparse
+import glob
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from benchmarks.bench_validation_comparison import create_results_table
+from result_handling.result_saver import EXCEL_FILE_NAME, ResultSaver
+from validation.validation_comparison import compare_validation
+
+
+def create_leaflet_results(num_rows: int, seed: int) -> pd.DataFrame:
+    """
+    Builds the results of one leaflet like the pipeline's, with consensus, categories and metadata.
+    """
+    data = create_results_table(num_rows, seed)
+    compare_validation(data)
+    rng = np.random.default_rng(seed)
+    data["extracted_folder"] = f"leaflet_{seed}"
+    data["extracted_page_number"] = [f"{page}.png" for page in rng.integers(1, 20, num_rows)]
+    data["final_category"] = rng.choice(["Grillfleisch (Rind)", "Käse", "Kein Grillprodukt"], num_rows)
+    data["categorization_confidence"] = 1.0
+    data["date_collected"] = "2024-06-10"
+    data["calendar_week"] = 24
+    return data
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares combining the leaflet results from Excel and from Parquet files.")
+    parser.add_argument("--leaflets", type=int, default=40)
+    parser.add_argument("--rows", type=int, default=80)
+    args = parser.parse_args()
+
+    result_saver = ResultSaver()
+    with tempfile.TemporaryDirectory() as parent_directory:
+        for seed in range(args.leaflets):
+            leaflet_directory = os.path.join(parent_directory, f"leaflet_{seed}")
+            results = create_leaflet_results(args.rows, seed)
+            result_saver.save(results, leaflet_directory)
+            results.to_excel(os.path.join(leaflet_directory, EXCEL_FILE_NAME), index=False)
+
+        start = time.perf_counter()
+        excel_files = glob.glob(f"{parent_directory}/**/{EXCEL_FILE_NAME}", recursive=True)
+        from_excel = pd.concat([pd.read_excel(file) for file in excel_files], ignore_index=True)
+        excel_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        from_parquet = result_saver.combine_results_from_all_subdirectories(parent_directory)
+        parquet_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        cheese = result_saver.combine_results_from_all_subdirectories(
+            parent_directory, columns=["extracted_folder", "final_product_name", "final_discount_price"],
+            filters=[("final_category", "==", "Käse")],
+        )
+        pruned_seconds = time.perf_counter() - start
+
+    print(f"{args.leaflets} leaflets with {args.rows} rows each")
+    print(f"   Excel: {excel_seconds:8.3f}s for {len(from_excel)} rows")
+    print(f" Parquet: {parquet_seconds:8.3f}s for {len(from_parquet)} rows")
+    print(f"  Pruned: {pruned_seconds:8.3f}s for {len(cheese)} rows of 3 columns")
+    print(f"Speedup: {excel_seconds / parquet_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,67 @@
+# benchmarks/bench_result_review.py
+#
+# Compares a rerun of the Manual Error Check page that saves one correction, as before (loading all results,
+# updating the row and writing the combined results again) and with the ResultsCache and the edit log,
+# on a synthetic season of results. Run from the repository root:
+#
+#     python -m benchmarks.bench_result_review --leaflets 200 --rows 100
+
+import argparse
+import os
+import tempfile
+import time
+
+from benchmarks.bench_result_combining import create_leaflet_results
+from result_handling.result_saver import ResultSaver
+from result_handling.results_cache import ResultsCache
+from result_handling.run_database import RunDatabase
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares saving a review correction by rewriting all results and with the edit log.")
+    parser.add_argument("--leaflets", type=int, default=200)
+    parser.add_argument("--rows", type=int, default=100)
+    parser.add_argument("--saves", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as results_dir:
+        run_database = RunDatabase(os.path.join(results_dir, "runs.sqlite"))
+        for seed in range(args.leaflets):
+            run_database.save_results(f"Coop Zeitung KW {seed % 52 + 1} {seed}", create_leaflet_results(args.rows, seed))
+        result_saver = ResultSaver()
+        extraction_ids = run_database.results()["extraction_id"].tolist()
+
+        start = time.perf_counter()
+        for save in range(args.saves):
+            data = run_database.results()
+            data.loc[data.index[save], "final_product_name"] = f"Corrected {save}"
+            run_database.record_edits([(extraction_ids[save], "final_product_name", f"Corrected {save}")])
+            run_database.compact_edits()
+            result_saver.save(data, results_dir)
+        rewrite_seconds = (time.perf_counter() - start) / args.saves
+
+        results_cache = ResultsCache(run_database)
+        start = time.perf_counter()
+        results_cache.results()
+        first_load_seconds = time.perf_counter() - start
+
+        start = time.perf_counter()
+        for save in range(args.saves):
+            results_cache.results()
+            run_database.record_edits([(extraction_ids[save], "final_product_name", f"Edited {save}")])
+        edit_log_seconds = (time.perf_counter() - start) / args.saves
+        assert results_cache.results()["final_product_name"].iloc[0] == "Edited 0"
+
+        start = time.perf_counter()
+        run_database.compact_edits()
+        compaction_seconds = time.perf_counter() - start
+
+    print(f"{args.leaflets} leaflets with {args.rows} rows each")
+    print(f"Load and rewrite per save: {rewrite_seconds:8.3f}s")
+    print(f"Cached, edit log per save: {edit_log_seconds:8.3f}s   (first load {first_load_seconds:.3f}s)")
+    print(f"Compacting {args.saves} edits:      {compaction_seconds:8.3f}s")
+    print(f"Speedup: {rewrite_seconds / edit_log_seconds:.0f}x")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,98 @@
+# benchmarks/bench_validation_comparison.py
+#
+# Compares the row-wise compare_validation (the previous approach, copied below) against the
+# vectorized validation.validation_comparison.compare_validation on a synthetic results table.
+# Run from the repository root:
+#
+#     python -m benchmarks.bench_validation_comparison --rows 50000
+
+import argparse
+import random
+import time
+
+from collections import Counter
+
+import numpy as np
+import pandas as pd
+
+from settings.settings import NUMBER_OF_CHATGPT_VALIDATIONS, EXTRACTED_DATA_COLUMNS
+from validation.validation_comparison import compare_validation
+
+
+def determine_final_column_and_confidence(row: pd.Series, column_name: str) -> (str, float):
+    validation_columns = [f'validated{i + 1}_{column_name}' for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)]
+    validation_values = [row[col] for col in validation_columns]
+
+    counts = Counter(validation_values)
+    most_common_value, max_count = counts.most_common(1)[0]
+    tied_values = [val for val, count in counts.items() if count == max_count]
+
+    if len(tied_values) == 1:
+        final_value = most_common_value
+    else:
+        if row[f'extracted_{column_name}'] in tied_values:
+            final_value = row[f'extracted_{column_name}']
+        else:
+            final_value = random.choice(tied_values)
+
+    confidence = counts[final_value] / NUMBER_OF_CHATGPT_VALIDATIONS
+    return final_value, confidence
+
+
+def compare_validation_rowwise(data: pd.DataFrame) -> None:
+    for column in EXTRACTED_DATA_COLUMNS:
+        data[[f'final_{column}', f'confidence_{column}']] = data.apply(
+            lambda row: pd.Series(determine_final_column_and_confidence(row, column)),
+            axis=1
+        )
+
+
+def create_results_table(num_rows: int, seed: int = 0) -> pd.DataFrame:
+    """
+    Builds a results table like the pipeline's: mostly agreeing validations, some disagreements and missing values.
+    """
+    rng = np.random.default_rng(seed)
+    data = {}
+    for column in EXTRACTED_DATA_COLUMNS:
+        if column == "percentage_discount":
+            truth = rng.integers(5, 60, num_rows).astype(float)
+        elif column == "product_name":
+            truth = np.array([f"Produkt {i % 5000}" for i in range(num_rows)], dtype=object)
+        else:
+            truth = np.array([f"{p:.2f}" for p in rng.integers(100, 2000, num_rows) / 100], dtype=object)
+
+        for prefix in ["extracted"] + [f"validated{i + 1}" for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)]:
+            values = truth.copy().astype(object)
+            wrong = rng.random(num_rows) < 0.15
+            values[wrong] = np.roll(truth, 1)[wrong]
+            values[rng.random(num_rows) < 0.05] = np.nan
+            data[f"{prefix}_{column}"] = values
+    return pd.DataFrame(data)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Compares the row-wise and the vectorized compare_validation.")
+    parser.add_argument("--rows", type=int, default=50000)
+    args = parser.parse_args()
+
+    table = create_results_table(args.rows)
+    results = {}
+    for name, compare in [("row-wise", compare_validation_rowwise), ("vectorized", compare_validation)]:
+        data = table.copy()
+        random.seed(0)
+        start = time.perf_counter()
+        compare(data)
+        results[name] = (time.perf_counter() - start, data)
+        print(f"{name:>10}: {results[name][0]:8.3f}s for {args.rows} rows")
+    print(f"Speedup: {results['row-wise'][0] / results['vectorized'][0]:.0f}x")
+
+    # The row-wise version breaks ties between validations randomly, so the results only agree on rows without ties
+    rowwise, vectorized = results["row-wise"][1], results["vectorized"][1]
+    for column in EXTRACTED_DATA_COLUMNS:
+        same = (rowwise[f"final_{column}"] == vectorized[f"final_{column}"]) \
+            | (rowwise[f"final_{column}"].isna() & vectorized[f"final_{column}"].isna())
+        print(f"final_{column}: {same.mean():.1%} of rows agree")
+
+
+if __name__ == "__main__":
+    main()
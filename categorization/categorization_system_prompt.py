@@ -145,17 +145,17 @@ If you encounter a product, assign it to the correct category using the descript
 
 
 ### Instructions
-    - I will send you at most 5 products at a time.  Each product is on a newline.  For each product, return the categorization.
+    - I will send you at most 5 products at a time.  Each product is on a newline and starts with its id, e.g. "1: ".  For each product, return its id and the categorization.
 
 ### Example
-Mariniertes Hähnchenbrustfilet
-Hackbraten
-RACLETTE-KÄSE IN SCHEIBEN
-Evian, 6 x 1.5 Liter
+1: Mariniertes Hähnchenbrustfilet
+2: Hackbraten
+3: RACLETTE-KÄSE IN SCHEIBEN
+4: Evian, 6 x 1.5 Liter
 
 
-Grillfleisch (Geflügel)
-Kein Grillprodukt
-Käse
-Kein Grillprodukt
+1: Grillfleisch (Geflügel)
+2: Kein Grillprodukt
+3: Käse
+4: Kein Grillprodukt
 """
\ No newline at end of file
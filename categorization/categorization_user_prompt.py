@@ -1,5 +1,5 @@
 CATEGORIZATION_USER_PROMPT = """
-Here are all the products, each separated by a newline character. Provide the category for every product.
+Here are all the products, each on its own line and starting with its id. Provide the category for every product, together with its id.
 
 Products:
 
@@ -0,0 +1,102 @@
+# categorization/category_cache.py
+
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from openai_integration.models import ProductCategory
+
+CATEGORY_CACHE_FILE_NAME = "category_cache.sqlite"
+LLM_SOURCE = "llm"
+REVIEWER_SOURCE = "reviewer"
+LOCAL_SOURCE = "local"
+# SQLite limits the number of parameters of a query
+MAX_QUERY_PARAMETERS = 900
+
+
+def normalize_product_name(product_name: Optional[str]) -> str:
+    """
+    Returns the key under which a product name is categorized: case, accents written as combining characters,
+    punctuation and whitespace don't matter, so e.g. "Coop Naturafarm Schweinskoteletts," and
+    "COOP  Naturafarm Schweinskoteletts" are the same product.
+    """
+    product_name = unicodedata.normalize("NFKC", str(product_name or "")).casefold()
+    return re.sub(r"[\W_]+", " ", product_name).strip()
+
+
+class CategoryCache:
+    """
+    Persistent cache of product categories by normalized product name, stored in SQLite.
+
+    Holds the categories returned by the LLM, those resolved by the local classifier and the final categories
+    confirmed by reviewers.
+    A reviewer's category is never overwritten by the LLM.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path (str): Path to the SQLite file, created if it doesn't exist.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS categories ("
+                "name_key TEXT PRIMARY KEY, product_name TEXT NOT NULL, category TEXT NOT NULL, "
+                "source TEXT NOT NULL, updated_at REAL NOT NULL)"
+            )
+
+    def get_many(self, name_keys: Iterable[str]) -> Dict[str, ProductCategory]:
+        """
+        Returns the cached category of every normalized product name that has one.
+        """
+        name_keys = list(name_keys)
+        categories = {}
+        with self._lock:
+            for i in range(0, len(name_keys), MAX_QUERY_PARAMETERS):
+                chunk = name_keys[i: i + MAX_QUERY_PARAMETERS]
+                rows = self._connection.execute(
+                    f"SELECT name_key, category FROM categories WHERE name_key IN ({', '.join('?' * len(chunk))})", chunk
+                ).fetchall()
+                categories.update({name_key: ProductCategory(category) for name_key, category in rows})
+        return categories
+
+    def put_many(self, categories: Iterable[Tuple[str, ProductCategory]], source: str = LLM_SOURCE) -> None:
+        """
+        Stores categories, given as pairs of product name and category.
+
+        Parameters:
+            categories (Iterable[Tuple[str, ProductCategory]]): The product names (not normalized) and their categories.
+            source (str): LLM_SOURCE, LOCAL_SOURCE or REVIEWER_SOURCE.
+        """
+        now = time.time()
+        rows = [
+            (normalize_product_name(product_name), product_name, category.value, source, now)
+            for product_name, category in categories
+        ]
+        with self._lock, self._connection:
+            self._connection.executemany(
+                "INSERT INTO categories (name_key, product_name, category, source, updated_at) VALUES (?, ?, ?, ?, ?) "
+                "ON CONFLICT (name_key) DO UPDATE SET product_name = excluded.product_name, category = excluded.category, "
+                "source = excluded.source, updated_at = excluded.updated_at "
+                f"WHERE categories.source != '{REVIEWER_SOURCE}' OR excluded.source = '{REVIEWER_SOURCE}'",
+                rows,
+            )
+
+    def entries(self, sources: Iterable[str]) -> List[Tuple[str, ProductCategory]]:
+        """
+        Returns the product names and categories that were stored by one of the given sources.
+        """
+        sources = list(sources)
+        with self._lock:
+            rows = self._connection.execute(
+                f"SELECT product_name, category FROM categories WHERE source IN ({', '.join('?' * len(sources))})", sources
+            ).fetchall()
+        return [(product_name, ProductCategory(category)) for product_name, category in rows]
@@ -0,0 +1,98 @@
+# categorization/local_classifier.py
+
+import os
+
+import pandas as pd
+from sklearn.feature_extraction.text import TfidfVectorizer
+from sklearn.linear_model import LogisticRegression
+from sklearn.pipeline import Pipeline
+from typing import Iterable, List, Optional, Tuple
+
+from openai_integration.models import ProductCategory
+from settings.settings import LOCAL_CLASSIFIER_THRESHOLD
+from .category_cache import LLM_SOURCE, REVIEWER_SOURCE, CategoryCache, normalize_product_name
+
+GROUND_TRUTH_PATH = os.path.join(os.path.dirname(os.path.dirname(os.path.abspath(__file__))), "test_LLM", "2023_ground_truth.csv")
+# Ground truth 'Sorten' to categories; lamb and unknown products have no category of their own and are left out
+GROUND_TRUTH_CATEGORIES = {
+    "Schwein": ProductCategory.MEAT_PORK,
+    "Geflügel": ProductCategory.MEAT_CHICKEN,
+    "Rind": ProductCategory.MEAT_BEEF,
+    "Gemischt": ProductCategory.MEAT_MIXED,
+    "Fisch & Meeresfrüchte": ProductCategory.FISH_SEE_FOOD,
+    "Ersatzprodukt": ProductCategory.VEGETARIAN_VEGAN,
+    "Käse": ProductCategory.CHEESE,
+}
+
+
+def load_ground_truth(path: str = GROUND_TRUTH_PATH) -> List[Tuple[str, ProductCategory]]:
+    """
+    Returns the product names and categories of the manually labelled 2023 leaflets.
+    """
+    data = pd.read_csv(path)
+    examples = []
+    for product_name, sort, grill_product in zip(data["Produkt"], data["Sorten"], data["Grillprodukt? Ja/nein"]):
+        if not isinstance(product_name, str):
+            continue
+        if str(grill_product).strip().lower() == "nein":
+            examples.append((product_name, ProductCategory.NO_GRILL_PRODUCT))
+        elif sort in GROUND_TRUTH_CATEGORIES:
+            examples.append((product_name, GROUND_TRUTH_CATEGORIES[sort]))
+    return examples
+
+
+class LocalCategoryClassifier:
+    """
+    Small CPU-only classifier of product names: character n-gram TF-IDF features and a logistic regression.
+
+    Resolves the products it is confident about, e.g. obvious non-grill products like detergents and drinks,
+    so that only the uncertain ones are sent to the LLM.
+    """
+
+    def __init__(self, threshold: float = LOCAL_CLASSIFIER_THRESHOLD):
+        """
+        Parameters:
+            threshold (float): Minimum predicted probability for a category to be used without asking the LLM.
+        """
+        self.threshold = threshold
+        self._pipeline: Optional[Pipeline] = None
+
+    @classmethod
+    def train(cls, category_cache: Optional[CategoryCache] = None, threshold: float = LOCAL_CLASSIFIER_THRESHOLD) -> "LocalCategoryClassifier":
+        """
+        Trains a classifier on the ground truth, and on the categories of the LLM and of reviewers in the category cache.
+        """
+        examples = load_ground_truth()
+        if category_cache is not None:
+            examples.extend(category_cache.entries([LLM_SOURCE, REVIEWER_SOURCE]))
+        return cls(threshold).fit(examples)
+
+    def fit(self, examples: Iterable[Tuple[str, ProductCategory]]) -> "LocalCategoryClassifier":
+        """
+        Trains the classifier on pairs of product name and category. With fewer than two categories
+        there is nothing to learn, and the classifier stays untrained and resolves nothing.
+        """
+        examples = list(examples)
+        if len({category for _, category in examples}) < 2:
+            self._pipeline = None
+            return self
+        self._pipeline = Pipeline([
+            ("tfidf", TfidfVectorizer(analyzer="char_wb", ngram_range=(2, 4), preprocessor=normalize_product_name, sublinear_tf=True)),
+            # Weak regularization, the default gives too flat probabilities on the few hundred ground truth names
+            ("classifier", LogisticRegression(C=10, max_iter=1000, class_weight="balanced")),
+        ])
+        self._pipeline.fit([product_name for product_name, _ in examples], [category.value for _, category in examples])
+        return self
+
+    def predict(self, product_names: List[str]) -> List[Optional[ProductCategory]]:
+        """
+        Returns the category of every product name, or None where the classifier isn't confident enough.
+        """
+        if self._pipeline is None or not product_names:
+            return [None] * len(product_names)
+        probabilities = self._pipeline.predict_proba(product_names)
+        classes = self._pipeline.classes_
+        return [
+            ProductCategory(classes[best]) if row[best] >= self.threshold else None
+            for row, best in zip(probabilities, probabilities.argmax(axis=1))
+        ]
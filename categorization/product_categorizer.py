@@ -1,18 +1,43 @@
 # categorization/product_categorizer.py
 
+import asyncio
+import numpy as np
 import pandas as pd
-import time
-from typing import Any
+import threading
+from concurrent.futures import Future
+from typing import Any, Dict, List, Optional, Tuple
 from PIL import Image
 from jupyterlab.semver import compare
 
 from openai_integration.models import CategorizationResult, ProductCategory
+from openai_integration.async_openai_client import AsyncOpenAIClient
 from openai_integration.openai_client import OpenAIClient
+from .category_cache import LOCAL_SOURCE, CategoryCache, normalize_product_name
+from .local_classifier import LocalCategoryClassifier
+
+BATCH_SIZE = 5
+# Follow-up requests for the products a categorization response has no category for
+CATEGORIZATION_RETRIES = 2
 
 
 class ProductCategorizer:
-    def __init__(self):
+    def __init__(self, category_cache: Optional[CategoryCache] = None, local_classifier: Optional[LocalCategoryClassifier] = None):
+        """
+        Parameters:
+            category_cache (Optional[CategoryCache]): If given, categories are looked up there first and stored there.
+            local_classifier (Optional[LocalCategoryClassifier]): If given, names it is confident about aren't sent to the LLM.
+        """
         self.categorization_columns = []
+        self.category_cache = category_cache
+        self.local_classifier = local_classifier
+        # Distinct names of this run by where their category came from
+        self.names_from_cache = 0
+        self.names_resolved_locally = 0
+        self.names_sent_to_llm = 0
+        # Categories of this run by normalized product name, and the names being categorized right now
+        self._known_categories: Dict[str, ProductCategory] = {}
+        self._in_flight: Dict[str, Future] = {}
+        self._lock = threading.Lock()
 
     def categorize_products(self, data: pd.DataFrame, openai_client: OpenAIClient) -> pd.DataFrame:
         """
@@ -25,21 +50,183 @@ class ProductCategorizer:
         Returns:
             pd.DataFrame: DataFrame with an added 'Category' column for product categorization.
         """
+        product_names = list(data['extracted_product_name'])
+        categories = self.categorize_names(product_names, openai_client)
+        return self.assign_categories(data, [categories.get(normalize_product_name(name)) for name in product_names])
 
-        product_categories: list[ProductCategory] = []
+    async def categorize_products_async(self, data: pd.DataFrame, openai_client: AsyncOpenAIClient) -> pd.DataFrame:
+        """
+        Same as categorize_products, but sends all batches of products concurrently.
+        """
         product_names = list(data['extracted_product_name'])
-        step_size = 5
-        for i in range(0, len(product_names), step_size):
-            categorization_results = openai_client.categorize_products(product_names[i: i+step_size])
-            time.sleep(31)
-            product_categories.extend(categorization_results.categories)
+        categories = await self.categorize_names_async(product_names, openai_client)
+        return self.assign_categories(data, [categories.get(normalize_product_name(name)) for name in product_names])
+
+    def categorize_names(self, product_names: List[str], openai_client: OpenAIClient) -> Dict[str, Optional[ProductCategory]]:
+        """
+        Categorizes product names, sending each distinct (normalized) name to the LLM at most once per run.
+        Names in the category cache, already categorized in this run or confidently categorized by the local
+        classifier cost no API call, and names that another thread is categorizing at the same time are waited
+        for instead of being sent again. Names a response has no category for are sent again in follow-up batches
+        of only those names, at most CATEGORIZATION_RETRIES times.
+
+        Returns:
+            Dict[str, Optional[ProductCategory]]: The category by normalized product name, None if the LLM gave none.
+        """
+        categories, names_to_send, pending = self.claim_names(product_names)
+        keys_to_send = list(names_to_send)
+        results = {}
+        try:
+            for attempt in range(1 + CATEGORIZATION_RETRIES):
+                for batch in self.make_batches(keys_to_send):
+                    categorization_results = openai_client.categorize_products([names_to_send[key] for key in batch], attempt)
+                    results.update(self.batch_categories(batch, categorization_results))
+                keys_to_send = self.missing_keys(keys_to_send, results)
+                if not keys_to_send:
+                    break
+        finally:
+            # Also on errors, so that nobody waits forever for these names
+            self.resolve_names(names_to_send, results)
+        categories.update(results)
+        categories.update({key: future.result() for key, future in pending.items()})
+        return categories
+
+    async def categorize_names_async(self, product_names: List[str], openai_client: AsyncOpenAIClient) -> Dict[str, Optional[ProductCategory]]:
+        """
+        Same as categorize_names, but sends all batches of names concurrently.
+        """
+        categories, names_to_send, pending = self.claim_names(product_names)
+        keys_to_send = list(names_to_send)
+        results = {}
+        try:
+            for attempt in range(1 + CATEGORIZATION_RETRIES):
+                batches = self.make_batches(keys_to_send)
+                all_categorization_results = await asyncio.gather(*[
+                    openai_client.categorize_products([names_to_send[key] for key in batch], attempt) for batch in batches
+                ])
+                for batch, categorization_results in zip(batches, all_categorization_results):
+                    results.update(self.batch_categories(batch, categorization_results))
+                keys_to_send = self.missing_keys(keys_to_send, results)
+                if not keys_to_send:
+                    break
+        finally:
+            self.resolve_names(names_to_send, results)
+        categories.update(results)
+        for key, future in pending.items():
+            categories[key] = await asyncio.wrap_future(future)
+        return categories
+
+    def claim_names(self, product_names: List[str]) -> Tuple[Dict[str, ProductCategory], Dict[str, str], Dict[str, Future]]:
+        """
+        Sorts product names into the ones whose category is already known, the ones the caller has to categorize,
+        and the ones someone else is categorizing. The caller must pass its names to resolve_names afterwards.
+
+        Returns:
+            Tuple[Dict[str, ProductCategory], Dict[str, str], Dict[str, Future]]: By normalized name: the known
+                categories, the product names to send to the LLM, and futures of the categories being determined.
+        """
+        names_by_key = {}
+        for product_name in product_names:
+            names_by_key.setdefault(normalize_product_name(product_name), product_name)
+
+        with self._lock:
+            unknown_keys = [key for key in names_by_key if key not in self._known_categories and key not in self._in_flight]
+            if self.category_cache is not None and unknown_keys:
+                cached_categories = self.category_cache.get_many(unknown_keys)
+                self._known_categories.update(cached_categories)
+                self.names_from_cache += len(cached_categories)
+                unknown_keys = [key for key in unknown_keys if key not in cached_categories]
+            if self.local_classifier is not None and unknown_keys:
+                local_categories = self.classify_locally({key: names_by_key[key] for key in unknown_keys})
+                self._known_categories.update(local_categories)
+                self.names_resolved_locally += len(local_categories)
+
+            known, names_to_send, pending = {}, {}, {}
+            for key, product_name in names_by_key.items():
+                if key in self._known_categories:
+                    known[key] = self._known_categories[key]
+                elif key in self._in_flight:
+                    pending[key] = self._in_flight[key]
+                else:
+                    names_to_send[key] = product_name
+                    self._in_flight[key] = Future()
+            self.names_sent_to_llm += len(names_to_send)
+        return known, names_to_send, pending
 
+    def classify_locally(self, names_by_key: Dict[str, str]) -> Dict[str, ProductCategory]:
+        """
+        Returns the categories the local classifier is confident about, by normalized name, and stores them
+        in the category cache. They are stored as LOCAL_SOURCE, so the classifier isn't trained on its own guesses.
+        """
+        keys = list(names_by_key)
+        predictions = self.local_classifier.predict([names_by_key[key] for key in keys])
+        categories = {key: category for key, category in zip(keys, predictions) if category is not None}
+        if self.category_cache is not None and categories:
+            self.category_cache.put_many(((names_by_key[key], category) for key, category in categories.items()), source=LOCAL_SOURCE)
+        return categories
+
+    def print_statistics(self) -> None:
+        """
+        Prints where the categories of the distinct product names of this run came from.
+        """
+        total = self.names_from_cache + self.names_resolved_locally + self.names_sent_to_llm
+        if total == 0:
+            return
+        print(f"Categorized {total} distinct product names: {self.names_from_cache / total:.0%} from the category cache, "
+              f"{self.names_resolved_locally / total:.0%} resolved locally, {self.names_sent_to_llm / total:.0%} sent to the LLM.")
+
+    def resolve_names(self, names_to_send: Dict[str, str], categories: Dict[str, Optional[ProductCategory]]) -> None:
+        """
+        Records the categories of names claimed with claim_names, in this run and in the category cache.
+        Names without a category are released, so they are sent again the next time they come up.
+        """
+        with self._lock:
+            for key in names_to_send:
+                category = categories.get(key)
+                if category is not None:
+                    self._known_categories[key] = category
+                self._in_flight.pop(key).set_result(category)
+        if self.category_cache is not None:
+            self.category_cache.put_many(
+                (product_name, categories[key]) for key, product_name in names_to_send.items() if categories.get(key) is not None
+            )
+
+    @staticmethod
+    def make_batches(keys: List[str]) -> List[List[str]]:
+        return [keys[i: i+BATCH_SIZE] for i in range(0, len(keys), BATCH_SIZE)]
+
+    @staticmethod
+    def batch_categories(batch: List[str], categorization_results: Optional[CategorizationResult]) -> Dict[str, ProductCategory]:
+        """
+        Matches the categories of a response to the names of its batch by the ids the response echoes.
+        Names the response has no category for, e.g. because it skipped them or gave an unknown id, are left out.
+        """
+        categories = {}
+        for product in categorization_results.categories if categorization_results else []:
+            if 1 <= product.id <= len(batch):
+                categories.setdefault(batch[product.id - 1], product.category)
+        return categories
+
+    @staticmethod
+    def missing_keys(keys: List[str], categories: Dict[str, ProductCategory]) -> List[str]:
+        """
+        Returns the names that were sent but have no category yet, which are sent again in follow-up batches.
+        """
+        missing = [key for key in keys if key not in categories]
+        if missing:
+            print(f"{len(missing)} of {len(keys)} products are missing from the categorization responses.")
+        return missing
+
+    def assign_categories(self, data: pd.DataFrame, product_categories: List[Optional[ProductCategory]]) -> pd.DataFrame:
+        """
+        Adds the categories returned by the LLM, in the order of data['extracted_product_name'], to the DataFrame.
+        Products without a category are left empty.
+        """
         if len(data.index) == len(product_categories):
-            data['Category'] = [c.value for c in product_categories]
-            self.categorization_columns.append('Category')
+            data['Category'] = [c.value if c is not None else None for c in product_categories]
+            if 'Category' not in self.categorization_columns:
+                self.categorization_columns.append('Category')
         else:
-            # TODO: maybe we should also have ChatGPT return the original product name,
-            # so if the length doesn't match, we can still include the data for most of them.
             print(f"Length of the data {len(data.index)} and the assigned categories {len(product_categories)} do not match!")
             print(product_categories)
 
@@ -50,14 +237,42 @@ class ProductCategorizer:
     def compare_categorization(self, data: pd.DataFrame) -> None:
         """
         compares categorization from e.g. different LLMs or multiple trys of the same LLM
+
+        Counts the votes for every category over all categorization columns at once with NumPy, and adds:
+        - votes_<category>: the number of categorization columns that chose the category, for every category that occurs
+        - final_category: the category with the most votes; ties go to the category of the first column among them
+        - categorization_confidence: the share of categorization columns that voted for final_category
+        - categorization_all_same: True if all categorizations that returned a category agree
         :param data: Dataframe with all the data
         :return: None, the data dataframe is edited itself
         """
         if len(self.categorization_columns) == 0:
             print("WARNING: No categorization columns found!")
-        else:
-            data['categorization_all_same'] = data[self.categorization_columns].apply(lambda product: product.nunique() == 1, axis=1) # create new column that contains True if all categories are the same
-            placeholder = 'To_Check'
-            data['final_category'] = data.apply(lambda product: product[self.categorization_columns[0]] if product['categorization_all_same'] else placeholder, axis=1) # create a column to store potential manual input
+            return
+
+        votes = data[self.categorization_columns].to_numpy(dtype=object)
+        num_rows, num_columns = votes.shape
+        # Missing categories get the code -1 and don't count as a vote
+        codes, categories = pd.factorize(votes.ravel())
+        codes = codes.reshape(votes.shape)
+        has_vote = codes >= 0
+
+        # counts[row, category]: the number of votes for the category
+        rows = np.broadcast_to(np.arange(num_rows)[:, None], codes.shape)
+        counts = np.bincount((rows * len(categories) + codes)[has_vote], minlength=num_rows * len(categories))
+        counts = counts.reshape(num_rows, len(categories))
+        max_votes = counts.max(axis=1, initial=0)
 
+        # Among the categories with the most votes, take the one of the first column that voted for one of them.
+        # The extra zero column is the vote count of the code -1, so missing categories are never picked.
+        votes_for_own_category = np.take_along_axis(np.pad(counts, ((0, 0), (0, 1))), codes, axis=1)
+        winning_column = (votes_for_own_category == max_votes[:, None]).argmax(axis=1)
+        winning_codes = codes[np.arange(num_rows), winning_column]
 
+        data.drop(columns=[column for column in data.columns if str(column).startswith('votes_')], inplace=True)
+        for i, category in enumerate(categories):
+            data[f'votes_{category}'] = counts[:, i]
+        data['categorization_all_same'] = (max_votes > 0) & (max_votes == has_vote.sum(axis=1))
+        data['categorization_confidence'] = max_votes / num_columns
+        # Rows without any vote have the code -1, which picks the None appended to the categories
+        data['final_category'] = np.append(np.asarray(categories, dtype=object), None)[winning_codes]
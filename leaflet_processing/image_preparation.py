@@ -0,0 +1,149 @@
+# leaflet_processing/image_preparation.py
+
+import base64
+import io
+import math
+
+from functools import cached_property
+from PIL import Image
+from pydantic import BaseModel
+from typing import Literal
+
+# OpenAI image token accounting, see https://platform.openai.com/docs/guides/vision
+LOW_DETAIL_TOKENS = 85
+TOKENS_PER_TILE = 170
+TILE_SIZE = 512
+MAX_IMAGE_SIZE = 2048
+SHORTEST_SIDE_SIZE = 768
+
+
+class ImagePreset(BaseModel):
+    """
+    Settings for rendering and encoding leaflet pages before they are uploaded.
+
+    Attributes:
+        dpi (int): Resolution used to render the PDF pages.
+        max_edge (int): Maximum length of the longest edge of the uploaded image, in pixels.
+        image_format (str): Format of the uploaded image.
+        quality (int): JPEG/WebP quality, ignored for PNG.
+        detail (str): OpenAI image detail level.
+    """
+    dpi: int = 150
+    max_edge: int = 1600
+    image_format: Literal["JPEG", "WEBP", "PNG"] = "JPEG"
+    quality: int = 85
+    detail: Literal["low", "high", "auto"] = "high"
+
+
+DEFAULT_PRESET = ImagePreset()
+
+# Magazines have small print, so they get rendered and uploaded at a higher resolution and quality
+SUPERMARKET_PRESETS = {
+    "aldi": ImagePreset(),
+    "coop": ImagePreset(dpi=200, max_edge=2048, quality=90),
+    "denner": ImagePreset(),
+    "lidl": ImagePreset(),
+    "migros": ImagePreset(dpi=200, max_edge=2048, quality=90),
+    "volg": ImagePreset(),
+}
+
+
+def get_preset(leaflet_name: str) -> ImagePreset:
+    """
+    Returns the preset of the supermarket whose name appears in the leaflet name, or the default preset.
+    """
+    leaflet_name = leaflet_name.lower()
+    for supermarket, preset in SUPERMARKET_PRESETS.items():
+        if supermarket in leaflet_name:
+            return preset
+    return DEFAULT_PRESET
+
+
+def estimate_image_tokens(width: int, height: int, detail: str) -> int:
+    """
+    Estimates the number of input tokens OpenAI bills for an image of the given size.
+    """
+    if detail == "low":
+        return LOW_DETAIL_TOKENS
+    scale = min(1.0, MAX_IMAGE_SIZE / max(width, height))
+    width, height = width * scale, height * scale
+    scale = min(1.0, SHORTEST_SIDE_SIZE / min(width, height))
+    width, height = width * scale, height * scale
+    tiles = math.ceil(width / TILE_SIZE) * math.ceil(height / TILE_SIZE)
+    return LOW_DETAIL_TOKENS + TOKENS_PER_TILE * tiles
+
+
+class PreparedImage(BaseModel):
+    """
+    An encoded image ready to be uploaded to OpenAI.
+
+    Attributes:
+        data (bytes): The encoded image.
+        mime_type (str): The MIME type of the encoded image.
+        width (int): Width in pixels.
+        height (int): Height in pixels.
+        detail (str): OpenAI image detail level.
+    """
+    data: bytes
+    mime_type: str
+    width: int
+    height: int
+    detail: str = "auto"
+
+    @classmethod
+    def from_bytes(cls, image_data: bytes, detail: str = "auto") -> "PreparedImage":
+        """
+        Wraps already encoded image bytes without re-encoding them.
+        """
+        with Image.open(io.BytesIO(image_data)) as image:
+            return cls(data=image_data, mime_type=Image.MIME[image.format], width=image.width, height=image.height, detail=detail)
+
+    @property
+    def num_bytes(self) -> int:
+        return len(self.data)
+
+    @property
+    def estimated_tokens(self) -> int:
+        return estimate_image_tokens(self.width, self.height, self.detail)
+
+    @cached_property
+    def base64(self) -> str:
+        return base64.b64encode(self.data).decode('utf-8')
+
+    def data_url(self) -> str:
+        return f"data:{self.mime_type};base64,{self.base64}"
+
+
+def prepare_image(image_data: bytes, preset: ImagePreset = DEFAULT_PRESET) -> PreparedImage:
+    """
+    Downscales an image so its longest edge fits into the preset, and encodes it in the preset's format.
+
+    Parameters:
+        image_data (bytes): The image as read from disk.
+        preset (ImagePreset): The encoding settings.
+
+    Returns:
+        PreparedImage: The encoded image, with its size and estimated token count.
+    """
+    with Image.open(io.BytesIO(image_data)) as image:
+        return encode_image(image, preset)
+
+
+def encode_image(image: Image.Image, preset: ImagePreset = DEFAULT_PRESET) -> PreparedImage:
+    """
+    Same as prepare_image, for an image that is already loaded, e.g. a crop of a page.
+    """
+    image = image.copy()
+    image.thumbnail((preset.max_edge, preset.max_edge), Image.LANCZOS)
+    if preset.image_format != "PNG" and image.mode != "RGB":
+        image = image.convert("RGB")
+
+    output = io.BytesIO()
+    image.save(output, format=preset.image_format, quality=preset.quality)
+    return PreparedImage(
+        data=output.getvalue(),
+        mime_type=Image.MIME[preset.image_format],
+        width=image.width,
+        height=image.height,
+        detail=preset.detail,
+    )
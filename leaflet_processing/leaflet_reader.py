@@ -3,11 +3,19 @@
 import gdown
 import glob
 import os
+import re
+import tempfile
 
-from natsort import natsorted
-from typing import List
-from pdf2image import convert_from_path
-from PyPDF2 import PdfReader
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from typing import Callable, Dict, Iterator, List, Optional, Tuple
+from pdf2image import convert_from_path, pdfinfo_from_path
+
+from .image_preparation import DEFAULT_PRESET
+from .page_manifest import PageManifest, file_sha256, pdf_page_hashes
+from .page_store import PAGE_STORE_FILE_NAME, open_page_store, pack_pages, page_exists
+
+PAGES_PER_CHUNK = 4
+MAX_RASTERIZATION_WORKERS = os.cpu_count() or 1
 
 
 class LeafletReader:
@@ -38,38 +46,185 @@ class LeafletReader:
         gdown.download_folder(self.download_url, output=pdf_dir)
         print("Leaflets downloaded successfully.")
 
-    def convert_pdf_to_images(self, pdf_path: str, output_dir: str, overwrite_images = False) -> List[str]:
+    def convert_pdf_to_images(self, pdf_path: str, output_dir: str, overwrite_images = False, dpi: int = DEFAULT_PRESET.dpi) -> List[str]:
         """
         Splits a PDF into individual images.
 
         Parameters:
             pdf_path (str): Path to the PDF file.
             output_dir (str): Path to where the images will be written.
-            overwrite_images (bool): If False, skips the conversion to images, if enough images are found.
+            overwrite_images (bool): If False, only pages that changed since the last conversion are rendered.
+            dpi (int): Resolution at which the pages are rendered.
 
         Returns:
-            List[str]: List of image paths.
+            List[str]: List of page paths, the pages are read with page_store.read_page.
         """
-        if not overwrite_images:
-            reader = PdfReader(pdf_path)
-            png_files = glob.glob(f"{output_dir}/*.png")
-            png_files = [os.path.basename(f) for f in png_files]
+        self.update_pages(pdf_path, output_dir, overwrite_images, dpi)
+        return PageManifest.load(output_dir).image_paths(output_dir)
 
+    def update_pages(self, pdf_path: str, output_dir: str, overwrite_images = False, dpi: int = DEFAULT_PRESET.dpi,
+                     on_page_rendered: Optional[Callable[[int, str], None]] = None) -> List[int]:
+        """
+        Brings the page images in output_dir up to date with the PDF, using the manifest of the last conversion.
+        The pages are rendered to image files first, and then packed into the leaflet's page store.
 
-            expected_image_names = set([f"{i+1}.png" for i in range(len(reader.pages))])
-            if len(expected_image_names - set(png_files)) == 0:
-                print(f"Found PNG images for {pdf_path}. Skipping conversion from PDF to images.")
-                return natsorted(png_files)
+        An unchanged PDF is recognized by its size and modification time, without reading it.
+        If the PDF was replaced, e.g. by a new week's edition with the same name, only the pages
+        whose content differs from the manifest are rendered again.
 
-        print(f"Converting {pdf_path} to images.")
-        os.makedirs(output_dir, exist_ok=True)
+        Parameters:
+            on_page_rendered (Optional[Callable[[int, str], None]]): Called with the page number and image path
+                of every page as soon as it is rendered, e.g. to start extracting it while the other pages render.
 
-        images = convert_from_path(pdf_path)
-        paths = []
+        Returns:
+            List[int]: The page numbers whose image changed or was removed, empty if nothing changed.
+        """
+        render_settings = {"dpi": dpi}
+        manifest = PageManifest.load(output_dir)
+        reuse_images = not overwrite_images and manifest is not None and manifest.render_settings == render_settings
+
+        if reuse_images and manifest.matches_file(pdf_path) and manifest.images_exist(output_dir):
+            print(f"{pdf_path} is unchanged. Skipping conversion from PDF to images.")
+            self._ensure_packed(output_dir, manifest)
+            return []
+
+        pdf_sha256 = file_sha256(pdf_path)
+        stat = os.stat(pdf_path)
+        if reuse_images and manifest.pdf_sha256 == pdf_sha256 and manifest.images_exist(output_dir):
+            print(f"{pdf_path} was touched, but its content is unchanged. Skipping conversion from PDF to images.")
+            manifest.pdf_size, manifest.pdf_mtime_ns = stat.st_size, stat.st_mtime_ns
+            manifest.save(output_dir)
+            self._ensure_packed(output_dir, manifest)
+            return []
+
+        page_sources = pdf_page_hashes(pdf_path)
+        page_count = len(page_sources)
+        if reuse_images:
+            previous_sources, page_images = manifest.page_sources, dict(manifest.page_images)
+        elif manifest is None and not overwrite_images:
+            # Images from before manifests existed: trust them if they are complete
+            previous_sources, page_images = self._adopt_existing_images(output_dir, page_sources)
+        else:
+            previous_sources, page_images = {}, {}
+
+        pages_to_render = [
+            page_number for page_number in range(1, page_count + 1)
+            if previous_sources.get(str(page_number)) != page_sources[str(page_number)]
+            or not page_exists(os.path.join(output_dir, f"{page_number}.png"))
+        ]
+
+        changed_pages = []
+        if pages_to_render:
+            print(f"Converting pages {pages_to_render} of {pdf_path} to images.")
+            for page_number, path in self.iter_pdf_pages(pdf_path, output_dir, dpi, pages_to_render):
+                image_sha256 = file_sha256(path)
+                if page_images.get(str(page_number)) != image_sha256:
+                    changed_pages.append(page_number)
+                page_images[str(page_number)] = image_sha256
+                if on_page_rendered:
+                    on_page_rendered(page_number, path)
+
+        # The new edition may have fewer pages than the previous one
+        store = open_page_store(output_dir)
+        stored_pages = {self._page_number(page_name) for page_name in store.page_names()} if store else set()
+        for image_path in glob.glob(os.path.join(output_dir, "*.png")):
+            if self._page_number(image_path) > page_count:
+                os.remove(image_path)
+                stored_pages.add(self._page_number(image_path))
+        for page_number in sorted(stored_pages):
+            if page_number > page_count:
+                page_images.pop(str(page_number), None)
+                changed_pages.append(page_number)
+
+        # Pages that aren't part of the new edition are dropped from the store
+        pack_pages(output_dir, [f"{page_number}.png" for page_number in range(1, page_count + 1)])
+
+        PageManifest(
+            pdf_sha256=pdf_sha256,
+            pdf_size=stat.st_size,
+            pdf_mtime_ns=stat.st_mtime_ns,
+            page_count=page_count,
+            render_settings=render_settings,
+            page_sources=page_sources,
+            page_images=page_images,
+        ).save(output_dir)
+        return sorted(changed_pages)
+
+    @staticmethod
+    def _page_number(image_path: str) -> int:
+        """
+        Returns the page number of a page image named <page number>.png, 0 for other files.
+        """
+        page_name, _ = os.path.splitext(os.path.basename(image_path))
+        return int(page_name) if page_name.isdigit() else 0
+
+    @staticmethod
+    def _ensure_packed(output_dir: str, manifest: PageManifest) -> None:
+        # Leaflets converted before page stores existed only have image files
+        if not os.path.exists(os.path.join(output_dir, PAGE_STORE_FILE_NAME)):
+            pack_pages(output_dir, [os.path.basename(path) for path in manifest.image_paths(output_dir)])
+
+    @staticmethod
+    def _adopt_existing_images(output_dir: str, page_sources: Dict[str, str]) -> Tuple[Dict[str, str], Dict[str, str]]:
+        image_paths = [os.path.join(output_dir, f"{page_number}.png") for page_number in page_sources]
+        if not all(os.path.exists(path) for path in image_paths):
+            return {}, {}
+        print(f"Found PNG images in {output_dir}, recording them in a manifest.")
+        return dict(page_sources), {page_number: file_sha256(path) for page_number, path in zip(page_sources, image_paths)}
+
+    def iter_pdf_pages(self, pdf_path: str, output_dir: str, dpi: int = DEFAULT_PRESET.dpi, pages: Optional[List[int]] = None) -> Iterator[Tuple[int, str]]:
+        """
+        Renders a PDF into output_dir/<page>.png, yielding each page as soon as it is written.
+
+        Page ranges are rendered in parallel by separate pdftoppm processes, which write the
+        images straight to disk, so memory use doesn't grow with the number of pages.
 
-        for i, image in enumerate(images):
-            output_filename = os.path.join(output_dir, f"{i+1}.png")
-            image.save(output_filename, format='PNG')
-            paths.append(output_filename)
+        Parameters:
+            pdf_path (str): Path to the PDF file.
+            output_dir (str): Path to where the images will be written.
+            dpi (int): Resolution at which the pages are rendered.
+            pages (Optional[List[int]]): The page numbers to render, all pages if None.
 
-        return natsorted(paths)
+        Returns:
+            Iterator[Tuple[int, str]]: Page number and image path, in the order the pages finish rendering.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        if pages is None:
+            pages = list(range(1, pdfinfo_from_path(pdf_path)["Pages"] + 1))
+
+        # Consecutive pages are rendered together, up to PAGES_PER_CHUNK at a time
+        page_ranges = []
+        for page_number in sorted(pages):
+            if page_ranges and page_ranges[-1][1] == page_number - 1 and page_number - page_ranges[-1][0] < PAGES_PER_CHUNK:
+                page_ranges[-1] = (page_ranges[-1][0], page_number)
+            else:
+                page_ranges.append((page_number, page_number))
+
+        # The rendering happens in the pdftoppm subprocesses, so threads are enough to use all cores
+        with ThreadPoolExecutor(max_workers=MAX_RASTERIZATION_WORKERS) as executor:
+            futures = [
+                executor.submit(render_page_range, pdf_path, output_dir, first_page, last_page, dpi)
+                for first_page, last_page in page_ranges
+            ]
+            for future in as_completed(futures):
+                yield from future.result()
+
+
+def render_page_range(pdf_path: str, output_dir: str, first_page: int, last_page: int, dpi: int) -> List[Tuple[int, str]]:
+    """
+    Renders the pages first_page to last_page (inclusive) of a PDF to output_dir/<page>.png.
+    """
+    with tempfile.TemporaryDirectory(dir=output_dir, prefix=".render-") as temp_dir:
+        # pdftoppm writes the pages to disk itself, paths_only avoids loading them as images
+        rendered_paths = convert_from_path(
+            pdf_path, dpi=dpi, first_page=first_page, last_page=last_page,
+            output_folder=temp_dir, output_file="page", fmt="png", paths_only=True,
+        )
+        pages = []
+        for rendered_path in rendered_paths:
+            # pdftoppm names the pages page-<number>.png, with the number zero-padded
+            page_number = int(re.search(r"(\d+)\.png$", rendered_path).group(1))
+            output_filename = os.path.join(output_dir, f"{page_number}.png")
+            os.replace(rendered_path, output_filename)
+            pages.append((page_number, output_filename))
+    return pages
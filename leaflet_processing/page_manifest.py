@@ -0,0 +1,114 @@
+# leaflet_processing/page_manifest.py
+
+import hashlib
+import os
+
+from pydantic import BaseModel
+from PyPDF2 import PdfReader
+from PyPDF2.generic import ArrayObject, DictionaryObject, IndirectObject, StreamObject
+from typing import Dict, List, Optional
+
+from .page_store import page_exists
+
+MANIFEST_FILE_NAME = "manifest.json"
+# Entries of a page that determine how it looks; /Parent is left out, it points to the whole document
+PAGE_APPEARANCE_KEYS = ["/Contents", "/Resources", "/MediaBox", "/CropBox", "/Rotate"]
+
+
+class PageManifest(BaseModel):
+    """
+    Records which PDF the page images of a leaflet were rendered from, and how.
+
+    Attributes:
+        pdf_sha256 (str): Hash of the PDF file.
+        pdf_size (int): Size of the PDF file, used with pdf_mtime_ns to skip unchanged PDFs without hashing them.
+        pdf_mtime_ns (int): Modification time of the PDF file.
+        page_count (int): Number of pages of the PDF.
+        render_settings (Dict[str, int]): Settings the pages were rendered with, e.g. the DPI.
+        page_sources (Dict[str, str]): Hash of each page's content in the PDF, by page number.
+        page_images (Dict[str, str]): Hash of each rendered page image, by page number.
+    """
+    pdf_sha256: str
+    pdf_size: int
+    pdf_mtime_ns: int
+    page_count: int
+    render_settings: Dict[str, int]
+    page_sources: Dict[str, str] = {}
+    page_images: Dict[str, str] = {}
+
+    @classmethod
+    def load(cls, output_dir: str) -> Optional["PageManifest"]:
+        path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        if not os.path.exists(path):
+            return None
+        with open(path, "r", encoding="utf-8") as manifest_file:
+            return cls.model_validate_json(manifest_file.read())
+
+    def save(self, output_dir: str) -> None:
+        path = os.path.join(output_dir, MANIFEST_FILE_NAME)
+        # Write to a temporary file first, so a crash never leaves a half-written manifest behind
+        with open(path + ".tmp", "w", encoding="utf-8") as manifest_file:
+            manifest_file.write(self.model_dump_json(indent=2))
+        os.replace(path + ".tmp", path)
+
+    def matches_file(self, pdf_path: str) -> bool:
+        """
+        Cheap check whether the PDF is unchanged, comparing only its size and modification time.
+        """
+        stat = os.stat(pdf_path)
+        return stat.st_size == self.pdf_size and stat.st_mtime_ns == self.pdf_mtime_ns
+
+    def image_paths(self, output_dir: str) -> List[str]:
+        return [os.path.join(output_dir, f"{page_number}.png") for page_number in range(1, self.page_count + 1)]
+
+    def images_exist(self, output_dir: str) -> bool:
+        return all(page_exists(path) for path in self.image_paths(output_dir))
+
+
+def file_sha256(path: str) -> str:
+    sha256 = hashlib.sha256()
+    with open(path, "rb") as file:
+        for chunk in iter(lambda: file.read(1024 * 1024), b""):
+            sha256.update(chunk)
+    return sha256.hexdigest()
+
+
+def pdf_page_hashes(pdf_path: str) -> Dict[str, str]:
+    """
+    Hashes the content of every page of a PDF: its content streams, its resources (fonts, images) and its size.
+    A page keeps its hash when other pages of the PDF change, so only changed pages need to be rendered again.
+
+    Returns:
+        Dict[str, str]: The hash of each page, by page number (starting at 1).
+    """
+    reader = PdfReader(pdf_path)
+    page_hashes = {}
+    for page_number, page in enumerate(reader.pages, start=1):
+        sha256 = hashlib.sha256()
+        for key in PAGE_APPEARANCE_KEYS:
+            sha256.update(key.encode("utf-8"))
+            _hash_pdf_object(page.raw_get(key) if key in page else None, sha256, set())
+        page_hashes[str(page_number)] = sha256.hexdigest()
+    return page_hashes
+
+
+def _hash_pdf_object(pdf_object, sha256, seen: set) -> None:
+    if isinstance(pdf_object, IndirectObject):
+        if pdf_object.idnum in seen:
+            return
+        seen.add(pdf_object.idnum)
+        pdf_object = pdf_object.get_object()
+
+    if isinstance(pdf_object, StreamObject):
+        sha256.update(pdf_object.get_data())
+    if isinstance(pdf_object, DictionaryObject):
+        for key in sorted(pdf_object.keys()):
+            if key == "/Parent":
+                continue
+            sha256.update(key.encode("utf-8"))
+            _hash_pdf_object(pdf_object.raw_get(key), sha256, seen)
+    elif isinstance(pdf_object, ArrayObject):
+        for item in pdf_object:
+            _hash_pdf_object(item, sha256, seen)
+    else:
+        sha256.update(repr(pdf_object).encode("utf-8"))
@@ -0,0 +1,150 @@
+# leaflet_processing/page_previews.py
+
+import io
+import os
+import threading
+
+from concurrent.futures import ThreadPoolExecutor
+from PIL import Image
+from typing import Dict, Iterable, Optional, Tuple
+
+from .page_store import PAGE_STORE_FILE_NAME, read_page
+from .region_detector import Box
+
+PREVIEWS_DIR_NAME = "previews"
+# Widths of the previews of every page, from small to large. The sidebar shows the middle one,
+# which is sharp on high-density screens; zooming into a product uses the largest one.
+PREVIEW_WIDTHS = (320, 640, 1280)
+SIDEBAR_PREVIEW_WIDTH = 640
+PREVIEW_QUALITY = 80
+# WebP encoder effort, 0-6: 2 encodes twice as fast as the default 4, for previews 1% larger
+PREVIEW_ENCODER_METHOD = 2
+# Space around a product when zooming into its region, as a fraction of the region's size
+ZOOM_MARGIN = 0.1
+PREFETCH_WORKERS = 2
+
+
+class PagePreviews:
+    """
+    Creates and caches downscaled WebP previews of leaflet pages, at the fixed PREVIEW_WIDTHS, in a previews
+    folder in the leaflet's directory. All sizes are made at once from the full page, the first time a page is
+    shown or prefetched, and are made again only when the page image changes.
+    """
+
+    def __init__(self, widths: Tuple[int, ...] = PREVIEW_WIDTHS, quality: int = PREVIEW_QUALITY):
+        """
+        Parameters:
+            widths (Tuple[int, ...]): Widths of the previews, from small to large.
+            quality (int): WebP quality of the previews, 0-100.
+        """
+        self.widths = widths
+        self.quality = quality
+        self._executor = ThreadPoolExecutor(max_workers=PREFETCH_WORKERS, thread_name_prefix="page-previews")
+        # One lock per page, so a page is never made twice at the same time, e.g. when prefetched and shown
+        self._locks: Dict[str, threading.Lock] = {}
+        self._locks_lock = threading.Lock()
+
+    def preview_path(self, image_path: str, width: int = SIDEBAR_PREVIEW_WIDTH) -> str:
+        """
+        Returns the path of a page's preview of the given width, one of the preview widths, making the previews if needed.
+        """
+        path = self._preview_path(image_path, width)
+        with self._page_lock(image_path):
+            if not self._is_current(path, image_path):
+                self._make_previews(image_path)
+        return path
+
+    def prefetch(self, image_paths: Iterable[str]) -> None:
+        """
+        Makes the previews of the pages in the background, e.g. of the next and previous page.
+        """
+        for image_path in image_paths:
+            try:
+                if self._is_current(self._preview_path(image_path, self.widths[-1]), image_path):
+                    continue
+            except FileNotFoundError:
+                continue
+            self._executor.submit(self._prefetch, image_path)
+
+    def zoom(self, image_path: str, region: Box, width: Optional[int] = None) -> Image.Image:
+        """
+        Returns the part of a page with a product, cut from the preview of the given width, the largest if None.
+
+        Parameters:
+            image_path (str): The page.
+            region (Box): The product's region, in pixels of the full page image.
+        """
+        width = width or self.widths[-1]
+        page_width = self.page_size(image_path)[0]
+        left, top, right, bottom = region
+        margin_x, margin_y = (right - left) * ZOOM_MARGIN, (bottom - top) * ZOOM_MARGIN
+        # The crop is loaded before the preview file is closed
+        with Image.open(self.preview_path(image_path, width)) as preview:
+            scale = preview.width / page_width
+            zoomed = preview.crop((
+                max(0, int((left - margin_x) * scale)), max(0, int((top - margin_y) * scale)),
+                min(preview.width, int((right + margin_x) * scale)), min(preview.height, int((bottom + margin_y) * scale)),
+            ))
+            zoomed.load()
+        return zoomed
+
+    @staticmethod
+    def page_size(image_path: str) -> Tuple[int, int]:
+        # Only the header of the image is read, not its pixels
+        with Image.open(io.BytesIO(read_page(image_path))) as image:
+            return image.size
+
+    def _prefetch(self, image_path: str) -> None:
+        try:
+            self.preview_path(image_path, self.widths[-1])
+        except Exception as e:
+            print(f"Prefetching the previews of {image_path} failed: {e}")
+
+    def _make_previews(self, image_path: str) -> None:
+        with Image.open(io.BytesIO(read_page(image_path))) as image:
+            image = image.convert("RGB")
+            os.makedirs(os.path.dirname(self._preview_path(image_path, self.widths[0])), exist_ok=True)
+            # Each size is scaled from the next larger one, which is faster than always scaling the full page
+            for width in sorted(self.widths, reverse=True):
+                if width < image.width:
+                    image = image.resize((width, round(image.height * width / image.width)), Image.LANCZOS, reducing_gap=3.0)
+                path = self._preview_path(image_path, width)
+                image.save(path + ".tmp", format="WEBP", quality=self.quality, method=PREVIEW_ENCODER_METHOD)
+                os.replace(path + ".tmp", path)
+
+    def _is_current(self, preview_path: str, image_path: str) -> bool:
+        try:
+            preview_mtime = os.path.getmtime(preview_path)
+        except FileNotFoundError:
+            return False
+        return preview_mtime >= self._page_mtime(image_path)
+
+    @staticmethod
+    def _page_mtime(image_path: str) -> float:
+        # Pages are image files, or packed into the leaflet's page store
+        for path in [image_path, os.path.join(os.path.dirname(image_path), PAGE_STORE_FILE_NAME)]:
+            try:
+                return os.path.getmtime(path)
+            except FileNotFoundError:
+                pass
+        raise FileNotFoundError(image_path)
+
+    @staticmethod
+    def _preview_path(image_path: str, width: int) -> str:
+        page_name, _ = os.path.splitext(os.path.basename(image_path))
+        return os.path.join(os.path.dirname(image_path), PREVIEWS_DIR_NAME, f"{page_name}-{width}.webp")
+
+    def _page_lock(self, image_path: str) -> threading.Lock:
+        with self._locks_lock:
+            return self._locks.setdefault(image_path, threading.Lock())
+
+
+def parse_region(region) -> Optional[Box]:
+    """
+    Returns the region of a product as saved in its results, e.g. "10,20,300,400", None if it has none.
+    """
+    try:
+        left, top, right, bottom = (int(float(coordinate)) for coordinate in str(region).split(","))
+    except ValueError:
+        return None
+    return (left, top, right, bottom) if right > left and bottom > top else None
@@ -0,0 +1,201 @@
+# leaflet_processing/page_store.py
+
+import hashlib
+import io
+import json
+import mmap
+import os
+import struct
+import threading
+
+from natsort import natsorted
+from PIL import Image
+from pydantic import BaseModel
+from typing import Dict, Iterable, List, Optional, Tuple
+
+PAGE_STORE_FILE_NAME = "pages.pack"
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg')
+MAGIC = b"WWFPAGES"
+VERSION = 1
+# magic, format version, offset and length of the JSON index
+HEADER = struct.Struct("<8sIQQ")
+
+
+class PageEntry(BaseModel):
+    """
+    Where a page is stored in the page store, and what it is.
+
+    Attributes:
+        offset (int): Position of the encoded image in the store file.
+        length (int): Size of the encoded image in bytes.
+        sha256 (str): Hash of the encoded image.
+        mime_type (str): The MIME type of the encoded image.
+        width (int): Width in pixels.
+        height (int): Height in pixels.
+    """
+    offset: int
+    length: int
+    sha256: str
+    mime_type: str
+    width: int
+    height: int
+
+
+class PageStore:
+    """
+    The page images of a leaflet packed into a single file: the encoded images one after the other, followed by
+    a JSON index with the offset and metadata of every page, in page order.
+
+    The file is memory-mapped, so reading a page is a copy of a slice of the mapping instead of a file open and read,
+    and listing the pages of a leaflet doesn't need a directory scan. Pages are returned as copies, so the mapping
+    can be closed as soon as the store is rewritten, even while pages read from it are still in use.
+    """
+
+    def __init__(self, path: str):
+        self.path = path
+        with open(path, "rb") as store_file:
+            self._mmap = mmap.mmap(store_file.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, index_offset, index_length = HEADER.unpack_from(self._mmap, 0)
+        if magic != MAGIC or version != VERSION:
+            raise ValueError(f"{path} is not a page store of version {VERSION}.")
+        index = json.loads(self._mmap[index_offset:index_offset + index_length])
+        self.pages: Dict[str, PageEntry] = {name: PageEntry(**entry) for name, entry in index["pages"].items()}
+
+    def __contains__(self, page_name: str) -> bool:
+        return page_name in self.pages
+
+    def page_names(self) -> List[str]:
+        return list(self.pages)
+
+    def read(self, page_name: str) -> bytes:
+        """
+        Returns the encoded image of a page.
+        """
+        entry = self.pages[page_name]
+        return self._mmap[entry.offset:entry.offset + entry.length]
+
+    def close(self) -> None:
+        self._mmap.close()
+
+    @staticmethod
+    def write(path: str, pages: Iterable[Tuple[str, bytes]]) -> None:
+        """
+        Writes the pages, given as pairs of page name and encoded image, into a new page store at path.
+        The store is written next to path and moved into place, so readers never see a half-written store.
+        """
+        index = {}
+        with open(path + ".tmp", "wb") as store_file:
+            store_file.write(HEADER.pack(MAGIC, VERSION, 0, 0))
+            for page_name, image_data in pages:
+                with Image.open(io.BytesIO(image_data)) as image:
+                    mime_type, width, height = Image.MIME[image.format], image.width, image.height
+                index[page_name] = PageEntry(
+                    offset=store_file.tell(), length=len(image_data), sha256=hashlib.sha256(image_data).hexdigest(),
+                    mime_type=mime_type, width=width, height=height,
+                ).model_dump()
+                store_file.write(image_data)
+
+            index_offset = store_file.tell()
+            index_data = json.dumps({"pages": index}).encode("utf-8")
+            store_file.write(index_data)
+            store_file.seek(0)
+            store_file.write(HEADER.pack(MAGIC, VERSION, index_offset, len(index_data)))
+        os.replace(path + ".tmp", path)
+
+
+_open_stores: Dict[str, Tuple[tuple, PageStore]] = {}
+_open_stores_lock = threading.Lock()
+
+
+def open_page_store(directory: str) -> Optional[PageStore]:
+    """
+    Returns the page store of a leaflet directory, None if it has none.
+    Stores stay open between calls, and are opened again once they are rewritten.
+    """
+    with _open_stores_lock:
+        return _current_store(directory)
+
+
+def _current_store(directory: str) -> Optional[PageStore]:
+    # Called with _open_stores_lock held
+    path = os.path.join(directory, PAGE_STORE_FILE_NAME)
+    try:
+        stat = os.stat(path)
+    except FileNotFoundError:
+        return None
+    version = (stat.st_ino, stat.st_size, stat.st_mtime_ns)
+    cached = _open_stores.get(path)
+    if cached is None or cached[0] != version:
+        if cached is not None:
+            # Pages are read from a store only while holding the lock, and are copies, so nothing uses the mapping anymore
+            cached[1].close()
+        cached = _open_stores[path] = (version, PageStore(path))
+    return cached[1]
+
+
+def _read_stored_page(directory: str, page_name: str) -> Optional[bytes]:
+    """
+    Returns a page from the directory's page store, None if it isn't stored there.
+    """
+    with _open_stores_lock:
+        store = _current_store(directory)
+        return store.read(page_name) if store is not None and page_name in store else None
+
+
+def read_page(image_path: str) -> bytes:
+    """
+    Returns the encoded image of a page, from its image file if there is one, else from the leaflet's page store.
+    Page paths look the same either way: <leaflet directory>/<page name>.
+    """
+    try:
+        with open(image_path, "rb") as image_file:
+            return image_file.read()
+    except FileNotFoundError:
+        # The page may have been packed into the store since it was listed
+        image_data = _read_stored_page(os.path.dirname(image_path), os.path.basename(image_path))
+        if image_data is None:
+            raise
+        return image_data
+
+
+def page_exists(image_path: str) -> bool:
+    if os.path.exists(image_path):
+        return True
+    store = open_page_store(os.path.dirname(image_path))
+    return store is not None and os.path.basename(image_path) in store
+
+
+def list_page_paths(directory: str) -> List[str]:
+    """
+    Returns the paths of all pages of a leaflet, in page order. Leaflets with a page store are listed
+    from its index, others, e.g. leaflets uploaded as images, from the image files in the directory.
+    """
+    store = open_page_store(directory)
+    if store is not None:
+        return [os.path.join(directory, page_name) for page_name in store.page_names()]
+    return natsorted(os.path.join(directory, file) for file in os.listdir(directory) if file.lower().endswith(IMAGE_EXTENSIONS))
+
+
+def pack_pages(directory: str, page_names: List[str]) -> None:
+    """
+    Writes the given pages into the directory's page store, and deletes their image files.
+    Each page is taken from its image file if there is one, else from the current store;
+    pages that aren't listed are dropped from the store.
+    """
+    def pages():
+        for page_name in page_names:
+            image_path = os.path.join(directory, page_name)
+            if os.path.exists(image_path):
+                with open(image_path, "rb") as image_file:
+                    yield page_name, image_file.read()
+            else:
+                image_data = _read_stored_page(directory, page_name)
+                if image_data is None:
+                    raise FileNotFoundError(image_path)
+                yield page_name, image_data
+
+    PageStore.write(os.path.join(directory, PAGE_STORE_FILE_NAME), pages())
+    for page_name in page_names:
+        image_path = os.path.join(directory, page_name)
+        if os.path.exists(image_path):
+            os.remove(image_path)
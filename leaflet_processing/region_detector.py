@@ -0,0 +1,158 @@
+# leaflet_processing/region_detector.py
+
+import re
+
+import numpy as np
+from PIL import Image
+from typing import Dict, List, Optional, Tuple
+
+from openai_integration.models import GroceryProduct, Results
+
+Box = Tuple[int, int, int, int]  # left, top, right, bottom in pixels of the page image
+
+# Pages are analysed at a reduced size, which is plenty to find the gutters between product tiles
+ANALYSIS_MAX_EDGE = 800
+# Pixels differing from the background by more than this (0-255) count as content
+BACKGROUND_TOLERANCE = 30
+# A row/column counts as empty if less than this fraction of it is content
+EMPTY_LINE_FRACTION = 0.01
+# Gutters must be at least this fraction of the page edge wide
+MIN_GAP_FRACTION = 0.008
+# Regions are never split into parts smaller than this fraction of the page edge
+MIN_REGION_FRACTION = 0.15
+# Pages that fall apart into more regions than this are extracted as a whole
+MAX_REGIONS = 16
+# Crops are padded by this fraction of the page edge, so products on a region's border aren't cut off
+PADDING_FRACTION = 0.02
+
+
+class RegionDetector:
+    """
+    Segments a leaflet page into product regions with a recursive XY-cut: the page is split along the widest
+    horizontal or vertical gutter of background colour, and each part again, until no gutter is left.
+    Runs on the CPU with numpy only.
+    """
+
+    def __init__(self, min_region_fraction: float = MIN_REGION_FRACTION, max_regions: int = MAX_REGIONS):
+        """
+        Parameters:
+            min_region_fraction (float): Regions are never smaller than this fraction of the page's width and height.
+            max_regions (int): If a page has more regions than this, the whole page is returned as one region.
+        """
+        self.min_region_fraction = min_region_fraction
+        self.max_regions = max_regions
+
+    def detect(self, image: Image.Image) -> List[Box]:
+        """
+        Returns the product regions of a page in reading order (top to bottom, left to right).
+        If the page can't be segmented, the whole page is returned as a single region.
+        """
+        full_page = (0, 0, image.width, image.height)
+        scale = min(1.0, ANALYSIS_MAX_EDGE / max(image.size))
+        small = image.convert("L").resize((max(1, round(image.width * scale)), max(1, round(image.height * scale))))
+        pixels = np.asarray(small, dtype=np.int16)
+
+        border = np.concatenate([pixels[0], pixels[-1], pixels[:, 0], pixels[:, -1]])
+        background = np.median(border)
+        content = np.abs(pixels - background) > BACKGROUND_TOLERANCE
+        if not content.any():
+            return [full_page]
+
+        height, width = content.shape
+        min_size = (self.min_region_fraction * width, self.min_region_fraction * height)
+        min_gap = (max(1, MIN_GAP_FRACTION * width), max(1, MIN_GAP_FRACTION * height))
+        boxes = self._xy_cut(content, (0, 0, width, height), min_size, min_gap)
+        if len(boxes) <= 1 or len(boxes) > self.max_regions:
+            return [full_page]
+
+        padding = round(PADDING_FRACTION * max(image.size))
+        return [
+            (max(0, round(left / scale) - padding), max(0, round(top / scale) - padding),
+             min(image.width, round(right / scale) + padding), min(image.height, round(bottom / scale) + padding))
+            for left, top, right, bottom in boxes
+        ]
+
+    def _xy_cut(self, content: np.ndarray, box: Box, min_size: Tuple[float, float], min_gap: Tuple[float, float]) -> List[Box]:
+        box = self._trim(content, box)
+        if box is None:
+            return []
+        left, top, right, bottom = box
+        region = content[top:bottom, left:right]
+
+        # axis 0: split between rows (horizontal gutter), axis 1: split between columns (vertical gutter)
+        best_split = None
+        for axis in (0, 1):
+            profile = region.mean(axis=1 - axis) > EMPTY_LINE_FRACTION
+            gap = self._widest_gap(profile, min_part=min_size[1 - axis], min_gap=min_gap[1 - axis])
+            if gap is not None and (best_split is None or gap[1] - gap[0] > best_split[2] - best_split[1]):
+                best_split = (axis, *gap)
+
+        if best_split is None:
+            return [box]
+
+        axis, gap_start, gap_end = best_split
+        if axis == 0:
+            first, second = (left, top, right, top + gap_start), (left, top + gap_end, right, bottom)
+        else:
+            first, second = (left, top, left + gap_start, bottom), (left + gap_end, top, right, bottom)
+        return self._xy_cut(content, first, min_size, min_gap) + self._xy_cut(content, second, min_size, min_gap)
+
+    @staticmethod
+    def _trim(content: np.ndarray, box: Box) -> Optional[Box]:
+        """
+        Shrinks the box to the rows and columns that contain content.
+        """
+        left, top, right, bottom = box
+        region = content[top:bottom, left:right]
+        rows = np.flatnonzero(region.mean(axis=1) > EMPTY_LINE_FRACTION)
+        columns = np.flatnonzero(region.mean(axis=0) > EMPTY_LINE_FRACTION)
+        if len(rows) == 0 or len(columns) == 0:
+            return None
+        return left + columns[0], top + rows[0], left + columns[-1] + 1, top + rows[-1] + 1
+
+    @staticmethod
+    def _widest_gap(has_content: np.ndarray, min_part: float, min_gap: float) -> Optional[Tuple[int, int]]:
+        """
+        Finds the widest run of empty lines that leaves at least `min_part` lines on both sides.
+        """
+        # Run boundaries: +1 where an empty run starts, -1 where it ends
+        edges = np.diff(np.concatenate([[0], (~has_content).astype(np.int8), [0]]))
+        starts, ends = np.flatnonzero(edges == 1), np.flatnonzero(edges == -1)
+        valid = (ends - starts >= min_gap) & (starts >= min_part) & (len(has_content) - ends >= min_part)
+        if not valid.any():
+            return None
+        widest = np.argmax(np.where(valid, ends - starts, -1))
+        return starts[widest], ends[widest]
+
+
+def _normalize(value: Optional[str]) -> str:
+    return re.sub(r"\s+", " ", str(value or "")).strip().casefold()
+
+
+def merge_region_results(region_results: List[Optional[Results]], boxes: List[Box]) -> Tuple[Results, List[Box]]:
+    """
+    Merges the products extracted from the regions of a page into one page-level result.
+    A product extracted again from another region that overlaps the first is kept only once, in the first region.
+    Products with the same name and price in regions that don't overlap, e.g. two pack sizes, are both kept.
+
+    Returns:
+        Tuple[Results, List[Box]]: The merged products and, for each product, the region it was extracted from.
+    """
+    products: List[GroceryProduct] = []
+    product_boxes: List[Box] = []
+    # The regions each product was kept in, by its key
+    seen: Dict[tuple, List[Box]] = {}
+    for results, box in zip(region_results, boxes):
+        for product in results.all_products if results else []:
+            key = (_normalize(product.product_name), _normalize(product.original_price),
+                   _normalize(product.discount_price), _normalize(product.discount_details))
+            if any(seen_box != box and _overlap(seen_box, box) for seen_box in seen.get(key, [])):
+                continue
+            seen.setdefault(key, []).append(box)
+            products.append(product)
+            product_boxes.append(box)
+    return Results(all_products=products), product_boxes
+
+
+def _overlap(first: Box, second: Box) -> bool:
+    return first[0] < second[2] and second[0] < first[2] and first[1] < second[3] and second[1] < first[3]
@@ -0,0 +1,126 @@
+# leaflet_processing/upload_staging.py
+
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import time
+import zipfile
+
+from typing import BinaryIO, Callable, Iterable, List, Set
+
+# Lists the processable files of a staged upload, written last so a staging directory with it is complete
+LISTING_FILE_NAME = "listing.json"
+FILES_DIR_NAME = "files"
+COPY_CHUNK_SIZE = 1024 * 1024
+# Staged uploads that haven't been used for this long are deleted, so leaflet zips of hundreds of MB don't fill the disk
+STAGED_UPLOAD_MAX_IDLE_IN_SECS = 24 * 60 * 60
+
+
+class UploadStaging:
+    """
+    Stages uploaded zip files on disk, in a directory named after the hash of the zip's content.
+    The upload is hashed while it is copied to disk and its processable files are extracted once,
+    so an upload is never held in memory twice and uploading the same zip again reuses its staged files.
+    Every use of a staged upload marks it as used, uploads that haven't been used for STAGED_UPLOAD_MAX_IDLE_IN_SECS are deleted.
+    """
+
+    def __init__(self, staging_root: str, can_process_file: Callable[[str], bool]):
+        """
+        Parameters:
+            staging_root (str): Directory the uploads are staged in.
+            can_process_file (Callable[[str], bool]): Whether a file of the zip, by its name, should be extracted.
+        """
+        self.staging_root = staging_root
+        self.can_process_file = can_process_file
+
+    def stage(self, upload: BinaryIO, in_use: Iterable[str] = ()) -> str:
+        """
+        Stages an uploaded zip file, unless the same content has already been staged.
+
+        Parameters:
+            upload (BinaryIO): The uploaded zip file.
+            in_use (Iterable[str]): Hashes of staged uploads the caller still uses, which are never deleted.
+        Returns:
+            str: The hash of the upload, to get its files with list_files and file_path.
+        """
+        os.makedirs(self.staging_root, exist_ok=True)
+        upload.seek(0)
+        sha256 = hashlib.sha256()
+        with tempfile.NamedTemporaryFile(dir=self.staging_root, suffix=".zip", delete=False) as zip_file:
+            for chunk in iter(lambda: upload.read(COPY_CHUNK_SIZE), b""):
+                sha256.update(chunk)
+                zip_file.write(chunk)
+        upload.seek(0)
+        upload_hash = sha256.hexdigest()
+        try:
+            if not self.is_staged(upload_hash):
+                self._extract(zip_file.name, self._staging_dir(upload_hash))
+        finally:
+            os.remove(zip_file.name)
+        self._mark_used(upload_hash)
+        self._delete_idle_uploads(keep={upload_hash, *in_use})
+        return upload_hash
+
+    def is_staged(self, upload_hash: str) -> bool:
+        return os.path.exists(os.path.join(self._staging_dir(upload_hash), LISTING_FILE_NAME))
+
+    def list_files(self, upload_hash: str) -> List[str]:
+        """
+        Returns the names of the processable files in a staged upload, as they are named in the zip.
+        """
+        self._mark_used(upload_hash)
+        with open(os.path.join(self._staging_dir(upload_hash), LISTING_FILE_NAME), "r", encoding="utf-8") as listing_file:
+            return json.load(listing_file)
+
+    def file_path(self, upload_hash: str, file_name: str) -> str:
+        """
+        Returns the path of a file of a staged upload, by its name in the zip.
+        """
+        self._mark_used(upload_hash)
+        return os.path.join(self._staging_dir(upload_hash), FILES_DIR_NAME, file_name)
+
+    def _staging_dir(self, upload_hash: str) -> str:
+        return os.path.join(self.staging_root, upload_hash)
+
+    def _extract(self, zip_path: str, staging_dir: str) -> None:
+        # Leftovers of an interrupted extraction are extracted again
+        shutil.rmtree(staging_dir, ignore_errors=True)
+        files_dir = os.path.join(staging_dir, FILES_DIR_NAME)
+        file_names = []
+        with zipfile.ZipFile(zip_path) as zf:
+            for member in zf.infolist():
+                name = member.filename
+                # Names leaving the staging directory, like "../x.pdf", are skipped
+                if member.is_dir() or not self.can_process_file(name) or os.path.isabs(name) \
+                        or os.path.normpath(name).startswith(".."):
+                    continue
+                output_path = os.path.join(files_dir, name)
+                os.makedirs(os.path.dirname(output_path), exist_ok=True)
+                with zf.open(member) as source, open(output_path, "wb") as target:
+                    shutil.copyfileobj(source, target, COPY_CHUNK_SIZE)
+                file_names.append(name)
+        listing_path = os.path.join(staging_dir, LISTING_FILE_NAME)
+        with open(listing_path + ".tmp", "w", encoding="utf-8") as listing_file:
+            json.dump(file_names, listing_file, ensure_ascii=False)
+        os.replace(listing_path + ".tmp", listing_path)
+
+    def _mark_used(self, upload_hash: str) -> None:
+        try:
+            os.utime(self._staging_dir(upload_hash))
+        except FileNotFoundError:
+            pass
+
+    def _delete_idle_uploads(self, keep: Set[str]) -> None:
+        # Uploads used by another session are marked as used on every rerun of its page, so they aren't idle
+        idle_since = time.time() - STAGED_UPLOAD_MAX_IDLE_IN_SECS
+        for upload_hash in os.listdir(self.staging_root):
+            staging_dir = self._staging_dir(upload_hash)
+            if upload_hash in keep or not os.path.isdir(staging_dir):
+                continue
+            try:
+                if os.path.getmtime(staging_dir) < idle_since:
+                    shutil.rmtree(staging_dir, ignore_errors=True)
+            except FileNotFoundError:
+                pass
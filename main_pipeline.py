@@ -1,23 +1,41 @@
+import asyncio
 import glob
+import io
 import os
 import pandas as pd
-import time
+import threading
 
-from categorization.product_categorizer import ProductCategorizer
+from categorization.category_cache import CATEGORY_CACHE_FILE_NAME, CategoryCache, normalize_product_name
+from categorization.local_classifier import LocalCategoryClassifier
+from categorization.product_categorizer import BATCH_SIZE as CATEGORIZATION_BATCH_SIZE, CATEGORIZATION_RETRIES, ProductCategorizer
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+from leaflet_processing.image_preparation import PreparedImage, encode_image, get_preset, prepare_image
 from leaflet_processing.leaflet_reader import LeafletReader
+from leaflet_processing.page_store import list_page_paths, read_page
+from leaflet_processing.region_detector import Box, RegionDetector, merge_region_results
 from natsort import natsorted
+from PIL import Image
+from typing import Callable, Dict, List, Optional, Tuple
 
-from openai_integration.models import Results
+from openai import OpenAI
+from openai_integration.async_openai_client import AsyncOpenAIClient
+from openai_integration.batch_runner import BatchRunner
+from openai_integration.models import ProductCategory, Results
 from openai_integration.openai_client import OpenAIClient
+from result_handling.page_journal import JournaledPage, PageJournal
 from result_handling.result_saver import ResultSaver
-from openai_integration.mock_client import MockLLM
-
-from settings.settings import NUMBER_OF_CHATGPT_VALIDATIONS
+from result_handling.run_database import RUN_DATABASE_FILE_NAME, RunDatabase
+from openai_integration.mock_batch_server import MockBatchServer
+from openai_integration.mock_client import AsyncMockLLM, MockLLM
+from openai_integration.response_cache import ResponseCache
+from pipeline.stage_pipeline import Emit, Stage, StagePipeline
+
+from settings.settings import NUMBER_OF_CHATGPT_VALIDATIONS, MAX_CONCURRENT_PAGES, MAX_CONCURRENT_LEAFLETS, \
+    RESPONSE_CACHE_MAX_SIZE_MB, BYPASS_RESPONSE_CACHE, USE_REGION_CROPPING, VALIDATION_SAMPLES_IN_ONE_REQUEST, \
+    USE_LOCAL_CLASSIFIER, LOCAL_CLASSIFIER_THRESHOLD
 from validation.validation_comparison import compare_validation
 
-import streamlit as st
-
 
 PDF_DIR = "pdf-files"
 API_KEY_PATH = "openai_api_key.txt"
@@ -25,6 +43,26 @@ URL = "https://drive.google.com/drive/folders/1AR2_592V_x4EF97FHv4UPN5zdLTXpVB3"
 DO_DOWNLOAD = False # just used for testing, saves time
 DO_CATEGORIZE = False
 USE_TEST_LLM_CLIENT = True
+RUN_ASYNC = True
+# Renders, extracts and categorizes as overlapping stages, instead of one phase after the other
+RUN_STREAMING = True
+PIPELINE_REPORT_INTERVAL_IN_SECS = 10
+# Lists the pages of a leaflet that failed in the streaming pipeline. Its results are incomplete,
+# so it's processed again in the next run, where the journal skips the pages that succeeded.
+FAILED_PAGES_FILE_NAME = "failed_pages.txt"
+# Sends the region requests of all pages, so that pages extracted at the same time, e.g. by the streaming
+# pipeline, don't each start MAX_CONCURRENT_PAGES threads of their own
+region_executor = ThreadPoolExecutor(max_workers=MAX_CONCURRENT_PAGES, thread_name_prefix="region-extraction")
+# Uses the OpenAI Batch API: slower to finish, but not limited by the per-minute rate limits
+BATCH_MODE = False
+BATCH_DIR = os.path.join(PDF_DIR, ".batches")
+RESPONSE_CACHE_FILE_NAME = "response_cache.sqlite"
+# Continues interrupted leaflets from their page journal instead of calling the LLM again for journaled pages
+RESUME = True
+# Results are saved as Parquet, this also exports the combined results to Excel
+EXPORT_EXCEL = True
+# Gives every supermarket its own sheet in the exported Excel file
+EXCEL_SHEET_PER_SUPERMARKET = True
 
 def load_api_key(api_key_path: str) -> str:
     with open(api_key_path, 'r') as file:
@@ -37,12 +75,42 @@ def append_metadata(df: pd.DataFrame):
     except:
         df['calendar_week'] = datetime.now().isocalendar()[1] # now().isocalendar().week Didn't work for Darya so I changed it in this way
 
+def create_response_cache(results_dir: str) -> ResponseCache:
+    return ResponseCache(
+        os.path.join(results_dir, RESPONSE_CACHE_FILE_NAME),
+        max_size_bytes=RESPONSE_CACHE_MAX_SIZE_MB * 1024 * 1024,
+        bypass=BYPASS_RESPONSE_CACHE,
+    )
+
+def create_result_saver(results_dir: str) -> ResultSaver:
+    run_database = RunDatabase(os.path.join(results_dir, RUN_DATABASE_FILE_NAME))
+    result_saver = ResultSaver(run_database)
+    # Leaflets saved before there was a run database
+    for directory in get_leaflet_directories(results_dir):
+        if not run_database.has_leaflet(os.path.basename(directory)) and result_saver.results_exist(directory):
+            run_database.save_results(os.path.basename(directory), result_saver.load(directory),
+                                      [os.path.basename(image_path) for image_path in get_all_image_paths(directory)])
+    return result_saver
+
+def create_categorizer(results_dir: str) -> ProductCategorizer:
+    category_cache = CategoryCache(os.path.join(results_dir, CATEGORY_CACHE_FILE_NAME))
+    # Trained at every start, so that it learns from the categories of the LLM and the reviewers so far
+    local_classifier = LocalCategoryClassifier.train(category_cache, LOCAL_CLASSIFIER_THRESHOLD) if USE_LOCAL_CLASSIFIER else None
+    return ProductCategorizer(category_cache, local_classifier)
+
 def main():
+    if BATCH_MODE:
+        return main_batch()
+
     api_key = load_api_key(API_KEY_PATH)
     leaflet_reader = LeafletReader(download_url=URL)
-    openai_client = MockLLM() if USE_TEST_LLM_CLIENT else OpenAIClient(api_key=api_key)
-    result_saver = ResultSaver()
-    categorizer = ProductCategorizer()
+    response_cache = create_response_cache(PDF_DIR)
+    if RUN_ASYNC and not RUN_STREAMING:
+        openai_client = AsyncMockLLM() if USE_TEST_LLM_CLIENT else AsyncOpenAIClient(api_key=api_key, response_cache=response_cache)
+    else:
+        openai_client = MockLLM() if USE_TEST_LLM_CLIENT else OpenAIClient(api_key=api_key, response_cache=response_cache)
+    result_saver = create_result_saver(PDF_DIR)
+    categorizer = create_categorizer(PDF_DIR)
 
     if DO_DOWNLOAD:
         leaflet_reader.download_leaflets(PDF_DIR)
@@ -52,90 +120,645 @@ def main():
         print("If you'd like new results, delete or rename the results file and rerun the script.")
         return
 
+    if RUN_STREAMING:
+        run_streaming_pipeline(leaflet_reader, openai_client, categorizer, result_saver)
+        combine_all_results(result_saver)
+        categorizer.print_statistics()
+        return
+
+    convert_all_pdfs(leaflet_reader, result_saver)
+
+    all_directories = get_leaflet_directories(PDF_DIR)
+    if RUN_ASYNC:
+        asyncio.run(process_directories_async(all_directories, openai_client, categorizer, result_saver))
+    else:
+        for directory in all_directories:
+            process_directory(directory, directory, openai_client, categorizer, result_saver)
+
+    combine_all_results(result_saver)
+    categorizer.print_statistics()
+
+
+def main_batch():
+    """
+    Runs the pipeline through the OpenAI Batch API: extraction, validation and categorization
+    are each submitted as batches of requests for all leaflets, and polled until they are done.
+    """
+    leaflet_reader = LeafletReader(download_url=URL)
+    result_saver = create_result_saver(PDF_DIR)
+    categorizer = create_categorizer(PDF_DIR)
+
+    if DO_DOWNLOAD:
+        leaflet_reader.download_leaflets(PDF_DIR)
+
+    if result_saver.results_exist(PDF_DIR):
+        print(f"Already found a results file: [{os.path.join(PDF_DIR, result_saver.output_file_name)}], nothing to do.")
+        return
+
+    convert_all_pdfs(leaflet_reader, result_saver)
+    all_directories = get_leaflet_directories(PDF_DIR)
+
+    if USE_TEST_LLM_CLIENT:
+        with MockBatchServer() as server:
+            batch_runner = BatchRunner(OpenAI(api_key="fake-key", base_url=server.url), BATCH_DIR, poll_interval=0.1)
+            results = process_directories_in_batch(all_directories, batch_runner, categorizer, result_saver)
+    else:
+        batch_runner = BatchRunner(OpenAI(api_key=load_api_key(API_KEY_PATH)), BATCH_DIR)
+        results = process_directories_in_batch(all_directories, batch_runner, categorizer, result_saver)
+
+    failed_directories = [directory for directory, (succeeded, _) in zip(all_directories, results) if not succeeded]
+    if failed_directories:
+        # Combined results would make the next run stop before processing the failed leaflets again
+        print(f"Leaflets {failed_directories} failed, run again to process them. The results aren't combined until then.")
+    else:
+        combine_all_results(result_saver)
+    categorizer.print_statistics()
+
+
+def convert_all_pdfs(leaflet_reader: LeafletReader, result_saver: ResultSaver) -> None:
     for filename in os.listdir(PDF_DIR):
         if filename.endswith(".pdf"):
-            pdf_path = os.path.join(PDF_DIR, filename)
             pdf_name, _ = os.path.splitext(os.path.basename(filename))
-            output_dir = os.path.join(PDF_DIR, pdf_name)
-            if result_saver.results_exist(output_dir):
-                print(f"Already have results for {filename}, skipping...")
-                continue
-            else:
-                print(f"Processing {pdf_path}.")
-                leaflet_reader.convert_pdf_to_images(pdf_path, output_dir)
+            convert_pdf(leaflet_reader, os.path.join(PDF_DIR, filename), os.path.join(PDF_DIR, pdf_name), result_saver)
 
-    all_directories = [entry.path for entry in os.scandir(PDF_DIR) if entry.is_dir()]
-    for directory in all_directories:
-            process_directory(directory, directory, openai_client, categorizer, result_saver)
 
-    combined_results = result_saver.combine_results_from_all_subdirectories(PDF_DIR)
+def convert_pdf(leaflet_reader: LeafletReader, pdf_path: str, output_dir: str, result_saver: ResultSaver) -> None:
+    pdf_name, _ = os.path.splitext(os.path.basename(pdf_path))
+    # Cheap for unchanged PDFs, the page manifest recognizes them without reading them
+    changed_pages = leaflet_reader.update_pages(pdf_path, output_dir, dpi=get_preset(pdf_name).dpi)
+    if changed_pages and result_saver.results_exist(output_dir):
+        # Unchanged pages are answered from the response cache, so only the changed pages cost API calls
+        print(f"Pages {changed_pages} of {os.path.basename(pdf_path)} changed, its results will be extracted again.")
+        result_saver.delete_results(output_dir)
+
+
+def combine_all_results(result_saver: ResultSaver) -> None:
+    if result_saver.run_database is not None:
+        combined_results = result_saver.run_database.results()
+    else:
+        combined_results = result_saver.combine_results_from_all_subdirectories(PDF_DIR)
     combined_results_filename = result_saver.save(combined_results, PDF_DIR)
     print(f"Combined results from all files in {PDF_DIR} saved at: {combined_results_filename}")
+    if EXPORT_EXCEL:
+        excel_file_name = result_saver.export_excel(PDF_DIR, sheet_by="supermarket" if EXCEL_SHEET_PER_SUPERMARKET else None)
+        print(f"Combined results exported to Excel at: {excel_file_name}")
+
+
+def get_leaflet_directories(parent_directory: str) -> List[str]:
+    # Hidden directories hold the pipeline's own working files, e.g. the batch files
+    return [entry.path for entry in os.scandir(parent_directory) if entry.is_dir() and not entry.name.startswith(".")]
 
 
 def get_all_image_paths(directory: str):
-    paths = []
-    for file in os.listdir(directory):
-        if file.lower().endswith(('.png', '.jpg', '.jpeg')):
-            paths.append(os.path.join(directory, file))
-    return natsorted(paths)
+    # Pages of converted PDFs are listed from the leaflet's page store, read them with read_page
+    return list_page_paths(directory)
+
 
+def process_directory(directory: str, output_dir: str, openai_client: OpenAIClient, categorizer: ProductCategorizer, result_saver,
+                      progress: Optional[Callable[[int, int, str], None]] = None):
+    """
+    Extracts, validates and categorizes the products of all pages of a leaflet, one page after the other.
 
-def process_directory(directory: str, output_dir: str, openai_client: OpenAIClient, categorizer: ProductCategorizer, result_saver, displaymood=False):
+    Parameters:
+        progress (Optional[Callable[[int, int, str], None]]): Called after every page with the number of pages
+            done, the number of pages and the page's path, e.g. to report the progress of a job.
+    """
     if result_saver.results_exist(output_dir):
-        if displaymood:
-            st.write(f"Results already exist for {directory}, skipping...")
-        else:
-            print(f"Already have results for {directory}, skipping...")
-        # Construct the path to the CSV file
-        csv_path = os.path.join(directory, "results.csv")
-        # Read the CSV file into a DataFrame
-        csv_df = pd.read_csv(csv_path)
-        return True,csv_df
+        print(f"Already have results for {directory}, skipping...")
+        return True, result_saver.load(directory)
 
     image_paths = get_all_image_paths(directory)
-    all_products = []
-
-    if displaymood:
-        progress_bar = st.progress(0)
-        total_directories = len(image_paths)
+    journal = PageJournal(directory, resume=RESUME)
 
-    all_validation_results = [[] for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)]
     # Call LLMs for all images for one PDF at a time
-    for i,image_path in enumerate(image_paths):
-        with open(image_path, "rb") as image_file:
-            if displaymood:
-                st.write(f"Extracting data from {image_path}")
+    page_results = []
+    for page_index, image_path in enumerate(image_paths):
+        print(f"Extracting data from {image_path}")
+        page_results.append(process_page(directory, image_path, openai_client, journal))
+        if progress is not None:
+            progress(page_index + 1, len(image_paths), image_path)
+
+    extracted_df = build_results_df(page_results)
+    save_extracted_results(extracted_df, directory, output_dir, result_saver)
+
+    if DO_CATEGORIZE:
+        # Categorize products
+        print(f"Categorizing products for {directory}")
+        categorized_df = categorizer.categorize_products(extracted_df, openai_client)
+        save_categorized_results(categorized_df, directory, output_dir, result_saver)
+        return True, categorized_df
+
+    return True, extracted_df
+
+
+async def process_directory_async(directory: str, output_dir: str, openai_client: AsyncOpenAIClient, categorizer: ProductCategorizer, result_saver, page_semaphore: Optional[asyncio.Semaphore] = None,
+                                  progress: Optional[Callable[[int, int, str], None]] = None):
+    """
+    Same as process_directory, but extracts and validates all pages concurrently.
+
+    Parameters:
+        page_semaphore (Optional[asyncio.Semaphore]): Bounds the number of pages processed at once.
+            Share one semaphore between directories to bound the total over a whole batch.
+        progress (Optional[Callable[[int, int, str], None]]): Called after every page, like in process_directory.
+    """
+    if result_saver.results_exist(output_dir):
+        print(f"Already have results for {directory}, skipping...")
+        return True, result_saver.load(directory)
+
+    page_semaphore = page_semaphore or asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+    image_paths = get_all_image_paths(directory)
+    journal = PageJournal(directory, resume=RESUME)
+
+    pages_done = 0
+
+    async def process(image_path: str):
+        nonlocal pages_done
+        page_result = await process_page_async(directory, image_path, openai_client, page_semaphore, journal)
+        pages_done += 1
+        if progress is not None:
+            progress(pages_done, len(image_paths), image_path)
+        return page_result
+
+    # gather keeps the results in page order, no matter in which order the pages finish
+    page_results = await asyncio.gather(*[process(image_path) for image_path in image_paths])
+
+    extracted_df = build_results_df(page_results)
+    save_extracted_results(extracted_df, directory, output_dir, result_saver)
+
+    if DO_CATEGORIZE:
+        print(f"Categorizing products for {directory}")
+        categorized_df = await categorizer.categorize_products_async(extracted_df, openai_client)
+        save_categorized_results(categorized_df, directory, output_dir, result_saver)
+        return True, categorized_df
+
+    return True, extracted_df
+
+
+async def process_directories_async(directories: List[str], openai_client: AsyncOpenAIClient, categorizer: ProductCategorizer, result_saver) -> List[Tuple[bool, pd.DataFrame]]:
+    """
+    Processes several leaflet directories concurrently, writing the results of each into the directory itself.
+    At most MAX_CONCURRENT_LEAFLETS directories and MAX_CONCURRENT_PAGES pages in total are processed at once.
+    """
+    leaflet_semaphore = asyncio.Semaphore(MAX_CONCURRENT_LEAFLETS)
+    page_semaphore = asyncio.Semaphore(MAX_CONCURRENT_PAGES)
+
+    async def process(directory: str):
+        async with leaflet_semaphore:
+            return await process_directory_async(directory, directory, openai_client, categorizer, result_saver, page_semaphore)
+
+    return await asyncio.gather(*[process(directory) for directory in directories])
+
+
+def process_directories_in_batch(directories: List[str], batch_runner: BatchRunner, categorizer: ProductCategorizer, result_saver) -> List[Tuple[bool, pd.DataFrame]]:
+    """
+    Processes the leaflet directories like process_directory, but with one batch of extraction requests for all pages,
+    followed by one batch of validation requests and one batch of categorization requests.
+    Leaflets with a page whose extraction or validation failed aren't saved, so they are processed again in the next run.
+    """
+    results = {}
+    directories_to_process = []
+    for directory in directories:
+        if result_saver.results_exist(directory):
+            print(f"Already have results for {directory}, skipping...")
+            results[directory] = (True, result_saver.load(directory))
+        else:
+            directories_to_process.append(directory)
+
+    pages = [(directory, image_path) for directory in directories_to_process for image_path in get_all_image_paths(directory)]
+
+    # Images are prepared again while the batch file is written, so they are never all in memory at once
+    extractions = batch_runner.run((
+        (f"extract-{page_index}", OpenAIClient.build_extraction_request(prepare_page_image(directory, image_path)))
+        for page_index, (directory, image_path) in enumerate(pages)
+    ), name="extraction")
+    extractions = [extractions[f"extract-{page_index}"] for page_index in range(len(pages))]
+    # Pages whose extraction failed aren't validated, their leaflets aren't saved anyway
+    extracted_pages = [(page_index, page) for page_index, page in enumerate(pages) if extractions[page_index] is not None]
+
+    if VALIDATION_SAMPLES_IN_ONE_REQUEST:
+        # One request per page, asking for all validation samples at once with the `n` parameter
+        sample_results = batch_runner.run((
+            (f"validate-{page_index}", dict(OpenAIClient.build_validation_request(extractions[page_index], prepare_page_image(directory, image_path)),
+                                           n=NUMBER_OF_CHATGPT_VALIDATIONS))
+            for page_index, (directory, image_path) in extracted_pages
+        ), name="validation")
+        validations = {}
+        for page_index, _ in extracted_pages:
+            samples = sample_results[f"validate-{page_index}"]
+            samples = samples if isinstance(samples, list) else [samples] * NUMBER_OF_CHATGPT_VALIDATIONS
+            validations.update({f"validate-{page_index}-{i}": sample for i, sample in enumerate(samples)})
+    else:
+        validations = batch_runner.run((
+            (f"validate-{page_index}-{i}", OpenAIClient.build_validation_request(extractions[page_index], prepare_page_image(directory, image_path)))
+            for page_index, (directory, image_path) in extracted_pages
+            for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)
+        ), name="validation")
+
+    extracted_dfs = {}
+    for directory in directories_to_process:
+        failed_pages = [
+            os.path.basename(image_path) for page_index, (page_directory, image_path) in enumerate(pages)
+            if page_directory == directory and (extractions[page_index] is None or any(
+                validations.get(f"validate-{page_index}-{i}") is None for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)))
+        ]
+        if failed_pages:
+            # An empty or partial results file would make the next runs skip the leaflet
+            print(f"Requests of pages {failed_pages} of {directory} failed, its results aren't saved and it's processed again in the next run.")
+            results[directory] = (False, pd.DataFrame())
+            continue
+        page_results = [
+            (product_dicts(directory, image_path, extractions[page_index]),
+             [validation_dicts(validations[f"validate-{page_index}-{i}"]) for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)])
+            for page_index, (page_directory, image_path) in enumerate(pages) if page_directory == directory
+        ]
+        extracted_dfs[directory] = build_results_df(page_results)
+        save_extracted_results(extracted_dfs[directory], directory, directory, result_saver)
+        results[directory] = (True, extracted_dfs[directory])
+
+    if DO_CATEGORIZE:
+        product_names = {directory: list(df['extracted_product_name']) for directory, df in extracted_dfs.items() if not df.empty}
+        # Names are deduplicated over all leaflets, and only names that aren't in the category cache are sent
+        categories, names_to_send, _ = categorizer.claim_names([name for names in product_names.values() for name in names])
+        keys_to_send = list(names_to_send)
+        results_by_key = {}
+        # Names missing from the responses are sent again in a small follow-up batch, not the whole categorization
+        for attempt in range(1 + CATEGORIZATION_RETRIES):
+            batches = categorizer.make_batches(keys_to_send)
+            categorizations = batch_runner.run((
+                (f"categorize-{batch_index}", OpenAIClient.build_categorization_request([names_to_send[key] for key in batch]))
+                for batch_index, batch in enumerate(batches)
+            ), name=f"categorization_{attempt}" if attempt else "categorization")
+            for batch_index, batch in enumerate(batches):
+                results_by_key.update(categorizer.batch_categories(batch, categorizations[f"categorize-{batch_index}"]))
+            keys_to_send = categorizer.missing_keys(keys_to_send, results_by_key)
+            if not keys_to_send:
+                break
+        categorizer.resolve_names(names_to_send, results_by_key)
+        categories.update(results_by_key)
+
+        for directory, names in product_names.items():
+            product_categories = [categories.get(normalize_product_name(name)) for name in names]
+            categorized_df = categorizer.assign_categories(extracted_dfs[directory], product_categories)
+            save_categorized_results(categorized_df, directory, directory, result_saver)
+            results[directory] = (True, categorized_df)
+
+    return [results[directory] for directory in directories]
+
+
+class LeafletProgress:
+    """
+    Collects the results of one leaflet while its pages go through the streaming pipeline.
+    The leaflet is finished once all of its pages are known and each is either extracted and, if enabled,
+    categorized, or failed.
+    """
+
+    def __init__(self, directory: str):
+        self.directory = directory
+        self.journal = PageJournal(directory, resume=RESUME)
+        self.image_paths: List[str] = []
+        self.all_pages_known = False
+        self.page_results: Dict[str, Tuple[List[dict], List[List[dict]]]] = {}
+        self.categories: Dict[Tuple[str, int], Optional[ProductCategory]] = {}
+        self.pending_categorizations = 0
+        # Error of each failed page, by image path, and of the leaflet if rendering its pages failed
+        self.failed_pages: Dict[str, str] = {}
+        self.error: Optional[str] = None
+        self.finished = False
+        self.lock = threading.Lock()
+
+    def record_failure(self, error: Exception, image_path: Optional[str] = None) -> None:
+        """
+        Records that a page, or the leaflet if no page is given, failed, so that the leaflet can still finish.
+        """
+        with self.lock:
+            if image_path is None:
+                self.error = f"{type(error).__name__}: {error}"
+                self.all_pages_known = True
+            else:
+                self.failed_pages[image_path] = f"{type(error).__name__}: {error}"
+
+    def try_finish(self) -> bool:
+        """
+        Returns True exactly once, when the last result of the leaflet has come in.
+        """
+        with self.lock:
+            if self.finished or not self.all_pages_known \
+                    or len(self.page_results.keys() | self.failed_pages.keys()) < len(self.image_paths) \
+                    or self.pending_categorizations:
+                return False
+            self.finished = True
+            return True
+
+
+def run_streaming_pipeline(leaflet_reader: LeafletReader, openai_client: OpenAIClient, categorizer: ProductCategorizer, result_saver: ResultSaver,
+                           leaflets: Optional[List[Tuple[Optional[str], str]]] = None,
+                           progress: Optional[Callable[[int, int, str], None]] = None) -> List[str]:
+    """
+    Processes leaflets with a StagePipeline of four stages working at the same time:
+    rasterize (PDF pages to images) -> extract (extraction and validation of each page)
+    -> categorize (batches of product names, across pages) -> save (results of each finished leaflet).
+    A page is extracted as soon as it is rendered, and its products are categorized as soon as they are extracted.
+
+    Parameters:
+        leaflets (Optional[List[Tuple[Optional[str], str]]]): The PDF, None for leaflets uploaded as images, and the
+            directory of every leaflet. All leaflets in PDF_DIR if None.
+        progress (Optional[Callable[[int, int, str], None]]): Called after every extracted page with the number of pages
+            of its leaflet done, the number of its pages rendered so far and the page's path, e.g. to report the progress of a job.
+    Returns:
+        List[str]: The directories of the leaflets that failed.
+    """
+    failed_directories = []
+
+    def emit_page(leaflet: LeafletProgress, image_path: str, emit: Emit) -> None:
+        with leaflet.lock:
+            leaflet.image_paths.append(image_path)
+        emit("extract", (leaflet, image_path))
+
+    def rasterize(item: Tuple[Optional[str], str], emit: Emit) -> None:
+        pdf_path, directory = item
+        leaflet = None
+        failed_before = os.path.exists(os.path.join(directory, FAILED_PAGES_FILE_NAME))
+        try:
+            if pdf_path is not None:
+                dpi = get_preset(os.path.basename(directory)).dpi
+                if result_saver.results_exist(directory):
+                    changed_pages = leaflet_reader.update_pages(pdf_path, directory, dpi=dpi)
+                    if not changed_pages and not failed_before:
+                        print(f"Already have results for {directory}, skipping...")
+                        return
+                    print(f"Pages {changed_pages} of {pdf_path} changed or failed before, its results will be extracted again.")
+                    result_saver.delete_results(directory)
+                else:
+                    leaflet = LeafletProgress(directory)
+                    leaflet_reader.update_pages(pdf_path, directory, dpi=dpi, on_page_rendered=lambda _, path: emit_page(leaflet, path, emit))
+            elif result_saver.results_exist(directory) and not failed_before:
+                print(f"Already have results for {directory}, skipping...")
+                return
+
+            leaflet = leaflet or LeafletProgress(directory)
+            # Pages that didn't need to be rendered again
+            for image_path in get_all_image_paths(directory):
+                if image_path not in leaflet.image_paths:
+                    emit_page(leaflet, image_path, emit)
+            with leaflet.lock:
+                leaflet.all_pages_known = True
+        except Exception as e:
+            # The pages rendered so far are still extracted and saved, the leaflet is reported as failed
+            if leaflet is not None:
+                leaflet.record_failure(e)
+                if leaflet.try_finish():
+                    emit("save", leaflet)
+            else:
+                failed_directories.append(directory)
+            raise
+        if leaflet.try_finish():
+            emit("save", leaflet)
+
+    def extract(item: Tuple[LeafletProgress, str], emit: Emit) -> None:
+        leaflet, image_path = item
+        print(f"Extracting data from {image_path}")
+        try:
+            products, validations = process_page(leaflet.directory, image_path, openai_client, leaflet.journal)
+        except Exception as e:
+            leaflet.record_failure(e, image_path)
+            if leaflet.try_finish():
+                emit("save", leaflet)
+            raise
+        with leaflet.lock:
+            leaflet.page_results[image_path] = (products, validations)
+            if DO_CATEGORIZE:
+                leaflet.pending_categorizations += len(products)
+            pages_done, pages_total = len(leaflet.page_results), len(leaflet.image_paths)
+        if progress is not None:
+            progress(pages_done, pages_total, image_path)
+        if DO_CATEGORIZE:
+            for index, product in enumerate(products):
+                emit("categorize", (leaflet, image_path, index, product["product_name"]))
+        if leaflet.try_finish():
+            emit("save", leaflet)
+
+    def categorize(batch: List[Tuple[LeafletProgress, str, int, str]], emit: Emit) -> None:
+        try:
+            categories = categorizer.categorize_names([product_name for *_, product_name in batch], openai_client)
+        except Exception as e:
+            # The products are saved without a category, and their leaflets are processed again in the next run
+            for leaflet, image_path, _, _ in batch:
+                leaflet.record_failure(e, image_path)
+                with leaflet.lock:
+                    leaflet.pending_categorizations -= 1
+                if leaflet.try_finish():
+                    emit("save", leaflet)
+            raise
+        for leaflet, image_path, index, product_name in batch:
+            with leaflet.lock:
+                leaflet.categories[(image_path, index)] = categories.get(normalize_product_name(product_name))
+                leaflet.pending_categorizations -= 1
+            if leaflet.try_finish():
+                emit("save", leaflet)
+
+    def save(leaflet: LeafletProgress, emit: Emit) -> None:
+        failed_pages_path = os.path.join(leaflet.directory, FAILED_PAGES_FILE_NAME)
+        image_paths = natsorted(image_path for image_path in leaflet.image_paths if image_path in leaflet.page_results)
+        if image_paths:
+            extracted_df = build_results_df([leaflet.page_results[image_path] for image_path in image_paths])
+            save_extracted_results(extracted_df, leaflet.directory, leaflet.directory, result_saver)
+            if DO_CATEGORIZE:
+                product_categories = [
+                    leaflet.categories.get((image_path, index))
+                    for image_path in image_paths for index in range(len(leaflet.page_results[image_path][0]))
+                ]
+                categorized_df = categorizer.assign_categories(extracted_df, product_categories)
+                save_categorized_results(categorized_df, leaflet.directory, leaflet.directory, result_saver)
+
+        if leaflet.error is None and not leaflet.failed_pages:
+            if os.path.exists(failed_pages_path):
+                os.remove(failed_pages_path)
+            return
+        with open(failed_pages_path, "w", encoding="utf-8") as failed_pages_file:
+            for image_path, error in natsorted(leaflet.failed_pages.items()):
+                failed_pages_file.write(f"{os.path.basename(image_path)}: {error}\n")
+            if leaflet.error is not None:
+                failed_pages_file.write(f"Rendering the pages: {leaflet.error}\n")
+        failed_directories.append(leaflet.directory)
+        raise RuntimeError(f"Leaflet {leaflet.directory} failed, saved {len(image_paths)} of its {len(leaflet.image_paths)} pages. "
+                           f"Failed pages: {', '.join(os.path.basename(path) for path in natsorted(leaflet.failed_pages)) or 'none'}"
+                           + (f", rendering failed: {leaflet.error}" if leaflet.error else ""))
+
+    if leaflets is None:
+        leaflets = []
+        for filename in natsorted(os.listdir(PDF_DIR)):
+            if filename.endswith(".pdf"):
+                pdf_name, _ = os.path.splitext(filename)
+                leaflets.append((os.path.join(PDF_DIR, filename), os.path.join(PDF_DIR, pdf_name)))
+        # Leaflets uploaded as images have a directory but no PDF
+        pdf_directories = {directory for _, directory in leaflets}
+        leaflets.extend((None, directory) for directory in get_leaflet_directories(PDF_DIR) if directory not in pdf_directories)
+
+    StagePipeline([
+        Stage("rasterize", rasterize, num_workers=MAX_CONCURRENT_LEAFLETS, max_queue_size=MAX_CONCURRENT_LEAFLETS),
+        Stage("extract", extract, num_workers=MAX_CONCURRENT_PAGES, max_queue_size=2 * MAX_CONCURRENT_PAGES),
+        Stage("categorize", categorize, num_workers=MAX_CONCURRENT_PAGES, max_queue_size=2 * MAX_CONCURRENT_PAGES * CATEGORIZATION_BATCH_SIZE,
+              batch_size=CATEGORIZATION_BATCH_SIZE),
+        # Saving stays in one thread, the categorizer and the result files aren't shared between threads
+        Stage("save", save),
+    ], report_interval=PIPELINE_REPORT_INTERVAL_IN_SECS).run(leaflets)
+    return failed_directories
+
+
+def process_page(directory: str, image_path: str, openai_client: OpenAIClient, journal: Optional[PageJournal] = None) -> Tuple[List[dict], List[List[dict]]]:
+    """
+    Extracts the products of one page and validates them NUMBER_OF_CHATGPT_VALIDATIONS times.
+    Every call is recorded in the journal, and calls that are already journaled for this page image are skipped.
+
+    Returns:
+        Tuple[List[dict], List[List[dict]]]: The extracted products and, for each validation, the validated products.
+    """
+    journaled = journal.page(image_path) if journal else None
+    if journaled and journaled.is_complete(NUMBER_OF_CHATGPT_VALIDATIONS):
+        print(f"Resuming {image_path} from the journal")
+        return journaled_results(journaled)
+
+    image = prepare_page_image(directory, image_path)
+    if journaled and journaled.products is not None:
+        products = journaled.products
+    else:
+        regions = None
+        if USE_REGION_CROPPING:
+            crops, boxes = crop_page_regions(directory, image_path)
+            region_responses = list(region_executor.map(openai_client.extract, crops))
+            response, regions = merge_region_results(region_responses, boxes)
+        else:
+            response = openai_client.extract(image)
+        products = product_dicts(directory, image_path, response, regions)
+        if journaled:
+            journaled.record_extraction(products)
+
+    # Validate each extracted product from the response
+    response = Results.model_validate({"all_products": products})
+    missing = missing_validations(journaled)
+    if missing and VALIDATION_SAMPLES_IN_ONE_REQUEST:
+        print(f"Running {NUMBER_OF_CHATGPT_VALIDATIONS} validations in one request")
+        samples = openai_client.validate_product_data_samples(response, image, NUMBER_OF_CHATGPT_VALIDATIONS)
+        validation_responses = {i: samples[i] for i in missing}
+    else:
+        validation_responses = {}
+        for i in missing: # Number of Checkings
+            print(f"Running validation: {i}")
+            validation_responses[i] = openai_client.validate_product_data(response, image, sample_index=i)
+
+    return products, collect_validations(journaled, validation_responses)
+
+
+async def process_page_async(directory: str, image_path: str, openai_client: AsyncOpenAIClient, page_semaphore: asyncio.Semaphore, journal: Optional[PageJournal] = None) -> Tuple[List[dict], List[List[dict]]]:
+    journaled = journal.page(image_path) if journal else None
+    if journaled and journaled.is_complete(NUMBER_OF_CHATGPT_VALIDATIONS):
+        print(f"Resuming {image_path} from the journal")
+        return journaled_results(journaled)
+
+    async with page_semaphore:
+        print(f"Extracting data from {image_path}")
+        image = await asyncio.to_thread(prepare_page_image, directory, image_path)
+        if journaled and journaled.products is not None:
+            products = journaled.products
+        else:
+            regions = None
+            if USE_REGION_CROPPING:
+                crops, boxes = await asyncio.to_thread(crop_page_regions, directory, image_path)
+                region_responses = await asyncio.gather(*[openai_client.extract(crop) for crop in crops])
+                response, regions = merge_region_results(region_responses, boxes)
             else:
-                print(f"Extracting data from {image_path}")
-            response = openai_client.extract(image_file.read())
-            time.sleep(21)
-
-            # Validate each extracted product from the response
-            for i in range(NUMBER_OF_CHATGPT_VALIDATIONS): # Number of Checkings
-                print(f"Running validation: {i}")
-                # Validate the product data
-                image_file.seek(0)  # Reset file pointer to beginning for reuse
-                validation_response = openai_client.validate_product_data(response, image_file.read())
-                time.sleep(21)
-
-                # Append the validation result to the validation_results list
-                if validation_response:
-                    for validation in validation_response.all_products:
-                        validation_as_dict = validation.model_dump()
-                        all_validation_results[i].append(validation_as_dict)
-
-
-            for product in response.all_products:
-                product_as_dict = product.model_dump()
-                # TODO: might need a better way to identify this than just folder
-                # or at least, make sure the folder isn't just "Denner", but has a date or calendar week
-                product_as_dict['folder'] = os.path.basename(directory)
-                product_as_dict['page_number'] = os.path.basename(image_path)
-                all_products.append(product_as_dict)
-
-        if displaymood:
-            progress_bar.progress((i) / total_directories)
+                response = await openai_client.extract(image)
+            products = product_dicts(directory, image_path, response, regions)
+            if journaled:
+                journaled.record_extraction(products)
+
+        response = Results.model_validate({"all_products": products})
+        missing = missing_validations(journaled)
+        if missing and VALIDATION_SAMPLES_IN_ONE_REQUEST:
+            samples = await openai_client.validate_product_data_samples(response, image, NUMBER_OF_CHATGPT_VALIDATIONS)
+            validation_responses = {i: samples[i] for i in missing}
+        else:
+            responses = await asyncio.gather(*[
+                openai_client.validate_product_data(response, image, sample_index=i) for i in missing
+            ])
+            validation_responses = dict(zip(missing, responses))
+
+    return products, collect_validations(journaled, validation_responses)
+
+
+def missing_validations(journaled: Optional[JournaledPage]) -> List[int]:
+    return [i for i in range(NUMBER_OF_CHATGPT_VALIDATIONS) if not journaled or i not in journaled.validations]
+
+
+def collect_validations(journaled: Optional[JournaledPage], validation_responses: Dict[int, Optional[Results]]) -> List[List[dict]]:
+    """
+    Journals the new validation responses, and returns all validations of the page with the journaled ones, in order.
+    """
+    validations = []
+    for i in range(NUMBER_OF_CHATGPT_VALIDATIONS):
+        if i in validation_responses:
+            validations.append(validation_dicts(validation_responses[i]))
+            if journaled:
+                journaled.record_validation(i, validations[i])
+        else:
+            validations.append(journaled.validations[i])
+    return validations
+
+
+def journaled_results(journaled: JournaledPage) -> Tuple[List[dict], List[List[dict]]]:
+    return journaled.products, [journaled.validations[i] for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)]
+
+
+def prepare_page_image(directory: str, image_path: str) -> PreparedImage:
+    """
+    Reads a page image and encodes it for upload with the preset of the leaflet's supermarket.
+    """
+    image = prepare_image(read_page(image_path), get_preset(os.path.basename(directory)))
+    print(f"Prepared {image_path}: {image.num_bytes / 1024:.0f} KB, {image.width}x{image.height}, ~{image.estimated_tokens} image tokens")
+    return image
+
+
+def crop_page_regions(directory: str, image_path: str) -> Tuple[List[PreparedImage], List[Box]]:
+    """
+    Splits a page into its product regions and encodes each crop for upload.
+    """
+    with Image.open(io.BytesIO(read_page(image_path))) as page:
+        boxes = RegionDetector().detect(page)
+        crops = [encode_image(page.crop(box), get_preset(os.path.basename(directory))) for box in boxes]
+    print(f"Found {len(boxes)} product regions on {image_path}")
+    return crops, boxes
+
+
+def product_dicts(directory: str, image_path: str, response: Results, regions: Optional[List[Box]] = None) -> List[dict]:
+    all_products = []
+    for i, product in enumerate(response.all_products):
+        product_as_dict = product.model_dump()
+        # TODO: might need a better way to identify this than just folder
+        # or at least, make sure the folder isn't just "Denner", but has a date or calendar week
+        product_as_dict['folder'] = os.path.basename(directory)
+        product_as_dict['page_number'] = os.path.basename(image_path)
+        if regions is not None:
+            # Crop the product was extracted from, as "left,top,right,bottom" in pixels of the page image
+            product_as_dict['region'] = ",".join(str(coordinate) for coordinate in regions[i])
+        all_products.append(product_as_dict)
+    return all_products
+
+
+def validation_dicts(validation_response: Optional[Results]) -> List[dict]:
+    if not validation_response:
+        return []
+    return [validation.model_dump() for validation in validation_response.all_products]
+
+
+def build_results_df(page_results: List[Tuple[List[dict], List[List[dict]]]]) -> pd.DataFrame:
+    """
+    Builds the DataFrame of extracted and validated products from the results of all pages, in page order.
+    """
+    all_products = [product for products, _ in page_results for product in products]
+    all_validation_results = [
+        [validation for _, validations in page_results for validation in validations[i]]
+        for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)
+    ]
 
     # Create a DataFrame for extracted results
     extracted_df = pd.DataFrame(all_products)
@@ -149,24 +772,22 @@ def process_directory(directory: str, output_dir: str, openai_client: OpenAIClie
         # Combine extracted data with validation data
         extracted_df = pd.concat([extracted_df, validation_df], axis=1)
 
+    return extracted_df
+
+
+def save_extracted_results(extracted_df: pd.DataFrame, directory: str, output_dir: str, result_saver) -> None:
     if NUMBER_OF_CHATGPT_VALIDATIONS > 0:
         compare_validation(extracted_df)
 
-    output_path = result_saver.save(extracted_df, output_dir)
+    output_path = result_saver.save_leaflet(extracted_df, output_dir)
     print(f"Results from {directory} saved at: {output_path}")
 
-    if DO_CATEGORIZE:
-        # Categorize products
-        print(f"Categorizing products for {directory}")
-        categorized_df = categorizer.categorize_products(extracted_df, openai_client)
-        append_metadata(categorized_df)
 
-        # Save categorized products to an Excel file
-        output_path = result_saver.save(categorized_df, output_dir)
-        print(f"Categorized results from {directory} saved at: {output_path}")
-        return True, categorized_df
+def save_categorized_results(categorized_df: pd.DataFrame, directory: str, output_dir: str, result_saver) -> None:
+    append_metadata(categorized_df)
 
-    return True, extracted_df
+    output_path = result_saver.save_leaflet(categorized_df, output_dir)
+    print(f"Categorized results from {directory} saved at: {output_path}")
 
 
 if __name__ == "__main__":
@@ -0,0 +1,128 @@
+# openai_integration/async_openai_client.py
+
+import asyncio
+import logging
+
+from openai import AsyncOpenAI, RateLimitError
+from pydantic import BaseModel
+from tenacity import retry, stop_after_attempt, retry_if_exception_type, before_sleep_log
+from typing import List, Optional, Union
+
+from leaflet_processing.image_preparation import PreparedImage
+
+from .models import Results, CategorizationResult
+from .openai_client import OpenAIClient, NUM_RETRY_ATTEMPTS, estimate_request_tokens
+from .rate_limiter import RateLimiter, get_shared_rate_limiter
+from .response_cache import ResponseCache
+
+logger = logging.getLogger(__name__)
+
+
+class AsyncOpenAIClient:
+    """
+    Asyncio variant of OpenAIClient, built on AsyncOpenAI.
+    It sends exactly the same requests and goes through the same shared rate limiter.
+    """
+
+    def __init__(self, api_key: str, rate_limiter: Optional[RateLimiter] = None, response_cache: Optional[ResponseCache] = None):
+        """
+        Parameters:
+            api_key (str): The OpenAI API key.
+            rate_limiter (Optional[RateLimiter]): Limiter all calls go through, defaults to the process-wide one.
+            response_cache (Optional[ResponseCache]): If given, responses are cached and repeated requests are free.
+        """
+        self.client = AsyncOpenAI(api_key=api_key)
+        self.rate_limiter = rate_limiter or get_shared_rate_limiter()
+        self.response_cache = response_cache
+
+    async def extract(self, image: Union[bytes, PreparedImage]) -> Results:
+        """
+        Extracts product information from an image by encoding it and sending it to the OpenAI API.
+        """
+        return await self._parse(**OpenAIClient.build_extraction_request(OpenAIClient.as_prepared_image(image)))
+
+    async def categorize_products(self, products: List[str], attempt: int = 0) -> CategorizationResult:
+        """
+        Sends prompt to OpenAI to get product categorization for products
+        :param products: product data
+        :param attempt: distinguishes retries of the same products, so a retry isn't answered by the cached response
+        :return: product categorization data, with the id (position starting at 1) of every product
+        """
+        return await self._parse(sample_index=attempt, **OpenAIClient.build_categorization_request(products))
+
+    async def validate_product_data(self, products: Results, image: Union[bytes, PreparedImage], sample_index: int = 0) -> Results:
+        prepared_image = OpenAIClient.as_prepared_image(image)
+        return await self._parse(sample_index=sample_index, **OpenAIClient.build_validation_request(products, prepared_image))
+
+    async def validate_product_data_samples(self, products: Results, image: Union[bytes, PreparedImage], number_of_samples: int) -> List[Optional[Results]]:
+        prepared_image = OpenAIClient.as_prepared_image(image)
+        return await self._parse_samples(number_of_samples, **OpenAIClient.build_validation_request(products, prepared_image))
+
+    async def _parse(self, sample_index: int = 0, **request) -> BaseModel:
+        """
+        Returns the parsed response to a structured output request, from the response cache if possible.
+        """
+        if self.response_cache is None:
+            return await self._send(**request)
+
+        # The cache is SQLite on disk, it is read and written in a thread so the other pages' coroutines keep running
+        cache_key = self.response_cache.make_key(request, sample_index)
+        cached_response = await asyncio.to_thread(self.response_cache.get, cache_key, request["response_format"])
+        if cached_response is not None:
+            return cached_response
+
+        response = await self._send(**request)
+        if response is not None:
+            await asyncio.to_thread(self.response_cache.put, cache_key, response)
+        return response
+
+    async def _parse_samples(self, number_of_samples: int, **request) -> List[Optional[BaseModel]]:
+        """
+        Returns number_of_samples parsed responses, requesting only the ones missing from the response cache.
+        """
+        if self.response_cache is None:
+            return await self._send_samples(number_of_samples, **request)
+
+        cache_keys = [self.response_cache.make_key(request, sample_index) for sample_index in range(number_of_samples)]
+        responses = await asyncio.to_thread(
+            lambda: [self.response_cache.get(cache_key, request["response_format"]) for cache_key in cache_keys]
+        )
+        missing = [sample_index for sample_index, response in enumerate(responses) if response is None]
+        if missing:
+            new_responses = []
+            for sample_index, response in zip(missing, await self._send_samples(len(missing), **request)):
+                responses[sample_index] = response
+                if response is not None:
+                    new_responses.append((cache_keys[sample_index], response))
+            await asyncio.to_thread(lambda: [self.response_cache.put(cache_key, response) for cache_key, response in new_responses])
+        return responses
+
+    async def _send(self, **request) -> BaseModel:
+        """
+        Sends a structured output request through the rate limiter and returns the parsed response.
+        """
+        return (await self._send_samples(1, **request))[0]
+
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
+        before_sleep=before_sleep_log(logger, logging.INFO),
+    )
+    async def _send_samples(self, number_of_samples: int, **request) -> List[Optional[BaseModel]]:
+        """
+        Sends a structured output request asking for number_of_samples choices, and returns all of them parsed.
+        """
+        if number_of_samples > 1:
+            request = dict(request, n=number_of_samples)
+        estimated_tokens = estimate_request_tokens(request["messages"], number_of_samples)
+        await self.rate_limiter.acquire_async(estimated_tokens)
+        try:
+            raw_response = await self.client.beta.chat.completions.with_raw_response.parse(**request)
+        except RateLimitError as e:
+            self.rate_limiter.on_rate_limited(e.response.headers)
+            raise
+
+        response = raw_response.parse()
+        used_tokens = response.usage.total_tokens if response.usage else None
+        self.rate_limiter.on_success(raw_response.headers, estimated_tokens, used_tokens)
+        return [choice.message.parsed for choice in response.choices]
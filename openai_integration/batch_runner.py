@@ -0,0 +1,183 @@
+# openai_integration/batch_runner.py
+
+import json
+import os
+import time
+
+from openai import OpenAI
+from openai.lib._parsing._completions import type_to_response_format_param
+from openai.types import Batch
+from pydantic import BaseModel, ValidationError
+from typing import Dict, Iterable, List, Optional, Tuple, Union
+
+BATCH_ENDPOINT = "/v1/chat/completions"
+COMPLETION_WINDOW = "24h"
+POLL_INTERVAL_IN_SECS = 30
+# The Batch API accepts input files of up to 200 MB and 50'000 requests, stay a bit below that
+MAX_BATCH_FILE_BYTES = 190 * 1024 * 1024
+MAX_REQUESTS_PER_BATCH = 50000
+FINAL_BATCH_STATUSES = {"completed", "failed", "expired", "cancelled"}
+
+
+class BatchRunner:
+    """
+    Runs chat completion requests through the OpenAI Batch API instead of calling the API once per request.
+
+    The requests are the same as the ones OpenAIClient sends, which are serialized into JSONL batch files,
+    submitted, polled until the batches are done, and parsed back into their response_format models.
+    """
+
+    def __init__(self, client: OpenAI, work_dir: str, poll_interval: float = POLL_INTERVAL_IN_SECS):
+        """
+        Parameters:
+            client (OpenAI): The OpenAI client used for the files and batches endpoints.
+            work_dir (str): Directory where the JSONL batch files are written.
+            poll_interval (float): Seconds to wait between checking the status of the batches.
+        """
+        self.client = client
+        self.work_dir = work_dir
+        self.poll_interval = poll_interval
+
+    def run(self, requests: Iterable[Tuple[str, dict]], name: str) -> Dict[str, Union[None, BaseModel, List[Optional[BaseModel]]]]:
+        """
+        Submits all requests, waits until they are processed and returns the parsed responses.
+
+        Parameters:
+            requests (Iterable[Tuple[str, dict]]): Pairs of a unique custom id and the request, as built by OpenAIClient.
+            name (str): Name of the batch, used for the batch file names.
+
+        Returns:
+            Dict[str, Optional[BaseModel]]: The parsed response per custom id, None if the request failed.
+                Requests with `n` > 1 get the list of their parsed samples instead.
+        """
+        response_formats = {}
+        batch_ids = []
+        for batch_file_path, batch_response_formats in self.write_batch_files(requests, name):
+            response_formats.update(batch_response_formats)
+            batch_ids.append(self.submit(batch_file_path))
+
+        results = {custom_id: None for custom_id in response_formats}
+        for batch_id in batch_ids:
+            batch = self.wait(batch_id)
+            results.update(self.fetch_results(batch, response_formats))
+
+        num_failed = sum(result is None for result in results.values())
+        if num_failed:
+            print(f"{num_failed} of {len(results)} requests of batch {name} failed.")
+        return results
+
+    def write_batch_files(self, requests: Iterable[Tuple[str, dict]], name: str) -> List[Tuple[str, Dict[str, type]]]:
+        """
+        Serializes the requests into as many JSONL batch files as needed to stay within the Batch API limits.
+
+        Returns:
+            List[Tuple[str, Dict[str, type]]]: The path of each batch file, with the response_format of each of its requests.
+        """
+        os.makedirs(self.work_dir, exist_ok=True)
+        batch_files = []
+        batch_file = None
+        for custom_id, request in requests:
+            line = json.dumps({
+                "custom_id": custom_id,
+                "method": "POST",
+                "url": BATCH_ENDPOINT,
+                "body": to_batch_body(request),
+            }) + "\n"
+            line_size = len(line.encode("utf-8"))
+
+            if batch_file is None or batch_file.tell() + line_size > MAX_BATCH_FILE_BYTES \
+                    or len(batch_files[-1][1]) >= MAX_REQUESTS_PER_BATCH:
+                if batch_file is not None:
+                    batch_file.close()
+                batch_file_path = os.path.join(self.work_dir, f"{name}_{len(batch_files) + 1}.jsonl")
+                batch_file = open(batch_file_path, "w", encoding="utf-8")
+                batch_files.append((batch_file_path, {}))
+
+            batch_file.write(line)
+            batch_files[-1][1][custom_id] = request["response_format"]
+
+        if batch_file is not None:
+            batch_file.close()
+        return batch_files
+
+    def submit(self, batch_file_path: str) -> str:
+        with open(batch_file_path, "rb") as batch_file:
+            input_file = self.client.files.create(file=batch_file, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint=BATCH_ENDPOINT,
+            completion_window=COMPLETION_WINDOW,
+        )
+        print(f"Submitted {batch_file_path} as batch {batch.id}.")
+        return batch.id
+
+    def wait(self, batch_id: str) -> Batch:
+        """
+        Polls the batch until it is completed, failed, expired or cancelled.
+        """
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status in FINAL_BATCH_STATUSES:
+                print(f"Batch {batch_id} is {batch.status}.")
+                return batch
+            print(f"Batch {batch_id} is {batch.status}, checking again in {self.poll_interval}s.")
+            time.sleep(self.poll_interval)
+
+    def fetch_results(self, batch: Batch, response_formats: Dict[str, type]) -> Dict[str, Union[None, BaseModel, List[Optional[BaseModel]]]]:
+        """
+        Downloads the output and error files of a finished batch and parses every response into its response_format.
+        Requests that failed, whose response can't be parsed or that weren't processed, e.g. because the batch
+        expired or was cancelled, are returned as None.
+        """
+        if batch.status != "completed":
+            print(f"Batch {batch.id} is {batch.status}, its unprocessed requests failed: {batch.errors}")
+        results = {}
+        # Failed requests are in the error file, the output file only has the successful ones
+        for file_id in [batch.output_file_id, batch.error_file_id]:
+            if file_id is None:
+                continue
+            for line in self.client.files.content(file_id).text.splitlines():
+                if not line.strip():
+                    continue
+                try:
+                    output_line = json.loads(line)
+                except json.JSONDecodeError:
+                    print(f"Could not parse a line of file {file_id} of batch {batch.id}: {line[:200]}")
+                    continue
+                custom_id = output_line.get("custom_id")
+                if custom_id in response_formats:
+                    results[custom_id] = self._parse_response(output_line, response_formats[custom_id])
+        return results
+
+    @staticmethod
+    def _parse_response(output_line: dict, response_format: type) -> Union[None, BaseModel, List[Optional[BaseModel]]]:
+        response = output_line.get("response")
+        if output_line.get("error") or not response or response["status_code"] != 200:
+            print(f"Request {output_line['custom_id']} failed: {output_line.get('error') or response}")
+            return None
+        samples = [
+            BatchRunner._parse_content(choice["message"].get("content"), response_format, output_line["custom_id"])
+            for choice in response["body"]["choices"]
+        ]
+        # Requests with n > 1 have one choice per sample
+        return samples[0] if len(samples) == 1 else samples
+
+    @staticmethod
+    def _parse_content(content: Optional[str], response_format: type, custom_id: str) -> Optional[BaseModel]:
+        if content is None:
+            return None
+        try:
+            return response_format.model_validate_json(content)
+        except ValidationError as e:
+            print(f"Could not parse the response to {custom_id}: {e}")
+            return None
+
+
+def to_batch_body(request: dict) -> dict:
+    """
+    Converts a request as built by OpenAIClient into the JSON body of a batch request,
+    turning the pydantic response_format into the json_schema format the API expects.
+    """
+    body = {key: value for key, value in request.items() if key != "response_format"}
+    body["response_format"] = type_to_response_format_param(request["response_format"])
+    return body
@@ -0,0 +1,171 @@
+# openai_integration/mock_batch_server.py
+
+import email.parser
+import email.policy
+import itertools
+import json
+import threading
+import time
+
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from typing import Callable, Dict
+
+from categorization.categorization_user_prompt import CATEGORIZATION_USER_PROMPT
+from .mock_client import MockLLM
+
+# Number of status checks a batch stays "in_progress" before it completes, so polling gets exercised
+POLLS_UNTIL_COMPLETED = 1
+
+
+def mock_batch_response(body: dict) -> str:
+    """
+    Returns the same canned responses as MockLLM, as the JSON content of a chat completion.
+    """
+    if body["response_format"]["json_schema"]["name"] == "CategorizationResult":
+        prompt = body["messages"][-1]["content"]
+        products = [line for line in prompt[len(CATEGORIZATION_USER_PROMPT):].split("\n") if line]
+        return MockLLM._categorization_results(products).model_dump_json()
+    return MockLLM._results().model_dump_json()
+
+
+class MockBatchServer:
+    """
+    Local stand-in for the files and batches endpoints of the OpenAI API, to run the batch mode without an API key.
+    Point an OpenAI client at it with `OpenAI(api_key="fake-key", base_url=server.url)`.
+    """
+
+    def __init__(self, respond: Callable[[dict], str] = mock_batch_response):
+        """
+        Parameters:
+            respond (Callable[[dict], str]): Returns the message content for the body of a chat completion request.
+        """
+        self.respond = respond
+        self.files: Dict[str, dict] = {}
+        self.batches: Dict[str, dict] = {}
+        self._ids = itertools.count(1)
+        self._server = ThreadingHTTPServer(("127.0.0.1", 0), self._handler())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def url(self) -> str:
+        host, port = self._server.server_address
+        return f"http://{host}:{port}/v1"
+
+    def start(self) -> "MockBatchServer":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._server.shutdown()
+        self._server.server_close()
+
+    def __enter__(self) -> "MockBatchServer":
+        return self.start()
+
+    def __exit__(self, *exc_info) -> None:
+        self.stop()
+
+    def _add_file(self, content: bytes, filename: str, purpose: str) -> dict:
+        file_id = f"file-{next(self._ids)}"
+        self.files[file_id] = {
+            "id": file_id, "object": "file", "bytes": len(content), "created_at": int(time.time()),
+            "filename": filename, "purpose": purpose, "status": "processed", "content": content,
+        }
+        return self.files[file_id]
+
+    def _create_batch(self, request: dict) -> dict:
+        batch_id = f"batch-{next(self._ids)}"
+        self.batches[batch_id] = {
+            "id": batch_id, "object": "batch", "endpoint": request["endpoint"],
+            "completion_window": request["completion_window"], "input_file_id": request["input_file_id"],
+            "created_at": int(time.time()), "status": "validating", "polls": 0,
+        }
+        return self.batches[batch_id]
+
+    def _retrieve_batch(self, batch_id: str) -> dict:
+        batch = self.batches[batch_id]
+        batch["polls"] += 1
+        if batch["status"] == "validating":
+            batch["status"] = "in_progress"
+        elif batch["status"] == "in_progress" and batch["polls"] > POLLS_UNTIL_COMPLETED:
+            self._complete_batch(batch)
+        return batch
+
+    def _complete_batch(self, batch: dict) -> None:
+        output_lines = []
+        input_lines = self.files[batch["input_file_id"]]["content"].decode("utf-8").splitlines()
+        for line in input_lines:
+            request = json.loads(line)
+            output_lines.append(json.dumps({
+                "id": f"batch_req-{next(self._ids)}",
+                "custom_id": request["custom_id"],
+                "response": {
+                    "status_code": 200,
+                    "body": {
+                        "object": "chat.completion",
+                        "model": request["body"]["model"],
+                        "choices": [{
+                            "index": index,
+                            "finish_reason": "stop",
+                            "message": {"role": "assistant", "content": self.respond(request["body"])},
+                        } for index in range(request["body"].get("n", 1))],
+                    },
+                },
+                "error": None,
+            }))
+        output_file = self._add_file("\n".join(output_lines).encode("utf-8"), "output.jsonl", "batch_output")
+        batch.update({
+            "status": "completed",
+            "output_file_id": output_file["id"],
+            "completed_at": int(time.time()),
+            "request_counts": {"total": len(input_lines), "completed": len(input_lines), "failed": 0},
+        })
+
+    def _handler(self):
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers["Content-Length"]))
+                if self.path == "/v1/files":
+                    self._send_json(self._public(server._add_file(*self._parse_upload(body))))
+                elif self.path == "/v1/batches":
+                    self._send_json(self._public(server._create_batch(json.loads(body))))
+                else:
+                    self.send_error(404)
+
+            def do_GET(self):
+                parts = self.path.strip("/").split("/")
+                if parts[:2] == ["v1", "batches"] and parts[2] in server.batches:
+                    self._send_json(self._public(server._retrieve_batch(parts[2])))
+                elif parts[:2] == ["v1", "files"] and parts[-1] == "content" and parts[2] in server.files:
+                    self._send(server.files[parts[2]]["content"], "application/octet-stream")
+                else:
+                    self.send_error(404)
+
+            def _parse_upload(self, body: bytes):
+                message = email.parser.BytesParser(policy=email.policy.HTTP).parsebytes(
+                    f"Content-Type: {self.headers['Content-Type']}\r\n\r\n".encode("utf-8") + body
+                )
+                fields = {part.get_param("name", header="content-disposition"): part for part in message.iter_parts()}
+                file_part = fields["file"]
+                return file_part.get_payload(decode=True), file_part.get_filename(), fields["purpose"].get_content().strip()
+
+            @staticmethod
+            def _public(entity: dict) -> dict:
+                return {key: value for key, value in entity.items() if key not in ("content", "polls")}
+
+            def _send_json(self, data: dict):
+                self._send(json.dumps(data).encode("utf-8"), "application/json")
+
+            def _send(self, content: bytes, content_type: str):
+                self.send_response(200)
+                self.send_header("Content-Type", content_type)
+                self.send_header("Content-Length", str(len(content)))
+                self.end_headers()
+                self.wfile.write(content)
+
+            def log_message(self, format, *args):
+                pass
+
+        return Handler
@@ -1,8 +1,9 @@
 from typing import List
-from unittest.mock import MagicMock
+from unittest.mock import AsyncMock, MagicMock
 
+from .async_openai_client import AsyncOpenAIClient
 from .openai_client import OpenAIClient
-from .models import Results, CategorizationResult, GroceryProduct, ProductCategory
+from .models import Results, CategorizationResult, CategorizedProduct, GroceryProduct, ProductCategory
 
 
 class MockLLM:
@@ -11,16 +12,34 @@ class MockLLM:
         self._client.extract = MagicMock(return_value=self._results())
         self._client.validate_product_data = MagicMock(return_value=self._results())
         self._client.validate_product_data = MagicMock(return_value=self._results())
+        self._client.validate_product_data_samples = MagicMock(side_effect=self._validation_samples)
         self._client.categorize_products = MagicMock(side_effect=self._categorization_results)
 
-    def _results(self) -> Results:
+    @staticmethod
+    def _results() -> Results:
         p1 = GroceryProduct(product_name="meat", original_price="1.99", discount_price="1.59", percentage_discount=20, discount_details="pro 100g")
         p2 = GroceryProduct(product_name="cheese", original_price="2.99", discount_price="1.49", percentage_discount=50)
         return Results(all_products=[p1, p2])
 
-    def _categorization_results(self, products: List[str]) -> CategorizationResult:
-        return CategorizationResult(categories=[ProductCategory.MEAT_BEEF for _ in products])
+    @staticmethod
+    def _validation_samples(products: Results, image, number_of_samples: int) -> List[Results]:
+        return [MockLLM._results() for _ in range(number_of_samples)]
+
+    @staticmethod
+    def _categorization_results(products: List[str], attempt: int = 0) -> CategorizationResult:
+        return CategorizationResult(categories=[
+            CategorizedProduct(id=product_id, category=ProductCategory.MEAT_BEEF) for product_id in range(1, len(products) + 1)
+        ])
 
     def __getattr__(self, name):
         # Delegate attribute access to the MagicMock
-        return getattr(self._client, name)
\ No newline at end of file
+        return getattr(self._client, name)
+
+
+class AsyncMockLLM(MockLLM):
+    def __init__(self):
+        self._client = AsyncOpenAIClient("fake-key")
+        self._client.extract = AsyncMock(return_value=self._results())
+        self._client.validate_product_data = AsyncMock(return_value=self._results())
+        self._client.validate_product_data_samples = AsyncMock(side_effect=self._validation_samples)
+        self._client.categorize_products = AsyncMock(side_effect=self._categorization_results)
@@ -53,11 +53,22 @@ class ProductCategory(Enum):
     VEGETABLES = "Grillgemüse"
     NO_GRILL_PRODUCT = "Kein Grillprodukt"
 
+class CategorizedProduct(BaseModel):
+    """
+    Model for the category of one product of a categorization request.
+
+    Attributes:
+        id (int): The id of the product in the request, its position starting at 1.
+        category (ProductCategory): The category of the product.
+    """
+    id: int
+    category: ProductCategory
+
 class CategorizationResult(BaseModel):
     """
     Model for storing the results of the categorization task for all products.
 
     Attributes:
-        all_products (List[CategorizationProduct]): List of products with their categorization.
+        categories (List[CategorizedProduct]): The category of every product, with the id of the product.
     """
-    categories: List[ProductCategory]
\ No newline at end of file
+    categories: List[CategorizedProduct]
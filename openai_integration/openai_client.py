@@ -1,4 +1,3 @@
-import base64
 import logging
 
 import pandas as pd
@@ -9,46 +8,113 @@ from categorization.categorization_user_prompt import CATEGORIZATION_USER_PROMPT
 from validation.validation_system_prompt import VALIDATION_SYSTEM_PROMPT
 from validation.validation_user_prompt import VALIDATION_USER_PROMPT
 from leaflet_processing.constants import OPENAI_PROMPT
+from leaflet_processing.image_preparation import LOW_DETAIL_TOKENS, PreparedImage
 from .models import Results, CategorizationResult
-from tenacity import retry, stop_after_attempt, wait_fixed, retry_if_exception_type, before_sleep_log
-from typing import List
+from .rate_limiter import RateLimiter, get_shared_rate_limiter
+from .response_cache import ResponseCache
+from pydantic import BaseModel
+from tenacity import retry, stop_after_attempt, retry_if_exception_type, before_sleep_log
+from typing import List, Optional, Union
 
 logging.basicConfig(level=logging.INFO)
 logger = logging.getLogger(__name__)
 
 MODEL = "gpt-4o-mini"
 NUM_RETRY_ATTEMPTS = 5
-RETRY_WAIT_IN_SECS = 60 # as current rate limit is 3 requests per minute
+# Rough token estimates used to reserve capacity in the rate limiter before a call is sent
+ESTIMATED_IMAGE_TOKENS = 765
+ESTIMATED_OUTPUT_TOKENS = 1000
+CHARS_PER_TOKEN = 4
+
+
+def estimate_request_tokens(messages: List[dict], number_of_samples: int = 1) -> int:
+    """
+    Estimates the number of tokens a chat completion request will use, including the response(s).
+    The prompt is counted once, even if several samples (`n`) are requested.
+    """
+    tokens = ESTIMATED_OUTPUT_TOKENS * number_of_samples
+    for message in messages:
+        content = message["content"]
+        parts = [{"type": "text", "text": content}] if isinstance(content, str) else content
+        for part in parts:
+            if part["type"] == "text":
+                tokens += len(part["text"]) // CHARS_PER_TOKEN
+            elif part["image_url"].get("detail") == "low":
+                tokens += LOW_DETAIL_TOKENS
+            else:
+                tokens += ESTIMATED_IMAGE_TOKENS
+    return tokens
+
 
 class OpenAIClient:
-    def __init__(self, api_key: str):
+    def __init__(self, api_key: str, rate_limiter: Optional[RateLimiter] = None, response_cache: Optional[ResponseCache] = None):
+        """
+        Parameters:
+            api_key (str): The OpenAI API key.
+            rate_limiter (Optional[RateLimiter]): Limiter all calls go through, defaults to the process-wide one.
+            response_cache (Optional[ResponseCache]): If given, responses are cached and repeated requests are free.
+        """
         self.client = OpenAI(api_key=api_key)
+        self.rate_limiter = rate_limiter or get_shared_rate_limiter()
+        self.response_cache = response_cache
 
-    def extract(self, image_data: bytes) -> Results:
+    def extract(self, image: Union[bytes, PreparedImage]) -> Results:
         """
         Extracts product information from an image by encoding it and sending it to the OpenAI API.
         """
-        encoded_image = self._encode_image(image_data)
-        return self._get_data_from_image(encoded_image)
+        return self._get_data_from_image(self.as_prepared_image(image))
 
-    def _encode_image(self, image_data: bytes) -> str:
+    @staticmethod
+    def as_prepared_image(image: Union[bytes, PreparedImage]) -> PreparedImage:
         """
-        Encodes an image into a base64 string for API transmission.
+        Wraps raw image bytes for API transmission, prepared images are sent as they are.
         """
-        return base64.b64encode(image_data).decode('utf-8')
+        return image if isinstance(image, PreparedImage) else PreparedImage.from_bytes(image)
 
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
-        before_sleep=before_sleep_log(logger, logging.INFO),
-    )
-    def _get_data_from_image(self, base64_image: str) -> Results:
+    def _get_data_from_image(self, image: PreparedImage) -> Results:
         """
-        Sends the base64-encoded image to OpenAI and receives extracted data.
+        Sends the encoded image to OpenAI and receives extracted data.
         Results: Parsed structured data containing product information.
         """
-        response = self.client.beta.chat.completions.parse(
+        return self._parse(**self.build_extraction_request(image))
+
+    def categorize_products(self, products: List[str], attempt: int = 0) -> CategorizationResult:
+        """
+        Sends prompt to OpenAI to get product categorization for products
+        :param products: product data
+        :param attempt: distinguishes retries of the same products, so a retry isn't answered by the cached response
+        :return: product categorization data, with the id (position starting at 1) of every product
+        """
+        return self._parse(sample_index=attempt, **self.build_categorization_request(products))
+
+    def validate_product_data(self, products: Results, image: Union[bytes, PreparedImage], sample_index: int = 0) -> Results:
+        """
+        Asks OpenAI to correct the extracted products by comparing them with the image again.
+        `sample_index` distinguishes repeated validations of the same page, so each one is cached separately.
+        """
+        return self._parse(sample_index=sample_index, **self.build_validation_request(products, self.as_prepared_image(image)))
+
+    def validate_product_data_samples(self, products: Results, image: Union[bytes, PreparedImage], number_of_samples: int) -> List[Optional[Results]]:
+        """
+        Same as calling validate_product_data with sample_index 0 to number_of_samples - 1, but all samples come
+        from a single request with the `n` parameter, so the image is uploaded and its tokens billed only once.
+        Samples are cached like the ones of validate_product_data, so both can be used on the same cache.
+        """
+        return self._parse_samples(number_of_samples, **self.build_validation_request(products, self.as_prepared_image(image)))
+
+    @staticmethod
+    def build_image_content(image: PreparedImage) -> dict:
+        return {
+            "type": "image_url",
+            "image_url": {
+                "url": image.data_url(),
+                "detail": image.detail,
+            },
+        }
+
+    @staticmethod
+    def build_extraction_request(image: PreparedImage) -> dict:
+        return dict(
             model=MODEL,
             messages=[
                 {
@@ -58,35 +124,16 @@ class OpenAIClient:
                             "type": "text",
                             "text": OPENAI_PROMPT,
                         },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{base64_image}"
-                            },
-                        },
+                        OpenAIClient.build_image_content(image),
                     ],
                 }
             ],
             response_format=Results,
         )
 
-        # Extract and parse the response
-        return response.choices[0].message.parsed
-
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
-        before_sleep=before_sleep_log(logger, logging.INFO),
-    )
-    def categorize_products(self, products: List[str]) -> CategorizationResult:
-        """
-        Sends prompt to OpenAI to get product categorization for products
-        :param products: product data
-        :return: product categorization data
-        """
-
-        response = self.client.beta.chat.completions.parse(
+    @staticmethod
+    def build_categorization_request(products: List[str]) -> dict:
+        return dict(
             model=MODEL,
             messages=[
                 {
@@ -95,33 +142,16 @@ class OpenAIClient:
                 },
                 {
                     "role": "user",
-                    "content": self.build_product_categorization_prompt(products)
+                    "content": OpenAIClient.build_product_categorization_prompt(products)
                 }
             ],
             response_format=CategorizationResult,
             temperature=0.5
         )
 
-        # Extract and parse the response
-        return response.choices[0].message.parsed
-
     @staticmethod
-    def build_product_categorization_prompt(products: List[str]) -> str:
-        return CATEGORIZATION_USER_PROMPT + "\n".join(products)
-
-    @staticmethod
-    def build_product_data_validation_prompt(products: Results) -> str:
-        return VALIDATION_USER_PROMPT + "\n" + products.__str__()
-
-    @retry(
-        retry=retry_if_exception_type(RateLimitError),
-        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
-        wait=wait_fixed(RETRY_WAIT_IN_SECS),
-        before_sleep=before_sleep_log(logger, logging.INFO),
-    )
-    def validate_product_data(self, products: Results, image: bytes) -> Results:
-        encoded_image = self._encode_image(image)
-        response = self.client.beta.chat.completions.parse(
+    def build_validation_request(products: Results, image: PreparedImage) -> dict:
+        return dict(
             model=MODEL,
             messages=[
                 {
@@ -133,19 +163,88 @@ class OpenAIClient:
                     "content": [
                         {
                             "type": "text",
-                            "text": self.build_product_data_validation_prompt(products),
-                        },
-                        {
-                            "type": "image_url",
-                            "image_url": {
-                                "url": f"data:image/png;base64,{encoded_image}"
-                            },
+                            "text": OpenAIClient.build_product_data_validation_prompt(products),
                         },
+                        OpenAIClient.build_image_content(image),
                     ],
                 }
             ],
             response_format=Results,
         )
 
-        # Extract and parse the response
-        return response.choices[0].message.parsed
+    @staticmethod
+    def build_product_categorization_prompt(products: List[str]) -> str:
+        # Every product gets its position as id, which the response echoes, so the categories can't get misaligned
+        return CATEGORIZATION_USER_PROMPT + "\n".join(
+            f"{product_id}: {' '.join(str(product).split())}" for product_id, product in enumerate(products, start=1)
+        )
+
+    @staticmethod
+    def build_product_data_validation_prompt(products: Results) -> str:
+        return VALIDATION_USER_PROMPT + "\n" + products.__str__()
+
+    def _parse(self, sample_index: int = 0, **request) -> BaseModel:
+        """
+        Returns the parsed response to a structured output request, from the response cache if possible.
+        """
+        if self.response_cache is None:
+            return self._send(**request)
+
+        cache_key = self.response_cache.make_key(request, sample_index)
+        cached_response = self.response_cache.get(cache_key, request["response_format"])
+        if cached_response is not None:
+            return cached_response
+
+        response = self._send(**request)
+        if response is not None:
+            self.response_cache.put(cache_key, response)
+        return response
+
+    def _parse_samples(self, number_of_samples: int, **request) -> List[Optional[BaseModel]]:
+        """
+        Returns number_of_samples parsed responses to a structured output request. Only the samples
+        missing from the response cache are requested, all of them in one request.
+        """
+        if self.response_cache is None:
+            return self._send_samples(number_of_samples, **request)
+
+        cache_keys = [self.response_cache.make_key(request, sample_index) for sample_index in range(number_of_samples)]
+        responses = [self.response_cache.get(cache_key, request["response_format"]) for cache_key in cache_keys]
+        missing = [sample_index for sample_index, response in enumerate(responses) if response is None]
+        if missing:
+            for sample_index, response in zip(missing, self._send_samples(len(missing), **request)):
+                responses[sample_index] = response
+                if response is not None:
+                    self.response_cache.put(cache_keys[sample_index], response)
+        return responses
+
+    def _send(self, **request) -> BaseModel:
+        """
+        Sends a structured output request through the rate limiter and returns the parsed response.
+        """
+        return self._send_samples(1, **request)[0]
+
+    @retry(
+        retry=retry_if_exception_type(RateLimitError),
+        stop=stop_after_attempt(NUM_RETRY_ATTEMPTS),
+        before_sleep=before_sleep_log(logger, logging.INFO),
+    )
+    def _send_samples(self, number_of_samples: int, **request) -> List[Optional[BaseModel]]:
+        """
+        Sends a structured output request asking for number_of_samples choices, and returns all of them parsed.
+        On a rate limit error the limiter backs off, so the retry waits only as long as needed.
+        """
+        if number_of_samples > 1:
+            request = dict(request, n=number_of_samples)
+        estimated_tokens = estimate_request_tokens(request["messages"], number_of_samples)
+        self.rate_limiter.acquire(estimated_tokens)
+        try:
+            raw_response = self.client.beta.chat.completions.with_raw_response.parse(**request)
+        except RateLimitError as e:
+            self.rate_limiter.on_rate_limited(e.response.headers)
+            raise
+
+        response = raw_response.parse()
+        used_tokens = response.usage.total_tokens if response.usage else None
+        self.rate_limiter.on_success(raw_response.headers, estimated_tokens, used_tokens)
+        return [choice.message.parsed for choice in response.choices]
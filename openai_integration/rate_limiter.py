@@ -0,0 +1,189 @@
+# openai_integration/rate_limiter.py
+
+import asyncio
+import logging
+import re
+import threading
+import time
+
+from typing import Mapping, Optional
+
+from settings.settings import REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE
+
+logger = logging.getLogger(__name__)
+
+MIN_RATE_FACTOR = 0.1
+RATE_DECREASE_FACTOR = 0.5
+RATE_INCREASE_STEP = 0.05
+DEFAULT_BACKOFF_IN_SECS = 5
+
+_DURATION_PART = re.compile(r"(\d+(?:\.\d+)?)(ms|h|m|s)")
+_DURATION_UNITS = {"ms": 0.001, "s": 1, "m": 60, "h": 3600}
+
+
+def parse_reset_duration(value: Optional[str]) -> Optional[float]:
+    """
+    Parses the durations used in the x-ratelimit-reset-* headers, e.g. "20ms", "1s" or "6m0s".
+
+    Returns:
+        Optional[float]: The duration in seconds, or None if the value can't be parsed.
+    """
+    if not value:
+        return None
+    parts = _DURATION_PART.findall(value)
+    if not parts:
+        return None
+    return sum(float(amount) * _DURATION_UNITS[unit] for amount, unit in parts)
+
+
+def _header_float(headers: Mapping[str, str], name: str) -> Optional[float]:
+    try:
+        return float(headers.get(name))
+    except (TypeError, ValueError):
+        return None
+
+
+class RateLimiter:
+    """
+    Token-bucket rate limiter for the OpenAI API, limiting both requests and tokens per minute.
+
+    The rate is adjusted with AIMD (additive increase, multiplicative decrease): every rate limit
+    error halves the rate, every successful call slowly raises it again up to the configured limits.
+    The x-ratelimit-* response headers are used to keep the buckets in sync with the server.
+    The limiter is thread-safe and can be shared by sync and async clients.
+    """
+
+    def __init__(self, requests_per_minute: int, tokens_per_minute: int):
+        """
+        Parameters:
+            requests_per_minute (int): Maximum number of requests per minute of the account tier.
+            tokens_per_minute (int): Maximum number of tokens per minute of the account tier.
+        """
+        self.requests_per_minute = requests_per_minute
+        self.tokens_per_minute = tokens_per_minute
+        self.rate_factor = 1.0
+        self._available_requests = float(requests_per_minute)
+        self._available_tokens = float(tokens_per_minute)
+        self._last_refill = time.monotonic()
+        self._blocked_until = 0.0
+        self._lock = threading.Lock()
+
+    def acquire(self, estimated_tokens: int) -> None:
+        """
+        Blocks until a request using roughly `estimated_tokens` tokens may be sent.
+        """
+        delay = self._reserve(estimated_tokens)
+        # A rate limit error while waiting pushes the caller back, instead of sending into the same limit again
+        while delay > 0:
+            time.sleep(delay)
+            delay = self._remaining_block()
+
+    async def acquire_async(self, estimated_tokens: int) -> None:
+        """
+        Same as `acquire`, but waits without blocking the event loop.
+        """
+        delay = self._reserve(estimated_tokens)
+        while delay > 0:
+            await asyncio.sleep(delay)
+            delay = self._remaining_block()
+
+    def on_success(self, headers: Mapping[str, str], reserved_tokens: int, used_tokens: Optional[int] = None) -> None:
+        """
+        Updates the buckets after a successful call.
+
+        Parameters:
+            headers (Mapping[str, str]): The response headers.
+            reserved_tokens (int): The number of tokens reserved by `acquire` for this call.
+            used_tokens (Optional[int]): The number of tokens the call actually used, if known.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            if used_tokens is not None:
+                self._available_tokens -= used_tokens - reserved_tokens
+            self._sync_with_headers(headers, now)
+            self.rate_factor = min(1.0, self.rate_factor + RATE_INCREASE_STEP)
+
+    def on_rate_limited(self, headers: Optional[Mapping[str, str]] = None) -> None:
+        """
+        Backs off after a rate limit error: halves the rate and pauses until the limit resets.
+        """
+        headers = headers or {}
+        with self._lock:
+            now = time.monotonic()
+            self.rate_factor = max(MIN_RATE_FACTOR, self.rate_factor * RATE_DECREASE_FACTOR)
+            self._available_requests = min(self._available_requests, 0.0)
+            self._available_tokens = min(self._available_tokens, 0.0)
+            backoff = (
+                _header_float(headers, "retry-after")
+                or max(parse_reset_duration(headers.get("x-ratelimit-reset-requests")) or 0,
+                       parse_reset_duration(headers.get("x-ratelimit-reset-tokens")) or 0)
+                or DEFAULT_BACKOFF_IN_SECS
+            )
+            self._blocked_until = max(self._blocked_until, now + backoff)
+            logger.info(f"Rate limited, backing off for {backoff:.1f}s at {self.rate_factor:.0%} of the configured rate.")
+
+    def _reserve(self, estimated_tokens: int) -> float:
+        """
+        Takes a request and the estimated tokens out of the buckets, returning how long the caller has to wait.
+        The buckets may go negative, which queues up callers in the order they reserved.
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._refill(now)
+            self._available_requests -= 1
+            self._available_tokens -= min(estimated_tokens, self.tokens_per_minute)
+            return max(
+                0.0,
+                self._blocked_until - now,
+                -self._available_requests / self._requests_per_second(),
+                -self._available_tokens / self._tokens_per_second(),
+            )
+
+    def _remaining_block(self) -> float:
+        """
+        Returns how long calls are still paused after a rate limit error, 0 if they aren't.
+        """
+        with self._lock:
+            return max(0.0, self._blocked_until - time.monotonic())
+
+    def _refill(self, now: float) -> None:
+        elapsed = now - self._last_refill
+        self._last_refill = now
+        self._available_requests = min(self.requests_per_minute * self.rate_factor,
+                                       self._available_requests + elapsed * self._requests_per_second())
+        self._available_tokens = min(self.tokens_per_minute * self.rate_factor,
+                                     self._available_tokens + elapsed * self._tokens_per_second())
+
+    def _sync_with_headers(self, headers: Mapping[str, str], now: float) -> None:
+        remaining_requests = _header_float(headers, "x-ratelimit-remaining-requests")
+        if remaining_requests is not None:
+            self._available_requests = min(self._available_requests, remaining_requests)
+            if remaining_requests < 1:
+                reset = parse_reset_duration(headers.get("x-ratelimit-reset-requests"))
+                self._blocked_until = max(self._blocked_until, now + (reset or DEFAULT_BACKOFF_IN_SECS))
+
+        remaining_tokens = _header_float(headers, "x-ratelimit-remaining-tokens")
+        if remaining_tokens is not None:
+            self._available_tokens = min(self._available_tokens, remaining_tokens)
+
+    def _requests_per_second(self) -> float:
+        return self.requests_per_minute * self.rate_factor / 60
+
+    def _tokens_per_second(self) -> float:
+        return self.tokens_per_minute * self.rate_factor / 60
+
+
+_shared_rate_limiter: Optional[RateLimiter] = None
+_shared_rate_limiter_lock = threading.Lock()
+
+
+def get_shared_rate_limiter() -> RateLimiter:
+    """
+    Returns the process-wide rate limiter, configured from the settings, that all OpenAI clients go through.
+    """
+    global _shared_rate_limiter
+    with _shared_rate_limiter_lock:
+        if _shared_rate_limiter is None:
+            _shared_rate_limiter = RateLimiter(REQUESTS_PER_MINUTE, TOKENS_PER_MINUTE)
+        return _shared_rate_limiter
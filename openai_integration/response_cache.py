@@ -0,0 +1,108 @@
+# openai_integration/response_cache.py
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from openai.lib._parsing._completions import type_to_response_format_param
+from pydantic import BaseModel
+from typing import Optional, Type
+
+DEFAULT_MAX_SIZE_BYTES = 512 * 1024 * 1024
+
+
+class ResponseCache:
+    """
+    Persistent, content-addressed cache of parsed OpenAI responses, stored in SQLite.
+
+    Entries are keyed on a hash of everything that determines the response: the model, the temperature,
+    the prompts, the images and the response_format schema. When the cache grows beyond its maximum size,
+    the least recently used entries are evicted.
+    """
+
+    def __init__(self, path: str, max_size_bytes: int = DEFAULT_MAX_SIZE_BYTES, bypass: bool = False):
+        """
+        Parameters:
+            path (str): Path to the SQLite file, created if it doesn't exist.
+            max_size_bytes (int): Maximum total size of the cached responses.
+            bypass (bool): If True, cached responses are never returned, but new responses are still stored.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self.max_size_bytes = max_size_bytes
+        self.bypass = bypass
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        with self._connection:
+            self._connection.execute(
+                "CREATE TABLE IF NOT EXISTS responses ("
+                "key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL, last_accessed REAL NOT NULL)"
+            )
+            self._connection.execute("CREATE INDEX IF NOT EXISTS responses_last_accessed ON responses (last_accessed)")
+
+    @staticmethod
+    def make_key(request: dict, sample_index: int = 0) -> str:
+        """
+        Computes the cache key of a chat completion request.
+
+        Parameters:
+            request (dict): The keyword arguments of the request, as built by OpenAIClient.
+            sample_index (int): Distinguishes repeated samples of the same request, e.g. multiple validations.
+        """
+        canonical_request = {
+            key: value for key, value in request.items() if key not in ("messages", "response_format")
+        }
+        canonical_request["messages"] = [ResponseCache._hash_images(message) for message in request["messages"]]
+        canonical_request["response_format"] = type_to_response_format_param(request["response_format"])
+        canonical_request["sample_index"] = sample_index
+        serialized = json.dumps(canonical_request, sort_keys=True, ensure_ascii=False, default=str)
+        return hashlib.sha256(serialized.encode("utf-8")).hexdigest()
+
+    @staticmethod
+    def _hash_images(message: dict) -> dict:
+        if isinstance(message["content"], str):
+            return message
+        content = []
+        for part in message["content"]:
+            if part["type"] == "image_url":
+                image_hash = hashlib.sha256(part["image_url"]["url"].encode("utf-8")).hexdigest()
+                part = {**part, "image_url": {**part["image_url"], "url": image_hash}}
+            content.append(part)
+        return {**message, "content": content}
+
+    def get(self, key: str, response_format: Type[BaseModel]) -> Optional[BaseModel]:
+        if self.bypass:
+            return None
+        with self._lock, self._connection:
+            row = self._connection.execute("SELECT value FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            self._connection.execute("UPDATE responses SET last_accessed = ? WHERE key = ?", (time.time(), key))
+        return response_format.model_validate_json(row[0])
+
+    def put(self, key: str, value: BaseModel) -> None:
+        serialized = value.model_dump_json()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT OR REPLACE INTO responses (key, value, size, last_accessed) VALUES (?, ?, ?, ?)",
+                (key, serialized, len(serialized), time.time()),
+            )
+            self._evict()
+
+    def _evict(self) -> None:
+        """
+        Deletes the least recently used entries until the cache fits into max_size_bytes.
+        """
+        total_size = self._connection.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+        if total_size <= self.max_size_bytes:
+            return
+        rows = self._connection.execute("SELECT key, size FROM responses ORDER BY last_accessed").fetchall()
+        keys_to_delete = []
+        for key, size in rows:
+            if total_size <= self.max_size_bytes:
+                break
+            keys_to_delete.append((key,))
+            total_size -= size
+        self._connection.executemany("DELETE FROM responses WHERE key = ?", keys_to_delete)
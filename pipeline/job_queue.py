@@ -0,0 +1,241 @@
+# pipeline/job_queue.py
+
+import os
+import sqlite3
+import threading
+import time
+
+from pydantic import BaseModel
+from typing import List, Optional
+
+JOB_QUEUE_FILE_NAME = "jobs.sqlite"
+QUEUED = "queued"
+RUNNING = "running"
+DONE = "done"
+FAILED = "failed"
+# Kinds of progress events
+STARTED_EVENT = "started"
+PAGE_EVENT = "page"
+MESSAGE_EVENT = "message"
+DONE_EVENT = "done"
+FAILED_EVENT = "failed"
+# A worker that hasn't sent a heartbeat for this long is considered dead, and its running jobs are queued again
+WORKER_TIMEOUT_IN_SECS = 60
+# Seconds another process may hold the database locked before a query fails
+BUSY_TIMEOUT_IN_SECS = 30
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS jobs (
+    id INTEGER PRIMARY KEY, directory TEXT NOT NULL, pdf_path TEXT, status TEXT NOT NULL, worker_id TEXT,
+    submitted_at REAL NOT NULL, started_at REAL, finished_at REAL, pages_done INTEGER NOT NULL DEFAULT 0,
+    pages_total INTEGER NOT NULL DEFAULT 0, error TEXT);
+CREATE TABLE IF NOT EXISTS job_events (
+    id INTEGER PRIMARY KEY, job_id INTEGER NOT NULL REFERENCES jobs (id) ON DELETE CASCADE, created_at REAL NOT NULL,
+    kind TEXT NOT NULL, message TEXT);
+CREATE TABLE IF NOT EXISTS workers (worker_id TEXT PRIMARY KEY, heartbeat_at REAL NOT NULL);
+CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status);
+CREATE INDEX IF NOT EXISTS job_events_job ON job_events (job_id);
+"""
+
+
+class Job(BaseModel):
+    """
+    A leaflet to be processed by a job worker.
+
+    Attributes:
+        directory (str): The leaflet directory, where its pages are and its results are saved.
+        pdf_path (Optional[str]): The leaflet's PDF, converted to pages first. None if the directory already has its pages.
+        status (str): QUEUED, RUNNING, DONE or FAILED.
+        pages_done (int): Number of pages processed so far.
+        pages_total (int): Number of pages of the leaflet, 0 until they are known.
+    """
+    id: int
+    directory: str
+    pdf_path: Optional[str] = None
+    status: str
+    worker_id: Optional[str] = None
+    submitted_at: float
+    started_at: Optional[float] = None
+    finished_at: Optional[float] = None
+    pages_done: int = 0
+    pages_total: int = 0
+    error: Optional[str] = None
+
+
+class JobEvent(BaseModel):
+    id: int
+    job_id: int
+    created_at: float
+    kind: str
+    message: Optional[str] = None
+
+
+class JobQueue:
+    """
+    Queue of leaflet jobs stored in SQLite, shared by the UI, which submits jobs and polls their progress,
+    and any number of job worker processes, which claim and run them.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path (str): Path to the SQLite file, created if it doesn't exist.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, timeout=BUSY_TIMEOUT_IN_SECS, check_same_thread=False)
+        self._connection.row_factory = sqlite3.Row
+        # Readers don't block the writing workers and the other way round
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        with self._lock, self._connection:
+            self._connection.executescript(SCHEMA)
+
+    def submit(self, directory: str, pdf_path: Optional[str] = None) -> int:
+        """
+        Queues a leaflet, unless it is already queued or running.
+
+        Returns:
+            int: The id of the job processing the leaflet.
+        """
+        with self._lock, self._connection:
+            row = self._connection.execute(
+                "SELECT id FROM jobs WHERE directory = ? AND status IN (?, ?)", (directory, QUEUED, RUNNING)
+            ).fetchone()
+            if row is not None:
+                return row["id"]
+            return self._connection.execute(
+                "INSERT INTO jobs (directory, pdf_path, status, submitted_at) VALUES (?, ?, ?, ?)",
+                (directory, pdf_path, QUEUED, time.time()),
+            ).lastrowid
+
+    def claim(self, worker_id: str) -> Optional[Job]:
+        """
+        Takes the oldest queued job for a worker, None if no job is queued.
+        """
+        while True:
+            with self._lock, self._connection:
+                row = self._connection.execute(
+                    "SELECT id FROM jobs WHERE status = ? ORDER BY id LIMIT 1", (QUEUED,)
+                ).fetchone()
+                if row is None:
+                    return None
+                # Another worker may have claimed the job since it was selected
+                claimed = self._connection.execute(
+                    "UPDATE jobs SET status = ?, worker_id = ?, started_at = ? WHERE id = ? AND status = ?",
+                    (RUNNING, worker_id, time.time(), row["id"], QUEUED),
+                ).rowcount
+            if claimed:
+                self.add_event(row["id"], STARTED_EVENT, f"Started by worker {worker_id}")
+                return self.job(row["id"])
+
+    def add_event(self, job_id: int, kind: str, message: Optional[str] = None) -> None:
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO job_events (job_id, created_at, kind, message) VALUES (?, ?, ?, ?)",
+                (job_id, time.time(), kind, message),
+            )
+
+    def report_page(self, job_id: int, pages_done: int, pages_total: int, page_name: str) -> None:
+        """
+        Records that a page of a job was processed.
+        """
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET pages_done = ?, pages_total = ? WHERE id = ?", (pages_done, pages_total, job_id)
+            )
+            self._connection.execute(
+                "INSERT INTO job_events (job_id, created_at, kind, message) VALUES (?, ?, ?, ?)",
+                (job_id, time.time(), PAGE_EVENT, page_name),
+            )
+
+    def finish(self, job_id: int, message: Optional[str] = None) -> None:
+        self._end(job_id, DONE, DONE_EVENT, message)
+
+    def fail(self, job_id: int, error: str) -> None:
+        self._end(job_id, FAILED, FAILED_EVENT, error)
+
+    def job(self, job_id: int) -> Optional[Job]:
+        with self._lock:
+            row = self._connection.execute("SELECT * FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        return Job(**dict(row)) if row is not None else None
+
+    def jobs(self, job_ids: Optional[List[int]] = None, limit: int = 100) -> List[Job]:
+        """
+        Returns the given jobs, or the most recently submitted ones if job_ids is None, newest first.
+        """
+        with self._lock:
+            if job_ids is None:
+                rows = self._connection.execute("SELECT * FROM jobs ORDER BY id DESC LIMIT ?", (limit,)).fetchall()
+            else:
+                rows = self._connection.execute(
+                    f"SELECT * FROM jobs WHERE id IN ({', '.join('?' * len(job_ids))}) ORDER BY id DESC", job_ids
+                ).fetchall()
+        return [Job(**dict(row)) for row in rows]
+
+    def running_jobs(self) -> List[Job]:
+        with self._lock:
+            rows = self._connection.execute("SELECT * FROM jobs WHERE status = ? ORDER BY id", (RUNNING,)).fetchall()
+        return [Job(**dict(row)) for row in rows]
+
+    def latest_events(self, job_id: int, limit: int = 10) -> List[JobEvent]:
+        """
+        Returns the last events of a job, oldest first.
+        """
+        with self._lock:
+            rows = self._connection.execute(
+                "SELECT * FROM job_events WHERE job_id = ? ORDER BY id DESC LIMIT ?", (job_id, limit)
+            ).fetchall()
+        return [JobEvent(**dict(row)) for row in reversed(rows)]
+
+    def heartbeat(self, worker_id: str) -> None:
+        """
+        Records that a worker is alive, and queues the running jobs of dead workers again.
+        """
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "INSERT INTO workers (worker_id, heartbeat_at) VALUES (?, ?) "
+                "ON CONFLICT (worker_id) DO UPDATE SET heartbeat_at = excluded.heartbeat_at",
+                (worker_id, now),
+            )
+            orphaned = self._connection.execute(
+                "SELECT id FROM jobs WHERE status = ? AND (worker_id IS NULL OR worker_id NOT IN "
+                "(SELECT worker_id FROM workers WHERE heartbeat_at >= ?))",
+                (RUNNING, now - WORKER_TIMEOUT_IN_SECS),
+            ).fetchall()
+            for row in orphaned:
+                # The page journal lets the next worker continue where the dead one stopped
+                self._connection.execute(
+                    "UPDATE jobs SET status = ?, worker_id = NULL WHERE id = ?", (QUEUED, row["id"])
+                )
+                self._connection.execute(
+                    "INSERT INTO job_events (job_id, created_at, kind, message) VALUES (?, ?, ?, ?)",
+                    (row["id"], now, MESSAGE_EVENT, "Worker stopped, queued again"),
+                )
+            self._connection.execute(
+                "DELETE FROM workers WHERE heartbeat_at < ?", (now - WORKER_TIMEOUT_IN_SECS,)
+            )
+
+    def remove_worker(self, worker_id: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM workers WHERE worker_id = ?", (worker_id,))
+
+    def has_live_worker(self) -> bool:
+        with self._lock:
+            row = self._connection.execute(
+                "SELECT 1 FROM workers WHERE heartbeat_at >= ?", (time.time() - WORKER_TIMEOUT_IN_SECS,)
+            ).fetchone()
+        return row is not None
+
+    def _end(self, job_id: int, status: str, kind: str, message: Optional[str]) -> None:
+        now = time.time()
+        with self._lock, self._connection:
+            self._connection.execute(
+                "UPDATE jobs SET status = ?, finished_at = ?, error = ? WHERE id = ?",
+                (status, now, message if status == FAILED else None, job_id),
+            )
+            self._connection.execute(
+                "INSERT INTO job_events (job_id, created_at, kind, message) VALUES (?, ?, ?, ?)",
+                (job_id, now, kind, message),
+            )
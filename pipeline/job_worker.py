@@ -0,0 +1,171 @@
+# pipeline/job_worker.py
+#
+# Runs the leaflet jobs submitted by the UI, outside of Streamlit. Started by the UI when no worker is running,
+# or by hand from the repository root:
+#
+#     python -m pipeline.job_worker
+#
+# The pages are extracted with the OpenAI API; --mock-llm uses the mock client instead, for testing.
+
+import argparse
+import asyncio
+import os
+import socket
+import subprocess
+import sys
+import threading
+import traceback
+
+from typing import Callable, Optional
+
+from .job_queue import JOB_QUEUE_FILE_NAME, MESSAGE_EVENT, WORKER_TIMEOUT_IN_SECS, Job, JobQueue
+
+POLL_INTERVAL_IN_SECS = 2
+HEARTBEAT_INTERVAL_IN_SECS = WORKER_TIMEOUT_IN_SECS / 4
+
+# Runs a job, reporting its progress to the queue
+JobRunner = Callable[[Job, JobQueue], str]
+
+
+class JobWorker:
+    """
+    Claims jobs from a JobQueue and runs up to max_parallel_jobs of them at a time, each in its own thread.
+    Failed jobs are recorded with their error, and don't stop the worker.
+    """
+
+    def __init__(self, job_queue: JobQueue, run_job: JobRunner, max_parallel_jobs: int = 1,
+                 poll_interval: float = POLL_INTERVAL_IN_SECS):
+        """
+        Parameters:
+            job_queue (JobQueue): The queue to take the jobs from.
+            run_job (JobRunner): Runs a job and returns a message describing its result.
+            max_parallel_jobs (int): Number of jobs run at the same time.
+            poll_interval (float): Seconds to wait before looking for jobs again when the queue is empty.
+        """
+        self.job_queue = job_queue
+        self.run_job = run_job
+        self.max_parallel_jobs = max_parallel_jobs
+        self.poll_interval = poll_interval
+        self.worker_id = f"{socket.gethostname()}:{os.getpid()}"
+        self._stop = threading.Event()
+
+    def run(self, stop_when_idle: bool = False) -> None:
+        """
+        Runs jobs until stop is called, or until the queue is empty if stop_when_idle is set.
+        """
+        self.job_queue.heartbeat(self.worker_id)
+        heartbeat_thread = threading.Thread(target=self._send_heartbeats, daemon=True)
+        heartbeat_thread.start()
+        threads = [
+            threading.Thread(target=self._run_jobs, args=(stop_when_idle,), name=f"job-worker-{i}")
+            for i in range(self.max_parallel_jobs)
+        ]
+        for thread in threads:
+            thread.start()
+        try:
+            for thread in threads:
+                # A timeout keeps the main thread responsive to KeyboardInterrupt
+                while thread.is_alive():
+                    thread.join(timeout=1)
+        except KeyboardInterrupt:
+            print("Stopping the job worker after the running jobs...")
+            self.stop()
+            for thread in threads:
+                thread.join()
+        finally:
+            self._stop.set()
+            self.job_queue.remove_worker(self.worker_id)
+
+    def stop(self) -> None:
+        self._stop.set()
+
+    def _run_jobs(self, stop_when_idle: bool) -> None:
+        while not self._stop.is_set():
+            job = self.job_queue.claim(self.worker_id)
+            if job is None:
+                if stop_when_idle:
+                    return
+                self._stop.wait(self.poll_interval)
+                continue
+            print(f"Running job {job.id} for {job.directory}")
+            try:
+                message = self.run_job(job, self.job_queue)
+            except Exception as e:
+                traceback.print_exc()
+                self.job_queue.fail(job.id, f"{type(e).__name__}: {e}")
+            else:
+                self.job_queue.finish(job.id, message)
+
+    def _send_heartbeats(self) -> None:
+        while not self._stop.wait(HEARTBEAT_INTERVAL_IN_SECS):
+            self.job_queue.heartbeat(self.worker_id)
+
+
+def start_worker_process(log_path: Optional[str] = None) -> subprocess.Popen:
+    """
+    Starts a job worker in its own process, which keeps running when the calling process, e.g. Streamlit, reruns or stops.
+    """
+    log_file = open(log_path, "a") if log_path else subprocess.DEVNULL
+    # The worker runs in the same working directory, where PDF_DIR is, and finds the pipeline's modules from there
+    repository_dir = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    python_path = os.pathsep.join(filter(None, [repository_dir, os.environ.get("PYTHONPATH")]))
+    return subprocess.Popen(
+        [sys.executable, "-m", "pipeline.job_worker"], stdout=log_file, stderr=subprocess.STDOUT,
+        start_new_session=True, env={**os.environ, "PYTHONPATH": python_path},
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Runs the leaflet jobs submitted by the UI.")
+    parser.add_argument("--mock-llm", action="store_true", help="Use the mock LLM client instead of the OpenAI API.")
+    args = parser.parse_args()
+
+    # Imported here, so that the UI can start workers without loading the whole pipeline
+    import main_pipeline
+    from settings.settings import API_KEY_PATH, MAX_CONCURRENT_LEAFLETS, PDF_DIR, URL
+
+    job_queue = JobQueue(os.path.join(PDF_DIR, JOB_QUEUE_FILE_NAME))
+    leaflet_reader = main_pipeline.LeafletReader(download_url=URL)
+    api_key = None if args.mock_llm else main_pipeline.load_api_key(API_KEY_PATH)
+    response_cache = None if args.mock_llm else main_pipeline.create_response_cache(PDF_DIR)
+    # Jobs run like main_pipeline.main: streaming, async or one page after the other
+    run_async = main_pipeline.RUN_ASYNC and not main_pipeline.RUN_STREAMING
+    if args.mock_llm:
+        openai_client = main_pipeline.MockLLM()
+    else:
+        openai_client = main_pipeline.OpenAIClient(api_key=api_key, response_cache=response_cache)
+    result_saver = main_pipeline.create_result_saver(PDF_DIR)
+    categorizer = main_pipeline.create_categorizer(PDF_DIR)
+
+    def run_job(job: Job, queue: JobQueue) -> str:
+        def progress(pages_done: int, pages_total: int, image_path: str) -> None:
+            queue.report_page(job.id, pages_done, pages_total, os.path.basename(image_path))
+
+        if main_pipeline.RUN_STREAMING:
+            # The PDF is converted by the pipeline, its pages are extracted while it is converted
+            failed_directories = main_pipeline.run_streaming_pipeline(
+                leaflet_reader, openai_client, categorizer, result_saver, leaflets=[(job.pdf_path, job.directory)], progress=progress,
+            )
+            if failed_directories:
+                raise RuntimeError(f"Pages of {job.directory} failed, see {main_pipeline.FAILED_PAGES_FILE_NAME} in its directory.")
+            return f"{len(result_saver.load(job.directory).index)} products found"
+
+        if job.pdf_path is not None:
+            queue.add_event(job.id, MESSAGE_EVENT, f"Converting {os.path.basename(job.pdf_path)} to images")
+            main_pipeline.convert_pdf(leaflet_reader, job.pdf_path, job.directory, result_saver)
+        if run_async:
+            # An async client per job, every job runs its own event loop in its worker thread
+            async_client = main_pipeline.AsyncMockLLM() if args.mock_llm \
+                else main_pipeline.AsyncOpenAIClient(api_key=api_key, response_cache=response_cache)
+            _, results = asyncio.run(main_pipeline.process_directory_async(
+                job.directory, job.directory, async_client, categorizer, result_saver, progress=progress))
+        else:
+            _, results = main_pipeline.process_directory(
+                job.directory, job.directory, openai_client, categorizer, result_saver, progress=progress)
+        return f"{len(results)} products found"
+
+    JobWorker(job_queue, run_job, max_parallel_jobs=MAX_CONCURRENT_LEAFLETS).run()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,175 @@
+# pipeline/stage_pipeline.py
+
+import queue
+import threading
+import time
+import traceback
+
+from typing import Any, Callable, Dict, Iterable, List, Optional
+
+# Put into a stage's queue once per worker to tell the workers that no more items will come
+_STOP = object()
+
+Emit = Callable[[str, Any], None]
+
+
+class Stage:
+    """
+    One step of a StagePipeline: a pool of worker threads taking items from a bounded queue.
+
+    The stage's function is called with an item (or a list of items, if batch_size is set) and an emit
+    function. emit(stage_name, item) hands an item to a later stage, so a stage can produce any number
+    of items per input, e.g. one item per rendered page of a PDF.
+    """
+
+    def __init__(self, name: str, function: Callable[[Any, Emit], None], num_workers: int = 1, max_queue_size: int = 0,
+                 batch_size: Optional[int] = None, batch_timeout: float = 1.0):
+        """
+        Parameters:
+            name (str): Name of the stage, used to emit items to it and in the progress reports.
+            function (Callable[[Any, Emit], None]): Processes one item, or one batch of items.
+            num_workers (int): Number of threads running the function concurrently.
+            max_queue_size (int): Emitting to a full queue blocks until a worker takes an item from it. 0 means unbounded.
+            batch_size (Optional[int]): If set, the function gets lists of up to batch_size items.
+            batch_timeout (float): Seconds to wait for a batch to fill up before processing a partial batch.
+        """
+        self.name = name
+        self.function = function
+        self.num_workers = num_workers
+        self.batch_size = batch_size
+        self.batch_timeout = batch_timeout
+        self.queue = queue.Queue(maxsize=max_queue_size)
+        # Items waiting in front of the stage; queue.qsize() would also count the stop markers
+        self.queued = 0
+        self.in_progress = 0
+        self.processed = 0
+        self.failed = 0
+        self._counter_lock = threading.Lock()
+
+    def put(self, item: Any) -> None:
+        with self._counter_lock:
+            self.queued += 1
+        self.queue.put(item)
+
+    def next_work(self) -> Optional[List[Any]]:
+        """
+        Waits for the next item (or batch of items) to process. Returns None once the stage is stopped.
+        """
+        item = self.queue.get()
+        if item is _STOP:
+            return None
+        self._taken()
+        if self.batch_size is None:
+            return [item]
+
+        batch = [item]
+        deadline = time.monotonic() + self.batch_timeout
+        while len(batch) < self.batch_size:
+            try:
+                item = self.queue.get(timeout=max(0.0, deadline - time.monotonic()))
+            except queue.Empty:
+                break
+            if item is _STOP:
+                # Leave the stop marker for this worker's next call, after the partial batch is processed
+                self.queue.put(_STOP)
+                break
+            self._taken()
+            batch.append(item)
+        return batch
+
+    def _taken(self) -> None:
+        with self._counter_lock:
+            self.queued -= 1
+
+
+class StagePipeline:
+    """
+    Runs items through a chain of stages that work at the same time, connected by bounded queues.
+
+    Each stage hands its output to later stages as soon as it is produced, so e.g. the first page of a leaflet
+    is extracted while later pages are still rendering. The total time then approaches the time of the slowest
+    stage instead of the sum of all stages. Full queues make fast stages wait for slow ones, which bounds memory use.
+    """
+
+    def __init__(self, stages: List[Stage], report_interval: Optional[float] = None):
+        """
+        Parameters:
+            stages (List[Stage]): The stages, in order. Stages may only emit items to stages after them.
+            report_interval (Optional[float]): If set, prints the progress of all stages every report_interval seconds.
+        """
+        self.stages = stages
+        self.report_interval = report_interval
+        self._stage_index = {stage.name: index for index, stage in enumerate(stages)}
+
+    def run(self, items: Iterable[Any]) -> None:
+        """
+        Feeds the items to the first stage and returns once every stage has processed all of its items.
+        """
+        threads = [
+            [threading.Thread(target=self._work, args=(index,), name=f"{stage.name}-{i}", daemon=True) for i in range(stage.num_workers)]
+            for index, stage in enumerate(self.stages)
+        ]
+        for stage_threads in threads:
+            for thread in stage_threads:
+                thread.start()
+
+        finished = threading.Event()
+        if self.report_interval:
+            threading.Thread(target=self._report, args=(finished,), daemon=True).start()
+
+        try:
+            for item in items:
+                self.stages[0].put(item)
+        finally:
+            # Stages only receive items from earlier stages, so once those are done, a stage can be stopped
+            for stage, stage_threads in zip(self.stages, threads):
+                for _ in stage_threads:
+                    stage.queue.put(_STOP)
+                for thread in stage_threads:
+                    thread.join()
+            finished.set()
+        print(f"Pipeline finished: {self.format_progress()}")
+
+    def queue_depths(self) -> Dict[str, int]:
+        """
+        Returns the number of items waiting in front of each stage.
+        """
+        return {stage.name: stage.queued for stage in self.stages}
+
+    def format_progress(self) -> str:
+        return " | ".join(
+            f"{stage.name}: {stage.queued} queued, {stage.in_progress} running, {stage.processed} done"
+            + (f", {stage.failed} failed" if stage.failed else "")
+            for stage in self.stages
+        )
+
+    def _emitter(self, index: int) -> Emit:
+        def emit(stage_name: str, item: Any) -> None:
+            target = self._stage_index[stage_name]
+            if target <= index:
+                raise ValueError(f"Stage {self.stages[index].name} can't emit to {stage_name}, which isn't after it.")
+            self.stages[target].put(item)
+        return emit
+
+    def _work(self, index: int) -> None:
+        stage = self.stages[index]
+        emit = self._emitter(index)
+        while (work := stage.next_work()) is not None:
+            with stage._counter_lock:
+                stage.in_progress += 1
+            try:
+                stage.function(work if stage.batch_size is not None else work[0], emit)
+                succeeded = True
+            except Exception:
+                # A failing item mustn't stop the worker, or the stages in front of it would block forever
+                print(f"Stage {stage.name} failed to process an item:")
+                traceback.print_exc()
+                succeeded = False
+            with stage._counter_lock:
+                stage.in_progress -= 1
+                stage.processed += len(work) if succeeded else 0
+                stage.failed += 0 if succeeded else len(work)
+
+    def _report(self, finished: threading.Event) -> None:
+        while not finished.wait(self.report_interval):
+            print(f"Pipeline progress: {self.format_progress()}")
@@ -0,0 +1,156 @@
+# result_handling/excel_exporter.py
+
+import re
+
+import pandas as pd
+import pyarrow.parquet as pq
+import xlsxwriter
+
+from typing import Callable, Dict, Iterable, List, Optional
+
+EXPORT_CHUNK_ROWS = 10000
+# Rows of an Excel sheet, including the header
+MAX_SHEET_ROWS = 1048576
+SHEET_NAME = "Results"
+UNKNOWN_SHEET_NAME = "Unbekannt"
+MAX_COLUMN_WIDTH = 40
+PRICE_FORMAT = "0.00"
+CONFIDENCE_FORMAT = "0%"
+DATE_FORMAT = "yyyy-mm-dd"
+
+
+class _Sheet:
+    """
+    A worksheet being written row by row, with the number of its next row.
+    """
+
+    def __init__(self, worksheet, part: int):
+        self.worksheet = worksheet
+        self.part = part
+        self.next_row = 1
+
+    def is_full(self) -> bool:
+        return self.next_row >= MAX_SHEET_ROWS
+
+
+class ExcelExporter:
+    """
+    Exports results to an Excel file by streaming them into the workbook in chunks. xlsxwriter's constant_memory
+    mode writes every row to disk once the next one starts, so memory doesn't grow with the number of rows,
+    unlike DataFrame.to_excel, which builds the whole workbook in memory first.
+
+    Columns keep their type: numbers, prices and confidences are written as formatted numbers,
+    booleans as booleans and dates as dates, so they can be sorted and filtered in Excel.
+    """
+
+    def __init__(self, chunk_rows: int = EXPORT_CHUNK_ROWS):
+        """
+        Parameters:
+            chunk_rows (int): Number of rows read and written at a time.
+        """
+        self.chunk_rows = chunk_rows
+
+    def export_parquet(self, parquet_path: str, excel_path: str, sheet_by: Optional[str] = None) -> str:
+        """
+        Exports a Parquet results file, reading it chunk by chunk.
+
+        Parameters:
+            parquet_path (str): The results file.
+            excel_path (str): Path of the Excel file to write.
+            sheet_by (Optional[str]): A column, e.g. "supermarket", whose values each get their own sheet.
+                All rows go to one sheet if None or if the results don't have the column.
+        Returns:
+            str: The path of the Excel file.
+        """
+        with pq.ParquetFile(parquet_path) as parquet_file:
+            chunks = (batch.to_pandas() for batch in parquet_file.iter_batches(batch_size=self.chunk_rows))
+            return self.export_chunks(chunks, excel_path, sheet_by)
+
+    def export_chunks(self, chunks: Iterable[pd.DataFrame], excel_path: str, sheet_by: Optional[str] = None) -> str:
+        """
+        Same as export_parquet, for results given as DataFrames with the same columns.
+        """
+        workbook = xlsxwriter.Workbook(excel_path, {"constant_memory": True})
+        formats = {
+            "price": workbook.add_format({"num_format": PRICE_FORMAT}),
+            "confidence": workbook.add_format({"num_format": CONFIDENCE_FORMAT}),
+            "date": workbook.add_format({"num_format": DATE_FORMAT}),
+            "header": workbook.add_format({"bold": True}),
+        }
+        # The sheet being written for every sheet_by value, and all sheets
+        sheets: Dict[str, _Sheet] = {}
+        all_sheets: List[_Sheet] = []
+        columns: Optional[List[str]] = None
+        writers: List[Callable] = []
+        try:
+            for chunk in chunks:
+                if columns is None:
+                    columns = [str(column) for column in chunk.columns]
+                    writers = [self._cell_writer(column, chunk[column].dtype, formats) for column in columns]
+                chunk = chunk.set_axis([str(column) for column in chunk.columns], axis=1).reindex(columns=columns)
+
+                if sheet_by is not None and sheet_by in columns:
+                    groups = chunk.groupby(chunk[sheet_by].astype(object).fillna(UNKNOWN_SHEET_NAME).astype(str), sort=False)
+                else:
+                    groups = [(SHEET_NAME, chunk)]
+                for group, rows in groups:
+                    values = [rows[column].tolist() for column in columns]
+                    for row_values in zip(*values):
+                        sheet = sheets.get(group)
+                        if sheet is None or sheet.is_full():
+                            # A full sheet is continued on the next one, e.g. "Coop (2)"
+                            sheet = self._add_sheet(workbook, group, sheet.part + 1 if sheet else 1, columns, formats)
+                            sheets[group] = sheet
+                            all_sheets.append(sheet)
+                        self._write_row(sheet, row_values, writers)
+
+            if not all_sheets:
+                all_sheets.append(self._add_sheet(workbook, SHEET_NAME, 1, columns or [], formats))
+            for sheet in all_sheets:
+                if columns:
+                    sheet.worksheet.autofilter(0, 0, sheet.next_row - 1, len(columns) - 1)
+        finally:
+            workbook.close()
+        return excel_path
+
+    @staticmethod
+    def _write_row(sheet: _Sheet, row_values: tuple, writers: List[Callable]) -> None:
+        worksheet, row = sheet.worksheet, sheet.next_row
+        for column, (value, write) in enumerate(zip(row_values, writers)):
+            # Missing values stay empty cells
+            if value is not None and value is not pd.NA and value is not pd.NaT and value == value:
+                write(worksheet, row, column, value)
+        sheet.next_row += 1
+
+    @staticmethod
+    def _add_sheet(workbook, group: str, part: int, columns: List[str], formats: dict) -> _Sheet:
+        # Excel sheet names are at most 31 characters, without []:*?/\
+        name = re.sub(r"[\[\]:*?/\\]", " ", group).strip() or UNKNOWN_SHEET_NAME
+        name = name[:31] if part == 1 else f"{name[:26]} ({part})"
+        worksheet = workbook.add_worksheet(name)
+        # Column widths must be set before the rows are written in constant_memory mode
+        for column, column_name in enumerate(columns):
+            worksheet.set_column(column, column, min(max(len(column_name) + 2, 10), MAX_COLUMN_WIDTH))
+        worksheet.write_row(0, 0, columns, formats["header"])
+        worksheet.freeze_panes(1, 0)
+        return _Sheet(worksheet, part)
+
+    @staticmethod
+    def _cell_writer(column: str, dtype, formats: dict) -> Callable:
+        """
+        Returns the function writing the values of a column, by the column's dtype and name.
+        """
+        if pd.api.types.is_bool_dtype(dtype):
+            return lambda worksheet, row, column_index, value: worksheet.write_boolean(row, column_index, bool(value))
+        if pd.api.types.is_datetime64_any_dtype(dtype):
+            return lambda worksheet, row, column_index, value: worksheet.write_datetime(
+                row, column_index, value.to_pydatetime(), formats["date"])
+        if pd.api.types.is_numeric_dtype(dtype):
+            if column.endswith("_price"):
+                number_format = formats["price"]
+            elif column.startswith("confidence_") or column == "categorization_confidence":
+                number_format = formats["confidence"]
+            else:
+                number_format = None
+            return lambda worksheet, row, column_index, value: worksheet.write_number(row, column_index, value, number_format)
+        return lambda worksheet, row, column_index, value: worksheet.write_string(row, column_index, str(value))
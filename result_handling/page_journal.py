@@ -0,0 +1,102 @@
+# result_handling/page_journal.py
+
+import hashlib
+import json
+import os
+import threading
+
+from typing import Dict, List, Optional
+
+from leaflet_processing.page_store import read_page
+
+JOURNAL_FILE_NAME = "journal.jsonl"
+
+
+class JournaledPage:
+    """
+    The journaled results of one page, bound to the image they were extracted from.
+
+    Attributes:
+        products (Optional[List[dict]]): The extracted products, None if the extraction isn't journaled yet.
+        validations (Dict[int, List[dict]]): The validated products, by validation index.
+    """
+
+    def __init__(self, journal: "PageJournal", page_name: str, image_sha256: str):
+        self.journal = journal
+        self.page_name = page_name
+        self.image_sha256 = image_sha256
+        self.products: Optional[List[dict]] = None
+        self.validations: Dict[int, List[dict]] = {}
+
+    def is_complete(self, number_of_validations: int) -> bool:
+        return self.products is not None and all(i in self.validations for i in range(number_of_validations))
+
+    def record_extraction(self, products: List[dict]) -> None:
+        self.products = products
+        self.journal.append({"kind": "extraction", "products": products}, self)
+
+    def record_validation(self, index: int, validations: List[dict]) -> None:
+        self.validations[index] = validations
+        self.journal.append({"kind": "validation", "index": index, "products": validations}, self)
+
+
+class PageJournal:
+    """
+    Append-only JSONL journal of the LLM results of a leaflet, written after every extraction and validation call.
+
+    If a run crashes or is interrupted, the next run resumes from the journal: calls that are already
+    journaled aren't sent again. Entries are bound to the hash of the page image, so results of a page
+    image that changed since are ignored.
+    """
+
+    def __init__(self, directory: str, resume: bool = True):
+        """
+        Parameters:
+            directory (str): The leaflet directory, where the journal is stored.
+            resume (bool): If False, the existing journal is discarded and all pages are processed again.
+        """
+        self.path = os.path.join(directory, JOURNAL_FILE_NAME)
+        self._lock = threading.Lock()
+        self._entries: Dict[tuple, List[dict]] = {}
+        if not resume and os.path.exists(self.path):
+            os.remove(self.path)
+        self._load()
+
+    def _load(self) -> None:
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, "r+b") as journal_file:
+            content = journal_file.read()
+            complete_length = content.rfind(b"\n") + 1
+            if complete_length < len(content):
+                # The last line is incomplete if the process was killed while writing it. It's cut off,
+                # otherwise the next entry would be appended to it and be lost as well.
+                journal_file.truncate(complete_length)
+        for line in content[:complete_length].decode("utf-8").splitlines():
+            try:
+                entry = json.loads(line)
+            except json.JSONDecodeError:
+                continue
+            self._entries.setdefault((entry["page"], entry["image_sha256"]), []).append(entry)
+
+    def page(self, image_path: str) -> JournaledPage:
+        """
+        Returns what has been journaled for the page image so far.
+        """
+        image_sha256 = hashlib.sha256(read_page(image_path)).hexdigest()
+        page = JournaledPage(self, os.path.basename(image_path), image_sha256)
+        for entry in self._entries.get((page.page_name, image_sha256), []):
+            if entry["kind"] == "extraction":
+                page.products = entry["products"]
+            else:
+                page.validations[entry["index"]] = entry["products"]
+        return page
+
+    def append(self, entry: dict, page: JournaledPage) -> None:
+        entry = {"page": page.page_name, "image_sha256": page.image_sha256, **entry}
+        with self._lock:
+            with open(self.path, "a", encoding="utf-8") as journal_file:
+                journal_file.write(json.dumps(entry, ensure_ascii=False) + "\n")
+                journal_file.flush()
+                os.fsync(journal_file.fileno())
+            self._entries.setdefault((entry["page"], entry["image_sha256"]), []).append(entry)
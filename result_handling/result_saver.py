@@ -1,36 +1,193 @@
 import glob
+import re
+
+import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 import os
 
+from typing import TYPE_CHECKING, List, Optional
+
+from leaflet_processing.page_store import list_page_paths
+from .excel_exporter import ExcelExporter
+
+if TYPE_CHECKING:
+    from .run_database import RunDatabase
+
+RESULTS_FILE_NAME = "results.parquet"
+EXCEL_FILE_NAME = "results.xlsx"
+# Written by earlier versions, read once to migrate them to Parquet
+LEGACY_CSV_FILE_NAME = "results.csv"
+# The first number of a price like "3.95", "12,50" or "2.-"
+PRICE_PATTERN = re.compile(r"\d+(?:[.,]\d+)?")
+
+
+def parse_price(price) -> float:
+    """
+    Returns the price as a number, NaN if it doesn't contain one.
+    """
+    if isinstance(price, (int, float, np.number)) and not isinstance(price, bool):
+        return float(price)
+    match = PRICE_PATTERN.search(str(price)) if isinstance(price, str) else None
+    return float(match.group().replace(",", ".")) if match else np.nan
+
+
+def with_result_dtypes(data: pd.DataFrame) -> pd.DataFrame:
+    """
+    Returns the results with a dtype for every column Parquet can store and filter on: the final prices, discounts,
+    confidences and votes as numbers, the calendar week as integer and the collection date as date.
+    Extracted and validated prices stay as the LLM returned them, e.g. "2.-", so nothing gets lost.
+    """
+    data = data.copy()
+    for column in data.columns:
+        column_name = str(column)
+        if column_name in ("final_original_price", "final_discount_price"):
+            data[column] = data[column].map(parse_price).astype("float64")
+        elif column_name.endswith("percentage_discount") or column_name.startswith("confidence_") \
+                or column_name == "categorization_confidence":
+            data[column] = pd.to_numeric(data[column], errors="coerce").astype("float64")
+        elif column_name.startswith("votes_"):
+            data[column] = pd.to_numeric(data[column], errors="coerce").astype("Int64")
+        elif column_name == "calendar_week":
+            data[column] = pd.to_numeric(data[column], errors="coerce").astype("Int16")
+        elif column_name == "categorization_all_same":
+            data[column] = data[column].astype("boolean")
+        elif column_name == "date_collected":
+            data[column] = pd.to_datetime(data[column], errors="coerce")
+        elif data[column].dtype == object:
+            # Strings, with the missing values stored as nulls
+            data[column] = data[column].map(lambda value: value if pd.isna(value) or isinstance(value, str) else str(value))
+    return data
+
+
 class ResultSaver:
-    def __init__(self):
-        self.output_file_name = "results.xlsx"
-        pass
+    """
+    Saves the results of every leaflet, and the combined results, as Parquet files. Excel files are only
+    exported on request, since writing and reading them is by far the slowest part of handling the results.
+    """
+
+    def __init__(self, run_database: Optional["RunDatabase"] = None):
+        """
+        Parameters:
+            run_database (Optional[RunDatabase]): If given, the results of every leaflet are also written there.
+        """
+        self.output_file_name = RESULTS_FILE_NAME
+        self.run_database = run_database
 
     def results_exist(self, output_dir: str) -> bool:
+        self._migrate_legacy_results(output_dir)
         results_path = os.path.join(output_dir, self.output_file_name)
         return os.path.exists(results_path) and os.path.getsize(results_path) > 0
 
+    def delete_results(self, output_dir: str) -> None:
+        for file_name in [self.output_file_name, EXCEL_FILE_NAME, LEGACY_CSV_FILE_NAME]:
+            results_path = os.path.join(output_dir, file_name)
+            if os.path.exists(results_path):
+                os.remove(results_path)
+        if self.run_database is not None:
+            self.run_database.delete_leaflet(os.path.basename(os.path.normpath(output_dir)))
+
     def save(self, categorized_df: pd.DataFrame, output_dir: str) -> str:
         """
-        Saves a pandas df to an Excel file.
+        Saves a pandas df to a Parquet file.
 
         Parameters:
             categorized_df (pd.DataFrame): The pandas df.
         Returns:
-            str: File path to the saved Excel file.
+            str: File path to the saved Parquet file.
+        """
+        os.makedirs(output_dir, exist_ok=True)
+        results_path = os.path.join(output_dir, self.output_file_name)
+        temporary_path = results_path + ".tmp"
+        with_result_dtypes(categorized_df).to_parquet(temporary_path, index=False)
+        # Readers never see a half written file
+        os.replace(temporary_path, results_path)
+        return results_path
+
+    def save_leaflet(self, leaflet_df: pd.DataFrame, output_dir: str) -> str:
+        """
+        Saves the results of a leaflet, to a Parquet file in its folder and to the run database.
+        The corrections of the reviewers made to earlier results of the leaflet are applied to both.
+
+        Returns:
+            str: File path to the saved Parquet file.
         """
         os.makedirs(output_dir, exist_ok=True)
+        if self.run_database is not None:
+            # Imported here, the run database module imports this one
+            from .run_database import apply_leaflet_edits
+
+            folder = os.path.basename(os.path.normpath(output_dir))
+            page_names = [os.path.basename(image_path) for image_path in list_page_paths(output_dir)]
+            self.run_database.save_results(folder, leaflet_df, page_names)
+            leaflet_df = apply_leaflet_edits(leaflet_df, self.run_database.leaflet_edits(folder))
+        return self.save(leaflet_df, output_dir)
+
+    def load(self, output_dir: str, columns: Optional[List[str]] = None, filters=None) -> pd.DataFrame:
+        """
+        Loads the results saved in a directory.
 
-        # Define the file name with a timestamp
-        excel_file_path = os.path.join(output_dir, self.output_file_name)
-        categorized_df.to_excel(excel_file_path, index=False)
+        Parameters:
+            output_dir (str): The directory of the results.
+            columns (Optional[List[str]]): Only these columns are read, all if None.
+            filters: Only rows matching these are read, e.g. [("final_category", "==", "Käse")], see pyarrow.parquet.read_table.
+        Returns:
+            pd.DataFrame: The results.
+        """
+        self._migrate_legacy_results(output_dir)
+        return pq.read_table(os.path.join(output_dir, self.output_file_name), columns=columns, filters=filters).to_pandas()
 
-        # Note that this is really just for debugging - I think eventually we can use only Excel
-        csv_file_path = os.path.join(output_dir, "results.csv")
-        categorized_df.to_csv(csv_file_path, index=False)
-        return excel_file_path
+    def export_excel(self, output_dir: str, sheet_by: Optional[str] = None) -> str:
+        """
+        Exports the results saved in a directory to an Excel file next to them, streamed chunk by chunk.
 
-    def combine_results_from_all_subdirectories(self, parent_directory: str) -> pd.DataFrame:
-        all_results_files = glob.glob(f"{parent_directory}/**/{self.output_file_name}", recursive=True)
-        return pd.concat([pd.read_excel(file) for file in all_results_files], ignore_index=True)
+        Parameters:
+            output_dir (str): The directory of the results.
+            sheet_by (Optional[str]): A column, e.g. "supermarket", whose values each get their own sheet.
+        Returns:
+            str: File path to the Excel file.
+        """
+        self._migrate_legacy_results(output_dir)
+        return ExcelExporter().export_parquet(
+            os.path.join(output_dir, self.output_file_name), os.path.join(output_dir, EXCEL_FILE_NAME), sheet_by
+        )
+
+    def combine_results_from_all_subdirectories(self, parent_directory: str, columns: Optional[List[str]] = None, filters=None) -> pd.DataFrame:
+        """
+        Combines the results of all leaflets below parent_directory, reading only the given columns and rows.
+        Leaflets with columns the others don't have, e.g. votes for a category only they got, get nulls there.
+        """
+        for legacy_results_path in glob.glob(f"{parent_directory}/**/{LEGACY_CSV_FILE_NAME}", recursive=True):
+            self._migrate_legacy_results(os.path.dirname(legacy_results_path))
+        # The combined results of parent_directory itself aren't combined again
+        all_results_files = [
+            file for file in glob.glob(f"{parent_directory}/**/{self.output_file_name}", recursive=True)
+            if os.path.dirname(os.path.abspath(file)) != os.path.abspath(parent_directory)
+        ]
+        filter_expression = pq.filters_to_expression(filters) if filters is not None else None
+        tables = []
+        for file in all_results_files:
+            # Reading the small per leaflet files directly is a lot faster than through pq.read_table's datasets
+            with pq.ParquetFile(file) as parquet_file:
+                file_columns = [column for column in columns if column in parquet_file.schema_arrow.names] if columns is not None else None
+                # The filter may need columns that aren't returned
+                table = parquet_file.read(columns=file_columns if filter_expression is None else None, use_threads=False)
+            if filter_expression is not None:
+                table = table.filter(filter_expression)
+                if file_columns is not None:
+                    table = table.select(file_columns)
+            tables.append(table)
+        if not tables:
+            return pd.DataFrame(columns=columns)
+        return pa.concat_tables(tables, promote_options="permissive").to_pandas()
+
+    def _migrate_legacy_results(self, output_dir: str) -> None:
+        """
+        Converts the CSV results of earlier versions to Parquet, so their leaflets aren't processed again.
+        """
+        legacy_results_path = os.path.join(output_dir, LEGACY_CSV_FILE_NAME)
+        if os.path.exists(legacy_results_path) and os.path.getsize(legacy_results_path) > 0 \
+                and not os.path.exists(os.path.join(output_dir, self.output_file_name)):
+            self.save(pd.read_csv(legacy_results_path), output_dir)
+            os.remove(legacy_results_path)
@@ -0,0 +1,151 @@
+# result_handling/results_cache.py
+
+import os
+import threading
+
+import pandas as pd
+from typing import TYPE_CHECKING, Callable, Dict, List, Optional, Set, Tuple
+
+from .result_saver import ResultSaver
+from .run_database import RunDatabase, apply_edits
+
+if TYPE_CHECKING:
+    from pipeline.job_queue import JobQueue
+
+COMPACTION_INTERVAL_IN_SECS = 30
+# Times a results file is written again when the results were saved by the pipeline meanwhile
+SAVE_ATTEMPTS = 3
+
+
+class ResultsCache:
+    """
+    Keeps the results of all leaflets in memory for the review pages, with an index of their pages.
+
+    The results are loaded again only when the results of a leaflet were saved or deleted since, otherwise
+    only the edits made since the last call are applied, so getting the results on every rerun of a page is cheap.
+    The returned DataFrame is shared, it must not be changed by the caller; changes go through RunDatabase.record_edits.
+    """
+
+    def __init__(self, run_database: RunDatabase):
+        self.run_database = run_database
+        self._lock = threading.Lock()
+        self._version: Optional[Tuple] = None
+        self._last_edit_id = 0
+        self._data = pd.DataFrame()
+        self._rows_by_page: Dict[Tuple[str, str], pd.Index] = {}
+
+    def results(self) -> pd.DataFrame:
+        """
+        Returns the current results, with all edits applied.
+        """
+        with self._lock:
+            version = self.run_database.results_version()
+            if version != self._version:
+                # Edits made while loading are applied again below, applying an edit twice doesn't matter
+                self._last_edit_id = self.run_database.last_edit_id()
+                self._data = self.run_database.results()
+                self._rows_by_page = self._data.groupby(["extracted_folder", "extracted_page_number"], sort=False).indices
+                self._version = version
+            edits = self.run_database.edits_after(self._last_edit_id)
+            if edits:
+                apply_edits(self._data, edits)
+                self._last_edit_id = edits[-1][0]
+            return self._data
+
+    def pages(self) -> List[Tuple[str, str]]:
+        """
+        Returns the folder and page name of every page with results, in the order of the results.
+        """
+        self.results()
+        return list(self._rows_by_page)
+
+    def page_results(self, folder: str, page_name: str) -> pd.DataFrame:
+        """
+        Returns the results of one page, as a copy that can be changed.
+        """
+        data = self.results()
+        rows = self._rows_by_page.get((folder, page_name))
+        return data.iloc[rows].copy() if rows is not None else data.iloc[0:0].copy()
+
+
+class EditCompactor:
+    """
+    Applies the edits of the reviewers to the run database in a background thread, and then writes the
+    results of the edited leaflets and the combined results again from the run database, so saving an edit
+    never waits for the results to be rewritten.
+
+    Leaflets that a job worker is processing are written by the worker, with the edits applied, and are left alone
+    until their job has finished; so are the combined results while any job is running.
+    """
+
+    def __init__(self, run_database: RunDatabase, result_saver: ResultSaver, results_dir: str,
+                 job_queue: Optional["JobQueue"] = None, interval: float = COMPACTION_INTERVAL_IN_SECS):
+        """
+        Parameters:
+            run_database (RunDatabase): The database with the edit log.
+            result_saver (ResultSaver): Saves the combined results.
+            results_dir (str): Where the combined results are saved, with the leaflet folders in it.
+            job_queue (Optional[JobQueue]): The queue of the job workers writing results to results_dir.
+            interval (float): Seconds between compactions.
+        """
+        self.run_database = run_database
+        self.result_saver = result_saver
+        self.results_dir = results_dir
+        self.job_queue = job_queue
+        self.interval = interval
+        # Written at the next compaction when they couldn't be written yet
+        self._folders_to_save: Set[str] = set()
+        self._combined_results_outdated = False
+        self._stop = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="edit-compactor", daemon=True)
+
+    def start(self) -> "EditCompactor":
+        self._thread.start()
+        return self
+
+    def stop(self) -> None:
+        self._stop.set()
+        self._thread.join()
+        # Edits made since the last compaction aren't left behind
+        self.compact()
+
+    def compact(self) -> int:
+        """
+        Compacts the pending edits now. Returns the number of edits applied.
+        """
+        edits_by_folder = self.run_database.compact_edits()
+        num_edits = sum(edits_by_folder.values())
+        self._folders_to_save.update(edits_by_folder)
+        self._combined_results_outdated |= num_edits > 0
+
+        running_jobs = self.job_queue.running_jobs() if self.job_queue is not None else []
+        running_folders = {os.path.basename(os.path.normpath(job.directory)) for job in running_jobs}
+        for folder in sorted(self._folders_to_save - running_folders):
+            leaflet_dir = os.path.join(self.results_dir, folder)
+            if self.result_saver.results_exist(leaflet_dir):
+                self._save(lambda: self.run_database.leaflet_results(folder), leaflet_dir)
+            self._folders_to_save.discard(folder)
+        if self._combined_results_outdated and not running_jobs:
+            self._save(self.run_database.results, self.results_dir)
+            self._combined_results_outdated = False
+            print(f"Results with the edits saved in {self.results_dir}")
+        if num_edits:
+            print(f"Applied {num_edits} edits to {len(edits_by_folder)} leaflets")
+        return num_edits
+
+    def _save(self, load_results: Callable[[], pd.DataFrame], output_dir: str) -> None:
+        # Written again if results were saved meanwhile, e.g. by the pipeline in another process,
+        # so the newer results aren't replaced by the ones loaded before
+        for _ in range(SAVE_ATTEMPTS):
+            version = self.run_database.results_version()
+            self.result_saver.save(load_results(), output_dir)
+            if self.run_database.results_version() == version:
+                return
+
+    def _run(self) -> None:
+        while not self._stop.wait(self.interval):
+            try:
+                self.compact()
+            except Exception as e:
+                # Tried again at the next interval, the edits stay in the log until then
+                print(f"Compacting the edits failed: {e}")
@@ -0,0 +1,496 @@
+# result_handling/run_database.py
+
+import datetime
+import os
+import re
+import sqlite3
+import threading
+import time
+
+import pandas as pd
+from typing import Dict, Iterable, List, Optional, Tuple
+
+from openai_integration.models import GroceryProduct
+from settings.settings import NUMBER_OF_CHATGPT_VALIDATIONS
+from .result_saver import with_result_dtypes
+
+RUN_DATABASE_FILE_NAME = "runs.sqlite"
+SUPERMARKETS = ["Aldi", "Coop", "Denner", "Lidl", "Migros", "Volg", "Spar", "Manor", "Aligro", "Otto's"]
+PRODUCT_FIELDS = list(GroceryProduct.model_fields)
+CONSENSUS_FIELDS = ["product_name", "original_price", "discount_price", "percentage_discount"]
+# Week in folder names like "Coop Zeitung KW 18", "LIDL-AKTUELL-KW17-27-4-3-5-06", "COOP AM_AKMA_W19_2023_DE",
+# "Woche 17 Coop Zeitung" or "Migros-Magazin-17-2023-d-ZH", and dates like "COOP AM_20230502_ZZ"
+WEEK_PATTERNS = [
+    re.compile(r"KW[\s_-]*(\d{1,2})(?!\d)", re.IGNORECASE),
+    re.compile(r"(?<![A-Za-z])W(?:oche)?[\s_-]*(\d{1,2})(?!\d)", re.IGNORECASE),
+    re.compile(r"(?<!\d)(\d{1,2})[\s_-]+20\d\d(?!\d)"),
+]
+DATE_PATTERN = re.compile(r"(?<!\d)(20\d\d)(\d\d)(\d\d)(?!\d)")
+# Results columns that can be changed after the run, e.g. by reviewers, and where they are stored
+EDITABLE_COLUMNS = {
+    "final_product_name": ("extractions", "final_product_name"),
+    "final_original_price": ("extractions", "final_original_price"),
+    "final_discount_price": ("extractions", "final_discount_price"),
+    "final_percentage_discount": ("extractions", "final_percentage_discount"),
+    "extracted_discount_details": ("extractions", "discount_details"),
+    "final_category": ("categories", "final_category"),
+}
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS leaflets (
+    id INTEGER PRIMARY KEY, folder TEXT NOT NULL UNIQUE, supermarket TEXT, calendar_week INTEGER,
+    date_collected TEXT, collection_week INTEGER, updated_at REAL NOT NULL);
+CREATE TABLE IF NOT EXISTS pages (
+    id INTEGER PRIMARY KEY, leaflet_id INTEGER NOT NULL REFERENCES leaflets (id) ON DELETE CASCADE,
+    page_name TEXT NOT NULL, UNIQUE (leaflet_id, page_name));
+CREATE TABLE IF NOT EXISTS extractions (
+    id INTEGER PRIMARY KEY, page_id INTEGER NOT NULL REFERENCES pages (id) ON DELETE CASCADE,
+    product_index INTEGER NOT NULL, product_name TEXT, original_price TEXT, discount_price TEXT,
+    percentage_discount REAL, discount_details TEXT, region TEXT,
+    final_product_name TEXT, final_original_price REAL, final_discount_price REAL, final_percentage_discount REAL,
+    confidence_product_name REAL, confidence_original_price REAL, confidence_discount_price REAL,
+    confidence_percentage_discount REAL);
+CREATE TABLE IF NOT EXISTS validations (
+    extraction_id INTEGER NOT NULL REFERENCES extractions (id) ON DELETE CASCADE, pass_index INTEGER NOT NULL,
+    product_name TEXT, original_price TEXT, discount_price TEXT, percentage_discount REAL, discount_details TEXT,
+    PRIMARY KEY (extraction_id, pass_index));
+CREATE TABLE IF NOT EXISTS categories (
+    extraction_id INTEGER PRIMARY KEY REFERENCES extractions (id) ON DELETE CASCADE, category TEXT,
+    final_category TEXT, categorization_confidence REAL, categorization_all_same INTEGER);
+CREATE TABLE IF NOT EXISTS category_votes (
+    extraction_id INTEGER NOT NULL REFERENCES extractions (id) ON DELETE CASCADE, category TEXT NOT NULL,
+    votes INTEGER NOT NULL, PRIMARY KEY (extraction_id, category));
+CREATE TABLE IF NOT EXISTS edits (
+    id INTEGER PRIMARY KEY AUTOINCREMENT, folder TEXT NOT NULL, page_name TEXT NOT NULL, product_index INTEGER NOT NULL,
+    product_name TEXT, column_name TEXT NOT NULL, value, created_at REAL NOT NULL, compacted INTEGER NOT NULL DEFAULT 0);
+CREATE INDEX IF NOT EXISTS leaflets_supermarket ON leaflets (supermarket);
+CREATE INDEX IF NOT EXISTS leaflets_calendar_week ON leaflets (calendar_week);
+CREATE INDEX IF NOT EXISTS pages_leaflet ON pages (leaflet_id);
+CREATE INDEX IF NOT EXISTS extractions_page ON extractions (page_id);
+CREATE INDEX IF NOT EXISTS categories_final_category ON categories (final_category);
+CREATE INDEX IF NOT EXISTS edits_pending ON edits (compacted, id);
+CREATE INDEX IF NOT EXISTS edits_product ON edits (folder, page_name, product_index);
+"""
+# The edits of the products that are currently in the results. Edits are bound to the leaflet folder, page and position
+# of the product, which stay the same when a leaflet is saved again, and to the extracted product name, so that an edit
+# is dropped instead of changing another product when the page was extracted again with other products.
+CURRENT_EDITS = """
+SELECT ed.id, e.id, ed.column_name, ed.value, l.folder, ed.page_name, ed.product_index FROM edits ed
+JOIN leaflets l ON l.folder = ed.folder JOIN pages p ON p.leaflet_id = l.id AND p.page_name = ed.page_name
+JOIN extractions e ON e.page_id = p.id AND e.product_index = ed.product_index AND e.product_name IS ed.product_name
+"""
+
+
+def parse_leaflet_folder(folder: str) -> Tuple[Optional[str], Optional[int]]:
+    """
+    Returns the supermarket and calendar week in the name of a leaflet folder, None for what isn't found.
+    E.g. ("Lidl", 17) for "LIDL-AKTUELL-KW17-27-4-3-5-06" and ("Coop", 18) for "COOP AM_20230502_ZZ".
+    """
+    supermarket = next((name for name in SUPERMARKETS if name.lower() in folder.lower()), None)
+    for pattern in WEEK_PATTERNS:
+        match = pattern.search(folder)
+        if match and 1 <= int(match.group(1)) <= 53:
+            return supermarket, int(match.group(1))
+    match = DATE_PATTERN.search(folder)
+    if match:
+        try:
+            return supermarket, datetime.date(*map(int, match.groups())).isocalendar()[1]
+        except ValueError:
+            pass
+    return supermarket, None
+
+
+def _sql_value(value):
+    """
+    Converts a pandas value to one SQLite stores, None for missing values.
+    """
+    if value is None or (not isinstance(value, (list, tuple)) and pd.isna(value)):
+        return None
+    if isinstance(value, pd.Timestamp):
+        return value.strftime("%Y-%m-%d")
+    return value.item() if hasattr(value, "item") else value
+
+
+def apply_edits(data: pd.DataFrame, edits: Iterable[Tuple[int, int, str, object]]) -> None:
+    """
+    Applies edits, as returned by RunDatabase.edits_after, in place to results with an extraction_id column.
+    Edits of rows that aren't in the results are ignored.
+    """
+    edits = list(edits)
+    if not edits or data.empty:
+        return
+    rows_by_extraction = pd.Series(data.index, index=data["extraction_id"])
+    for _, extraction_id, column, value in edits:
+        if column in data and extraction_id in rows_by_extraction.index:
+            data.at[rows_by_extraction[extraction_id], column] = _typed_value(column, value)
+
+
+def apply_leaflet_edits(data: pd.DataFrame, edits: Iterable[Tuple[str, int, str, object]]) -> pd.DataFrame:
+    """
+    Returns the results of a leaflet, as saved in its folder, with edits as returned by RunDatabase.leaflet_edits applied.
+    Columns that are edited but missing, e.g. final_category of a leaflet that wasn't categorized, are added.
+    """
+    edits = list(edits)
+    if not edits or data.empty:
+        return data
+    data = data.copy()
+    # Products are numbered per page in the order of the results, like in save_results
+    product_indexes = data.groupby("extracted_page_number", sort=False, dropna=False).cumcount()
+    rows_by_product = pd.Series(data.index, index=pd.MultiIndex.from_arrays([data["extracted_page_number"], product_indexes]))
+    for column in {column for _, _, column, _ in edits}:
+        data[column] = data[column].astype(object) if column in data else None
+    for page_name, product_index, column, value in edits:
+        if (page_name, product_index) in rows_by_product.index:
+            data.at[rows_by_product[(page_name, product_index)], column] = _typed_value(column, value)
+    return with_result_dtypes(data)
+
+
+def _typed_value(column: str, value):
+    # Converted like saved results, e.g. the price "2.-" to 2.0
+    return with_result_dtypes(pd.DataFrame({column: [value]}))[column].iloc[0]
+
+
+class RunDatabase:
+    """
+    Database of the results of all leaflets, stored in SQLite: the leaflets with their supermarket and
+    calendar week, their pages, the extracted products, the validation passes and the categories.
+
+    The results of a leaflet are written with save_results whenever they are saved, and are read with
+    results, filtered by supermarket, calendar week and category, without scanning the leaflet folders.
+    Corrections of reviewers are appended to an edit log with record_edits, which is cheap however many results
+    there are, and are applied to the results by compact_edits. Until then, results applies them on the fly.
+    The edits of a leaflet are applied again whenever its results are saved again, e.g. after some pages changed.
+    """
+
+    def __init__(self, path: str):
+        """
+        Parameters:
+            path (str): Path to the SQLite file, created if it doesn't exist.
+        """
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(path, check_same_thread=False)
+        # Reviewers can read while the job worker writes results
+        self._connection.execute("PRAGMA journal_mode = WAL")
+        self._connection.execute("PRAGMA foreign_keys = ON")
+        with self._connection:
+            self._migrate_edits_by_extraction()
+            self._connection.executescript(SCHEMA)
+            if self._connection.execute("SELECT 1 FROM sqlite_master WHERE name = 'edits_by_extraction'").fetchone():
+                self._connection.execute(
+                    "INSERT INTO edits (id, folder, page_name, product_index, product_name, column_name, value, created_at, compacted) "
+                    "SELECT ed.id, l.folder, p.page_name, e.product_index, e.product_name, ed.column_name, ed.value, "
+                    "ed.created_at, ed.compacted FROM edits_by_extraction ed JOIN extractions e ON e.id = ed.extraction_id "
+                    "JOIN pages p ON e.page_id = p.id JOIN leaflets l ON p.leaflet_id = l.id"
+                )
+                self._connection.execute("DROP TABLE edits_by_extraction")
+
+    def results_version(self) -> Tuple:
+        """
+        Returns a value that changes whenever results of a leaflet are saved or deleted, but not with edits.
+        """
+        with self._lock:
+            return tuple(self._connection.execute("SELECT COUNT(*), MAX(updated_at) FROM leaflets").fetchone())
+
+    def has_leaflet(self, folder: str) -> bool:
+        with self._lock:
+            return self._connection.execute("SELECT 1 FROM leaflets WHERE folder = ?", (folder,)).fetchone() is not None
+
+    def delete_leaflet(self, folder: str) -> None:
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM leaflets WHERE folder = ?", (folder,))
+
+    def save_results(self, folder: str, data: pd.DataFrame, page_names: Iterable[str] = ()) -> None:
+        """
+        Replaces the results of a leaflet with the rows of its results DataFrame.
+
+        Parameters:
+            folder (str): The name of the leaflet folder, which the supermarket and calendar week are parsed from.
+            data (pd.DataFrame): The results of the leaflet, as saved by ResultSaver.
+            page_names (Iterable[str]): All pages of the leaflet, also the ones without products.
+        """
+        data = with_result_dtypes(data)
+        supermarket, calendar_week = parse_leaflet_folder(folder)
+        date_collected = _sql_value(data["date_collected"].iloc[0]) if "date_collected" in data and len(data.index) else None
+        collection_week = _sql_value(data["calendar_week"].iloc[0]) if "calendar_week" in data and len(data.index) else None
+
+        def column(name: str) -> list:
+            return [_sql_value(value) for value in data[name]] if name in data else [None] * len(data.index)
+
+        with self._lock, self._connection:
+            self._connection.execute("DELETE FROM leaflets WHERE folder = ?", (folder,))
+            leaflet_id = self._connection.execute(
+                "INSERT INTO leaflets (folder, supermarket, calendar_week, date_collected, collection_week, updated_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (folder, supermarket, calendar_week, date_collected, collection_week, time.time()),
+            ).lastrowid
+
+            page_ids = {}
+            for page_name in list(page_names) + [page for page in column("extracted_page_number") if page is not None]:
+                if page_name not in page_ids:
+                    page_ids[page_name] = self._connection.execute(
+                        "INSERT INTO pages (leaflet_id, page_name) VALUES (?, ?)", (leaflet_id, page_name)
+                    ).lastrowid
+
+            extraction_columns = [f"extracted_{field}" for field in PRODUCT_FIELDS] + ["extracted_region"] \
+                + [f"final_{field}" for field in CONSENSUS_FIELDS] + [f"confidence_{field}" for field in CONSENSUS_FIELDS]
+            extraction_rows = zip(*[column(name) for name in extraction_columns])
+            validation_columns = {
+                i: list(zip(*[column(f"validated{i}_{field}") for field in PRODUCT_FIELDS]))
+                for i in range(1, NUMBER_OF_CHATGPT_VALIDATIONS + 1)
+            }
+            category_rows = list(zip(*[column(name) for name in
+                                       ["Category", "final_category", "categorization_confidence", "categorization_all_same"]]))
+            has_categories = "final_category" in data
+            vote_columns = {str(name)[len("votes_"):]: column(name) for name in data.columns if str(name).startswith("votes_")}
+
+            product_indexes: Dict[str, int] = {}
+            rows_without_page = 0
+            for row_index, (page_name, extraction) in enumerate(zip(column("extracted_page_number"), extraction_rows)):
+                if page_name is None:
+                    rows_without_page += 1
+                    continue
+                product_indexes[page_name] = product_indexes.get(page_name, -1) + 1
+                extraction_id = self._connection.execute(
+                    f"INSERT INTO extractions (page_id, product_index, {', '.join(self._extraction_fields())}) "
+                    f"VALUES (?, ?, {', '.join('?' * len(extraction))})",
+                    (page_ids.get(page_name), product_indexes[page_name], *extraction),
+                ).lastrowid
+                for pass_index, validations in validation_columns.items():
+                    validation = validations[row_index]
+                    if any(value is not None for value in validation):
+                        self._connection.execute(
+                            f"INSERT INTO validations (extraction_id, pass_index, {', '.join(PRODUCT_FIELDS)}) "
+                            f"VALUES (?, ?, {', '.join('?' * len(PRODUCT_FIELDS))})",
+                            (extraction_id, pass_index, *validation),
+                        )
+                if has_categories:
+                    self._connection.execute(
+                        "INSERT INTO categories (extraction_id, category, final_category, categorization_confidence, "
+                        "categorization_all_same) VALUES (?, ?, ?, ?, ?)",
+                        (extraction_id, *category_rows[row_index]),
+                    )
+                self._connection.executemany(
+                    "INSERT INTO category_votes (extraction_id, category, votes) VALUES (?, ?, ?)",
+                    [(extraction_id, category, votes[row_index]) for category, votes in vote_columns.items()
+                     if votes[row_index] is not None],
+                )
+            if rows_without_page:
+                print(f"{rows_without_page} results of {folder} have no extracted_page_number and aren't saved in the run database.")
+
+            # The corrections of the reviewers aren't lost when a leaflet is saved again
+            self._apply_edit_rows(self._connection.execute(f"{CURRENT_EDITS} WHERE ed.folder = ? ORDER BY ed.id", (folder,)).fetchall())
+
+    def leaflets(self, supermarket: Optional[str] = None, calendar_week: Optional[int] = None) -> pd.DataFrame:
+        """
+        Returns the leaflets with their supermarket, calendar week and number of pages and products.
+        """
+        where, parameters = self._leaflet_filter(supermarket, calendar_week)
+        with self._lock:
+            return pd.read_sql_query(
+                "SELECT l.folder, l.supermarket, l.calendar_week, l.date_collected, "
+                "(SELECT COUNT(*) FROM pages p WHERE p.leaflet_id = l.id) AS num_pages, "
+                "(SELECT COUNT(*) FROM pages p JOIN extractions e ON e.page_id = p.id WHERE p.leaflet_id = l.id) AS num_products "
+                f"FROM leaflets l {where} ORDER BY l.supermarket, l.calendar_week, l.folder",
+                self._connection, params=parameters,
+            )
+
+    def results(self, supermarket: Optional[str] = None, calendar_week: Optional[int] = None,
+                category: Optional[str] = None, folders: Optional[List[str]] = None) -> pd.DataFrame:
+        """
+        Returns the results of the matching leaflets, with the columns of the results saved by ResultSaver,
+        and extraction_id, supermarket and leaflet_week.
+
+        Parameters:
+            supermarket (Optional[str]): Only leaflets of this supermarket.
+            calendar_week (Optional[int]): Only leaflets of this calendar week.
+            category (Optional[str]): Only products with this final category.
+            folders (Optional[List[str]]): Only these leaflet folders.
+        """
+        where, parameters = self._leaflet_filter(supermarket, calendar_week)
+        conditions = [where[len("WHERE "):]] if where else []
+        if category is not None:
+            conditions.append("c.final_category = ?")
+            parameters.append(category)
+        if folders is not None:
+            conditions.append(f"l.folder IN ({', '.join('?' * len(folders))})")
+            parameters.extend(folders)
+
+        extraction_columns = ", ".join(
+            [f"e.{field} AS extracted_{field}" for field in PRODUCT_FIELDS] + ["e.region AS extracted_region"]
+            + [f"e.final_{field}, e.confidence_{field}" for field in CONSENSUS_FIELDS]
+        )
+        with self._lock:
+            data = pd.read_sql_query(
+                f"SELECT e.id AS extraction_id, l.folder AS extracted_folder, p.page_name AS extracted_page_number, "
+                f"{extraction_columns}, c.category AS Category, c.categorization_all_same, c.categorization_confidence, "
+                "c.final_category, l.date_collected, l.collection_week AS calendar_week, l.supermarket, "
+                "l.calendar_week AS leaflet_week "
+                "FROM extractions e JOIN pages p ON e.page_id = p.id JOIN leaflets l ON p.leaflet_id = l.id "
+                "LEFT JOIN categories c ON c.extraction_id = e.id "
+                f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''} "
+                "ORDER BY l.folder, p.id, e.product_index",
+                self._connection, params=parameters,
+            )
+            validations = pd.read_sql_query(
+                f"SELECT v.* FROM validations v JOIN extractions e ON v.extraction_id = e.id "
+                "JOIN pages p ON e.page_id = p.id JOIN leaflets l ON p.leaflet_id = l.id "
+                "LEFT JOIN categories c ON c.extraction_id = e.id "
+                f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''}",
+                self._connection, params=parameters,
+            )
+            votes = pd.read_sql_query(
+                f"SELECT v.* FROM category_votes v JOIN extractions e ON v.extraction_id = e.id "
+                "JOIN pages p ON e.page_id = p.id JOIN leaflets l ON p.leaflet_id = l.id "
+                "LEFT JOIN categories c ON c.extraction_id = e.id "
+                f"{'WHERE ' + ' AND '.join(conditions) if conditions else ''}",
+                self._connection, params=parameters,
+            )
+
+        for pass_index in range(1, NUMBER_OF_CHATGPT_VALIDATIONS + 1):
+            validation = validations[validations["pass_index"] == pass_index].set_index("extraction_id")[PRODUCT_FIELDS]
+            validation = validation.add_prefix(f"validated{pass_index}_")
+            data = data.join(validation, on="extraction_id")
+        if not votes.empty:
+            # Like in the combined results, leaflets without votes for a category get nulls there
+            data = data.join(votes.pivot(index="extraction_id", columns="category", values="votes").add_prefix("votes_"), on="extraction_id")
+        data["categorization_all_same"] = data["categorization_all_same"].astype("boolean")
+        data["leaflet_week"] = data["leaflet_week"].astype("Int16")
+        data = with_result_dtypes(data)
+        apply_edits(data, self.pending_edits())
+        return data
+
+    def leaflet_results(self, folder: str) -> pd.DataFrame:
+        """
+        Returns the results of one leaflet with all edits applied, with the columns of the results saved in its folder.
+        """
+        data = self.results(folders=[folder]).drop(columns=["extraction_id", "supermarket", "leaflet_week"])
+        # Columns the leaflet's results don't have come back empty, e.g. the categories of a leaflet that wasn't categorized
+        return data.loc[:, data.notna().any() | data.columns.isin(list(EDITABLE_COLUMNS))]
+
+    def record_edits(self, edits: Iterable[Tuple[int, str, object]]) -> int:
+        """
+        Appends corrections to the edit log, without rewriting any results.
+
+        Parameters:
+            edits (Iterable[Tuple[int, str, object]]): The extraction id, one of the EDITABLE_COLUMNS and the new value.
+                Edits of extractions that don't exist anymore are ignored.
+        Returns:
+            int: The id of the last edit, 0 if there were none.
+        """
+        now = time.time()
+        edits = [(int(extraction_id), column, _sql_value(value)) for extraction_id, column, value in edits
+                 if column in EDITABLE_COLUMNS]
+        with self._lock, self._connection:
+            products = {}
+            extraction_ids = list({extraction_id for extraction_id, _, _ in edits})
+            # In chunks, SQLite limits the number of parameters of a query
+            for start in range(0, len(extraction_ids), 500):
+                chunk = extraction_ids[start:start + 500]
+                for extraction_id, *product in self._connection.execute(
+                        "SELECT e.id, l.folder, p.page_name, e.product_index, e.product_name FROM extractions e "
+                        "JOIN pages p ON e.page_id = p.id JOIN leaflets l ON p.leaflet_id = l.id "
+                        f"WHERE e.id IN ({', '.join('?' * len(chunk))})", chunk):
+                    products[extraction_id] = product
+            rows = [(*products[extraction_id], column, value, now) for extraction_id, column, value in edits
+                    if extraction_id in products]
+            self._connection.executemany(
+                "INSERT INTO edits (folder, page_name, product_index, product_name, column_name, value, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)", rows
+            )
+            return self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM edits").fetchone()[0] if rows else 0
+
+    def last_edit_id(self) -> int:
+        with self._lock:
+            return self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM edits").fetchone()[0]
+
+    def edits_after(self, edit_id: int) -> List[Tuple[int, int, str, object]]:
+        """
+        Returns the edits after the one with edit_id, compacted or not, oldest first, as
+        tuples of edit id, extraction id, column and value. Edits of products that aren't in the results are left out.
+        """
+        with self._lock:
+            return [edit[:4] for edit in self._connection.execute(f"{CURRENT_EDITS} WHERE ed.id > ? ORDER BY ed.id", (edit_id,))]
+
+    def pending_edits(self) -> List[Tuple[int, int, str, object]]:
+        """
+        Returns the edits that haven't been compacted yet, oldest first, like edits_after.
+        """
+        with self._lock:
+            return [edit[:4] for edit in self._connection.execute(f"{CURRENT_EDITS} WHERE ed.compacted = 0 ORDER BY ed.id")]
+
+    def leaflet_edits(self, folder: str) -> List[Tuple[str, int, str, object]]:
+        """
+        Returns all edits of the products of a leaflet, compacted or not, oldest first, as tuples of
+        page name, product index on the page, column and value, for apply_leaflet_edits.
+        """
+        with self._lock:
+            return [(page_name, product_index, column, value) for _, _, column, value, _, page_name, product_index
+                    in self._connection.execute(f"{CURRENT_EDITS} WHERE ed.folder = ? ORDER BY ed.id", (folder,))]
+
+    def compact_edits(self) -> Dict[str, int]:
+        """
+        Applies the pending edits to the results, in one transaction, and marks them as compacted.
+        They are kept in the log as the history of the corrections, and to apply them again when a leaflet is saved again.
+
+        Returns:
+            Dict[str, int]: The number of edits applied, by leaflet folder.
+        """
+        with self._lock, self._connection:
+            last_edit_id = self._connection.execute("SELECT COALESCE(MAX(id), 0) FROM edits WHERE compacted = 0").fetchone()[0]
+            edits = self._connection.execute(
+                f"{CURRENT_EDITS} WHERE ed.compacted = 0 AND ed.id <= ? ORDER BY ed.id", (last_edit_id,)
+            ).fetchall()
+            self._apply_edit_rows(edits)
+            # Also edits of products that aren't in the results, they are applied if the products come back
+            self._connection.execute("UPDATE edits SET compacted = 1 WHERE compacted = 0 AND id <= ?", (last_edit_id,))
+        edits_by_folder: Dict[str, int] = {}
+        for _, _, _, _, folder, *_ in edits:
+            edits_by_folder[folder] = edits_by_folder.get(folder, 0) + 1
+        return edits_by_folder
+
+    def _apply_edit_rows(self, edits: List[tuple]) -> None:
+        # Only the last edit of a field counts
+        latest: Dict[str, Dict[int, object]] = {}
+        for _, extraction_id, column, value, *_ in edits:
+            latest.setdefault(column, {})[extraction_id] = value
+        for column, values in latest.items():
+            typed_values = with_result_dtypes(pd.DataFrame({column: list(values.values())}))[column]
+            self._update_column(column, zip(values.keys(), typed_values))
+
+    def _migrate_edits_by_extraction(self) -> None:
+        """
+        Edit logs of earlier versions referenced the extractions by id, and were deleted with them when a leaflet
+        was saved again. They are renamed, to be copied into the current edit log once it is created.
+        """
+        columns = [row[1] for row in self._connection.execute("PRAGMA table_info(edits)")]
+        if "extraction_id" in columns:
+            self._connection.execute("DROP INDEX IF EXISTS edits_pending")
+            self._connection.execute("ALTER TABLE edits RENAME TO edits_by_extraction")
+
+    def _update_column(self, column: str, values: Iterable[Tuple[int, object]]) -> None:
+        table, table_column = EDITABLE_COLUMNS[column]
+        rows = [(_sql_value(value), int(extraction_id)) for extraction_id, value in values]
+        if table == "categories":
+            self._connection.executemany(
+                "INSERT INTO categories (extraction_id, final_category) VALUES (?2, ?1) "
+                "ON CONFLICT (extraction_id) DO UPDATE SET final_category = excluded.final_category", rows
+            )
+        else:
+            self._connection.executemany(f"UPDATE {table} SET {table_column} = ? WHERE id = ?", rows)
+
+    @staticmethod
+    def _extraction_fields() -> List[str]:
+        return PRODUCT_FIELDS + ["region"] + [f"final_{field}" for field in CONSENSUS_FIELDS] \
+            + [f"confidence_{field}" for field in CONSENSUS_FIELDS]
+
+    @staticmethod
+    def _leaflet_filter(supermarket: Optional[str], calendar_week: Optional[int]) -> Tuple[str, list]:
+        conditions, parameters = [], []
+        if supermarket is not None:
+            conditions.append("l.supermarket = ?")
+            parameters.append(supermarket)
+        if calendar_week is not None:
+            conditions.append("l.calendar_week = ?")
+            parameters.append(int(calendar_week))
+        return ("WHERE " + " AND ".join(conditions)) if conditions else "", parameters
@@ -0,0 +1,2 @@
+# Files of an uploaded zip that can be processed, by extension
+PROCESSABLE_FILE_EXTENSIONS = [".pdf", ".png"]
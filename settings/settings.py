@@ -3,3 +3,14 @@ API_KEY_PATH = "openai_api_key.txt"
 URL = "https://drive.google.com/drive/folders/1AR2_592V_x4EF97FHv4UPN5zdLTXpVB3"
 NUMBER_OF_CHATGPT_VALIDATIONS = 2
 EXTRACTED_DATA_COLUMNS = ["product_name", "original_price", "discount_price","percentage_discount"]
+REQUESTS_PER_MINUTE = 500
+TOKENS_PER_MINUTE = 200000
+MAX_CONCURRENT_PAGES = 8
+MAX_CONCURRENT_LEAFLETS = 4
+RESPONSE_CACHE_MAX_SIZE_MB = 512
+BYPASS_RESPONSE_CACHE = False
+USE_REGION_CROPPING = False
+VALIDATION_SAMPLES_IN_ONE_REQUEST = True
+USE_LOCAL_CLASSIFIER = True
+LOCAL_CLASSIFIER_THRESHOLD = 0.9
+UPLOAD_STAGING_DIR = "upload-staging"
@@ -1,11 +1,79 @@
+import os
+import time
 import streamlit as st
 import pandas as pd
-from PIL import Image
+
+from categorization.category_cache import CATEGORY_CACHE_FILE_NAME, REVIEWER_SOURCE, CategoryCache
+from leaflet_processing.page_previews import PagePreviews, parse_region
+from openai_integration.models import ProductCategory
+from pipeline.job_queue import JOB_QUEUE_FILE_NAME, JobQueue
+from result_handling.result_saver import ResultSaver
+from result_handling.results_cache import EditCompactor, ResultsCache
+from result_handling.run_database import RUN_DATABASE_FILE_NAME, RunDatabase
+
+RESULTS_DIR = 'pdf-files'
+# The editable columns of the review grid, by their results column
+GRID_COLUMNS = {
+    "final_product_name": st.column_config.TextColumn("Product Name", width="large"),
+    "final_original_price": st.column_config.NumberColumn("Original Price", min_value=0.0, format="%.2f"),
+    "final_discount_price": st.column_config.NumberColumn("Discount Price", min_value=0.0, format="%.2f"),
+    "final_percentage_discount": st.column_config.NumberColumn("Percentage Discount", min_value=0.0, max_value=100.0),
+    "extracted_discount_details": st.column_config.TextColumn("Discount Details"),
+    "final_category": st.column_config.SelectboxColumn("Final Category", options=[category.value for category in ProductCategory]),
+}
+
+
+def changed_cells(shown: pd.DataFrame, edited: pd.DataFrame) -> list:
+    """
+    Returns the cells the reviewer changed in the grid, as edits for RunDatabase.record_edits.
+    """
+    edits = []
+    for column in GRID_COLUMNS:
+        before, after = shown[column], edited[column]
+        changed = ~((before == after) | (before.isna() & after.isna()))
+        edits.extend((shown.at[index, "extraction_id"], column, after[index]) for index in shown.index[changed.fillna(True)])
+    return edits
+
+
+@st.cache_resource
+def get_page_previews() -> PagePreviews:
+    return PagePreviews()
+
+
+@st.cache_resource
+def get_category_cache() -> CategoryCache:
+    # One connection for all sessions, the cache is thread safe
+    return CategoryCache(os.path.join(RESULTS_DIR, CATEGORY_CACHE_FILE_NAME))
+
+
+def reviewed_categories(data: pd.DataFrame, edits: list) -> list:
+    """
+    Returns the categories the reviewer changed, by the extracted product name the categorizer looks them up by.
+    """
+    categories = [category.value for category in ProductCategory]
+    extracted_names = dict(zip(data["extraction_id"], data["extracted_product_name"]))
+    return [
+        (extracted_names[extraction_id], ProductCategory(value)) for extraction_id, column, value in edits
+        if column == "final_category" and value in categories and isinstance(extracted_names.get(extraction_id), str)
+    ]
+
+
+@st.cache_resource
+def get_results_cache() -> ResultsCache:
+    """
+    Returns the results cache shared by all sessions, and starts compacting the edits in the background.
+    """
+    run_database = RunDatabase(os.path.join(RESULTS_DIR, RUN_DATABASE_FILE_NAME))
+    job_queue = JobQueue(os.path.join(RESULTS_DIR, JOB_QUEUE_FILE_NAME))
+    EditCompactor(run_database, ResultSaver(), RESULTS_DIR, job_queue).start()
+    return ResultsCache(run_database)
+
 
 def show_check_results_page():
-    # Load the data from csv file
-    result_csv_path = 'pdf-files/results.csv'
-    data = pd.read_csv(result_csv_path)
+    # The results of all leaflets, only loaded again when leaflets were saved since
+    results_cache = get_results_cache()
+    run_database = results_cache.run_database
+    data = results_cache.results()
 
     # Ensure 'extracted_folder', 'extracted_page_number', and 'categorization_all_same' columns are present
     required_columns = ['extracted_folder', 'extracted_page_number', 'categorization_all_same']
@@ -13,8 +81,11 @@ def show_check_results_page():
         st.error(f"The dataframe must have {required_columns} columns.")
         st.stop()
 
-    # Get the unique combinations of folder and page number
-    unique_images = data[['extracted_folder', 'extracted_page_number']].drop_duplicates()
+    # The unique combinations of folder and page number
+    unique_images = results_cache.pages()
+    if not unique_images:
+        st.write("No results to check yet.")
+        return
 
     # Initialize session state for current page index if not already set
     if 'current_page_index' not in st.session_state:
@@ -30,60 +101,78 @@ def show_check_results_page():
             st.session_state.current_page_index += 1
 
     # Get the current folder and page number based on session state index
-    current_image = unique_images.iloc[st.session_state.current_page_index]
-    current_folder = current_image['extracted_folder']
-    current_page_number = current_image['extracted_page_number']
-
-    # Filter the dataframe based on the current folder, page number, and categorization_all_same == True
-    filtered_data = data[
-        (data['extracted_folder'] == current_folder) &
-        (data['extracted_page_number'] == current_page_number) &
-        (data['categorization_all_same'] == True)
-    ]
+    st.session_state.current_page_index = min(st.session_state.current_page_index, len(unique_images) - 1)
+    current_folder, current_page_number = unique_images[st.session_state.current_page_index]
+
+    # The rows of the current page with categorization_all_same == True
+    page_data = results_cache.page_results(current_folder, current_page_number)
+    filtered_data = page_data[page_data['categorization_all_same'] == True]
 
-    # Load the image corresponding to the current folder and page number
+    # Show a preview of the current page, made once and cached on disk, instead of the full page image
+    page_previews = get_page_previews()
+    image_path = f'{RESULTS_DIR}/{current_folder}/{current_page_number}'
     try:
-        image_path = f'pdf-files/{current_folder}/{current_page_number}'
-        image = Image.open(image_path)
-        st.sidebar.image(image, caption=f"Image for {current_folder}, Page {current_page_number}", use_column_width=True)
+        st.sidebar.image(page_previews.preview_path(image_path), caption=f"Image for {current_folder}, Page {current_page_number}",
+                         use_container_width=True)
+
+        # Products with a region can be shown zoomed in
+        regions = {}
+        for index, row in filtered_data.iterrows():
+            region = parse_region(row.get('extracted_region'))
+            if region is not None:
+                regions[f"Row {index + 1}: {row['final_product_name']}"] = region
+        if regions:
+            zoomed_product = st.sidebar.selectbox("Zoom to product", ["Whole page"] + list(regions))
+            if zoomed_product != "Whole page":
+                st.sidebar.image(page_previews.zoom(image_path, regions[zoomed_product]), caption=zoomed_product,
+                                 use_container_width=True)
     except FileNotFoundError:
         st.sidebar.warning(f"Image not found for {current_folder}, Page {current_page_number}")
 
+    # The previous and next pages are ready by the time they are shown
+    current_index = st.session_state.current_page_index
+    page_previews.prefetch(f'{RESULTS_DIR}/{folder}/{page_name}'
+                           for folder, page_name in unique_images[max(0, current_index - 1): current_index + 2])
+
     # Set up the Streamlit page
     st.title("Supermarket Data Editing Tool")
 
-    # Function to edit the dataframe row by row
-    def edit_row(index, df, csv_path):
-        with st.form(key=f"form_{index}"):
-            st.write(f"Editing Row {index + 1}")
-
-            # Create editable input fields for each relevant column in the row
-            product_name = st.text_input("Product Name", value=str(df.loc[index, "final_product_name"]))
-            original_price = st.text_input("Original Price", value=str(df.loc[index, "final_original_price"]))
-            discount_price = st.text_input("Discount Price", value=str(df.loc[index, "final_discount_price"]))
-            percentage_discount = st.text_input("Percentage Discount", value=str(df.loc[index, "final_percentage_discount"]))
-            discount_details = st.text_input("Discount Details", value=str(df.loc[index, "extracted_discount_details"]))
-            final_category = st.text_input("Final Category", value=str(df.loc[index, "final_category"]))
-
-            # Button to save the changes for this row
-            submitted = st.form_submit_button("Save Changes")
-
-            if submitted:
-                # Update the dataframe with the new values
-                df.loc[index, "final_product_name"] = product_name
-                df.loc[index, "final_original_price"] = original_price
-                df.loc[index, "final_discount_price"] = discount_price
-                df.loc[index, "final_percentage_discount"] = percentage_discount
-                df.loc[index, "extracted_discount_details"] = discount_details
-                df.loc[index, "final_category"] = final_category
-
-                data.to_csv(csv_path, index=False)
-                st.success(f"Row {index + 1} updated successfully!")
-
-    # Display filtered rows and provide options for editing them
+    if 'products_checked' not in st.session_state:
+        st.session_state.products_checked = 0
+        st.session_state.review_started_at = time.time()
+    if 'review_message' in st.session_state:
+        st.success(st.session_state.pop('review_message'))
+
+    # All products of the page in one grid, edited with the keyboard like a spreadsheet: arrow keys and tab to move,
+    # typing or enter to edit. The form keeps edits from rerunning the page until they are saved together.
     if not filtered_data.empty:
-        for idx in filtered_data.index:
-            edit_row(idx, data, result_csv_path)
+        shown_data = filtered_data[["extraction_id"] + list(GRID_COLUMNS)]
+        with st.form(key=f"grid_{current_folder}_{current_page_number}"):
+            edited_data = st.data_editor(
+                shown_data, column_config={"extraction_id": None, **GRID_COLUMNS}, hide_index=True,
+                use_container_width=True, num_rows="fixed",
+            )
+            col1, col2 = st.columns([1, 1])
+            with col1:
+                save = st.form_submit_button("Save")
+            with col2:
+                save_and_next = st.form_submit_button("Save and Next Image", type="primary")
+
+        if save or save_and_next:
+            # Only the changed cells are written, in one batch, so reviewers don't overwrite each other's corrections
+            edits = changed_cells(shown_data, edited_data)
+            run_database.record_edits(edits)
+            # Corrected categories are reused for the same products in later runs
+            get_category_cache().put_many(reviewed_categories(filtered_data, edits), source=REVIEWER_SOURCE)
+            st.session_state.products_checked += len(edited_data.index)
+            minutes = max(time.time() - st.session_state.review_started_at, 1) / 60
+            st.session_state.review_message = (
+                f"Saved {len(edits)} changes. {st.session_state.products_checked} products checked, "
+                f"{st.session_state.products_checked / minutes:.1f} per minute."
+            )
+            if save_and_next and st.session_state.current_page_index < len(unique_images) - 1:
+                st.session_state.current_page_index += 1
+            st.rerun()
 
         # Display navigation buttons below the edit section
         st.write("### Navigation")
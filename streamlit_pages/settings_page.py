@@ -26,7 +26,10 @@ def show_settings_page():
     def save_settings(file_path, settings):
         with open(file_path, "w") as file:
             for key, value in settings.items():
-                if key in ['EXTRACTED_DATA_COLUMNS', 'NUMBER_OF_CHATGPT_VALIDATIONS']:
+                if key in ['EXTRACTED_DATA_COLUMNS', 'NUMBER_OF_CHATGPT_VALIDATIONS', 'REQUESTS_PER_MINUTE', 'TOKENS_PER_MINUTE',
+                           'MAX_CONCURRENT_PAGES', 'MAX_CONCURRENT_LEAFLETS', 'RESPONSE_CACHE_MAX_SIZE_MB',
+                           'BYPASS_RESPONSE_CACHE', 'USE_REGION_CROPPING', 'VALIDATION_SAMPLES_IN_ONE_REQUEST',
+                           'USE_LOCAL_CLASSIFIER', 'LOCAL_CLASSIFIER_THRESHOLD']:
                     file.write(f'{key} = {value}\n')
                 else:
                     file.write(f'{key} = "{value}"\n')
@@ -1,59 +1,115 @@
-import glob
-import io
 import os
 import pandas as pd
+import shutil
 import streamlit as st
-import tempfile
-import zipfile
 
 from datetime import datetime
-from natsort import natsorted
 
-from categorization.product_categorizer import ProductCategorizer
-from leaflet_processing.leaflet_reader import LeafletReader
-from openai_integration.openai_client import OpenAIClient
-from result_handling.result_saver import ResultSaver
-import main_pipeline
+from leaflet_processing.upload_staging import UploadStaging
+from pipeline.job_queue import DONE, FAILED, JOB_QUEUE_FILE_NAME, QUEUED, JobQueue
+from pipeline.job_worker import start_worker_process
 from settings import settings
 from settings.constants import PROCESSABLE_FILE_EXTENSIONS
 
 
 PDF_DIR = settings.PDF_DIR
-API_KEY_PATH = settings.API_KEY_PATH
-URL = settings.URL
-
-
-
-# Load API key
-def load_api_key(api_key_path: str) -> str:
-    with open(api_key_path, 'r') as file:
-        return file.readline().strip()
-
-
-
-# Process directory
-def process_directory(directory: str, output_dir: str, openai_client, categorizer, result_saver):
-    bool=False
-    bool,categorized_df =  main_pipeline.process_directory(directory, output_dir, openai_client, categorizer, result_saver,displaymood=True)
-    if bool:
-        return categorized_df
-    else:
-        st.write(f"No products found to save from {directory}.")
-        return pd.DataFrame()
+UPLOAD_STAGING_DIR = settings.UPLOAD_STAGING_DIR
+JOB_WORKER_LOG_FILE_NAME = "job_worker.log"
+JOB_POLL_INTERVAL_IN_SECS = 2
+
+
+
+@st.cache_resource
+def get_job_queue() -> JobQueue:
+    # One connection for all sessions, the queue is thread safe
+    return JobQueue(os.path.join(PDF_DIR, JOB_QUEUE_FILE_NAME))
+
+
+def ensure_worker_running() -> None:
+    """
+    Starts a job worker process, unless one is already running. The leaflets are processed there,
+    so that reruns of the page, e.g. from clicking a checkbox, don't interrupt them.
+    """
+    if not get_job_queue().has_live_worker():
+        start_worker_process(log_path=os.path.join(PDF_DIR, JOB_WORKER_LOG_FILE_NAME))
+
+
+def submit_jobs(upload_hash: str, selected_files) -> list:
+    """
+    Copies the selected files of a staged upload to PDF_DIR and queues a job for every leaflet:
+    one per PDF, and one per folder of page images.
+
+    Returns:
+        list: The ids of the jobs.
+    """
+    upload_staging = get_upload_staging()
+    os.makedirs(PDF_DIR, exist_ok=True)
+    jobs = {}
+    for filename in selected_files:
+        staged_path = upload_staging.file_path(upload_hash, filename)
+        if filename.lower().endswith(".pdf"):
+            pdf_path = os.path.join(PDF_DIR, os.path.basename(filename))
+            shutil.copyfile(staged_path, pdf_path)
+            pdf_name, _ = os.path.splitext(os.path.basename(filename))
+            jobs[os.path.join(PDF_DIR, pdf_name)] = pdf_path
+        else:
+            output_dir = os.path.join(PDF_DIR, os.path.dirname(filename) or "uploaded-pages")
+            os.makedirs(output_dir, exist_ok=True)
+            shutil.copyfile(staged_path, os.path.join(output_dir, os.path.basename(filename)))
+            jobs[output_dir] = None
+    return [get_job_queue().submit(directory, pdf_path) for directory, pdf_path in jobs.items()]
+
+
+@st.fragment(run_every=JOB_POLL_INTERVAL_IN_SECS)
+def show_job_progress(job_ids) -> None:
+    """
+    Shows the progress of the jobs, polled from the job queue. Only this part of the page is rerun to poll.
+    """
+    job_queue = get_job_queue()
+    for job in job_queue.jobs(job_ids):
+        name = os.path.basename(job.directory)
+        if job.status == QUEUED:
+            st.progress(0.0, text=f"{name}: waiting for a worker")
+        elif job.status == DONE:
+            last_event = job_queue.latest_events(job.id, limit=1)
+            st.success(f"{name}: {last_event[0].message if last_event else 'done'}")
+        elif job.status == FAILED:
+            st.error(f"{name}: {job.error}")
+        elif job.pages_total:
+            st.progress(job.pages_done / job.pages_total, text=f"{name}: page {job.pages_done} of {job.pages_total}")
+        else:
+            st.progress(0.0, text=f"{name}: preparing pages")
+        with st.expander(f"Events of {name}"):
+            st.text("\n".join(f"{datetime.fromtimestamp(event.created_at):%H:%M:%S} {event.kind}: {event.message or ''}"
+                               for event in job_queue.latest_events(job.id)))
+
+
+def get_upload_staging() -> UploadStaging:
+    return UploadStaging(UPLOAD_STAGING_DIR, can_process_file)
+
+
+def stage_upload(uploaded_zipfile) -> str:
+    """
+    Stages the uploaded zip on disk once, and returns its hash. Streamlit reruns the page on every click,
+    so the hash is remembered by the upload's id to not read the zip again.
+    """
+    if 'staged_uploads' not in st.session_state:
+        st.session_state.staged_uploads = {}
+    upload_hash = st.session_state.staged_uploads.get(uploaded_zipfile.file_id)
+    if upload_hash is None or not get_upload_staging().is_staged(upload_hash):
+        with st.spinner("Unpacking the zipfile..."):
+            # The other uploads of this session may still be submitted, so they aren't deleted
+            upload_hash = get_upload_staging().stage(uploaded_zipfile, in_use=st.session_state.staged_uploads.values())
+        st.session_state.staged_uploads[uploaded_zipfile.file_id] = upload_hash
+    return upload_hash
 
 
 def get_processable_files_in_zip(uploaded_zipfile):
-    processable_files = []
-    with zipfile.ZipFile(io.BytesIO(uploaded_zipfile.read())) as zf:
-        file_list = zf.namelist()
-        processable_files = [f for f in file_list if can_process_file(f)]
-    uploaded_zipfile.seek(0)
-    return processable_files
+    return get_upload_staging().list_files(stage_upload(uploaded_zipfile))
 
 
 def can_process_file(file_name):
     _, ext = os.path.splitext(file_name)
-    print(ext)
     return str.lower(ext) in PROCESSABLE_FILE_EXTENSIONS
 
 
@@ -72,13 +128,6 @@ def write_inmemory_file_to_dir(file, output_dir):
         output_file.write(file.read())
 
 def run(uploaded_zipfile):
-    # Load API key
-    api_key = load_api_key(API_KEY_PATH)
-    leaflet_reader = LeafletReader(download_url=URL)
-    openai_client = OpenAIClient(api_key=api_key)
-    result_saver = ResultSaver()
-    categorizer = ProductCategorizer()
-
     # Initialize session state variables if not set
     if 'cat_df' not in st.session_state:
         st.session_state.cat_df = pd.DataFrame()
@@ -126,28 +175,14 @@ def run(uploaded_zipfile):
 
 
     # st.session_state.selected_files = st.multiselect("Select PDF files to process", files)
+    if 'job_ids' not in st.session_state:
+        st.session_state.job_ids = []
     if st.button("Next - Process Selected Files") and st.session_state.selected_files:
-        with tempfile.TemporaryDirectory() as temp_dir:
-            print(f"Temporary directory created at: {temp_dir}")
-            with zipfile.ZipFile(io.BytesIO(uploaded_zipfile.read())) as zf:
-                file_list = zf.namelist()
-                for filename in file_list:
-                    if filename in st.session_state.selected_files:
-                        output_dir = os.path.join(temp_dir, os.path.dirname(filename))
-                        os.makedirs(output_dir, exist_ok=True)
-                        if filename.endswith(".pdf"):
-                            pdf_name, _ = os.path.splitext(os.path.basename(filename))
-                            output_dir = os.path.join(output_dir, pdf_name)
-                            os.makedirs(output_dir, exist_ok=True)
-                            leaflet_reader.convert_pdf_to_images(filename, output_dir)
-                            st.write("PDF files processed and converted to images.")
-                        elif filename.endswith(".png"):
-                            with zf.open(filename)as file:
-                                name = os.path.basename(filename)
-                                with open(os.path.join(output_dir, name), "wb") as output_file:
-                                    output_file.write(file.read())
-                                    print(f"File {filename} written to {output_dir}")
-                                    st.write(f"File {filename} written to {output_dir}")
+        job_ids = submit_jobs(stage_upload(uploaded_zipfile), st.session_state.selected_files)
+        st.session_state.job_ids = sorted(set(st.session_state.job_ids) | set(job_ids))
+        ensure_worker_running()
+    if st.session_state.job_ids:
+        show_job_progress(st.session_state.job_ids)
 
     # # Step 4: Process each selected directory and store results in session state
     # if st.button("Process Directories"):
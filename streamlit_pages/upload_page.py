@@ -1,10 +1,10 @@
-import io
 import streamlit as st
 import os
-import zipfile
 
 from datetime import date
 from calendar import week as calendar_week
+from leaflet_processing.upload_staging import UploadStaging
+from settings import settings
 from settings.constants import PROCESSABLE_FILE_EXTENSIONS
 
 
@@ -17,10 +17,11 @@ def show_upload_page():
         st.success(f"Here are the files to process: {get_files_in_zip(uploaded_file)}")
 
 def get_files_in_zip(uploaded_zipfile):
-    with zipfile.ZipFile(io.BytesIO(uploaded_zipfile.read())) as zf:
-        file_list = zf.namelist()
-        print("Files in zip:", file_list)
-        return [f for f in file_list if do_process_file(f)]
+    # Staged on disk by the hash of the zip, so the same zip is only unpacked once
+    upload_staging = UploadStaging(settings.UPLOAD_STAGING_DIR, do_process_file)
+    file_list = upload_staging.list_files(upload_staging.stage(uploaded_zipfile))
+    print("Files in zip:", file_list)
+    return file_list
 
 
 def do_process_file(file_name):
@@ -1,44 +1,47 @@
+import numpy as np
 import pandas as pd
-from collections import Counter
-import random
 
 from settings.settings import NUMBER_OF_CHATGPT_VALIDATIONS, EXTRACTED_DATA_COLUMNS
 
 
-def determine_final_column_and_confidence(row:pd.Series, column_name:str) -> (str, float):
-    # Get all validation values in a list
-    validation_columns = [f'validated{i + 1}_{column_name}' for i in range(NUMBER_OF_CHATGPT_VALIDATIONS)]
-    validation_values = [row[col] for col in validation_columns]
-
-    # Count occurrences of each value
-    counts = Counter(validation_values)     # TODO handle NaN values better
-    most_common_value, max_count = counts.most_common(1)[0]
-
-    # Check if there is a tie
-    tied_values = [val for val, count in counts.items() if count == max_count]
-
-    if len(tied_values) == 1:
-        final_value = most_common_value
-    else:
-        # Tie exists, check extracted_original_price
-        if row[f'extracted_{column_name}'] in tied_values:
-            final_value = row[f'extracted_{column_name}']
-        else:
-            final_value = random.choice(tied_values)  # Choose randomly if no match
-
-    # Calculate confidence
-    confidence = counts[final_value] / NUMBER_OF_CHATGPT_VALIDATIONS
-
-    return final_value, confidence
-
 def compare_validation(data: pd.DataFrame) -> None:
     """
     compares the values between the extraction and all validation steps
+
+    For every column in EXTRACTED_DATA_COLUMNS, the final value is the value most validations agree on, and the
+    confidence is the share of validations that agree on it. Missing values vote like any other value, so validations
+    agreeing that e.g. there is no original price count as agreement. Ties are broken deterministically: the extracted
+    value if it is among the tied values, else the tied value of the first validation.
+    All rows and columns are compared at once with NumPy.
     :param data: dataframe with extracted data and validation data
     :return: None, since the original dataframe is edited
     """
-    for column in EXTRACTED_DATA_COLUMNS:
-        data[[f'final_{column}', f'confidence_{column}']] = data.apply(
-            lambda row: pd.Series(determine_final_column_and_confidence(row, column)),
-            axis=1
-        )
\ No newline at end of file
+    columns = EXTRACTED_DATA_COLUMNS
+    n = NUMBER_OF_CHATGPT_VALIDATIONS
+    vote_columns = [
+        column_name
+        for column in columns
+        for column_name in [f'validated{i + 1}_{column}' for i in range(n)] + [f'extracted_{column}']
+    ]
+    # values[row, column, i]: the value of validation i, and the extracted value at i == n
+    # Columns that don't exist, e.g. because a validation returned no products, count as missing values
+    values = data.reindex(columns=vote_columns).to_numpy(dtype=object).reshape(len(data.index), len(columns), n + 1)
+
+    # Integer codes make the values comparable with NumPy, all missing values get the same code
+    codes, _ = pd.factorize(values.ravel(), use_na_sentinel=False)
+    codes = codes.reshape(values.shape)
+    validation_codes, extracted_codes = codes[..., :n], codes[..., n]
+
+    # votes[row, column, i]: the number of validations that agree with validation i
+    votes = (validation_codes[..., :, None] == validation_codes[..., None, :]).sum(axis=-1)
+    max_votes = votes.max(axis=-1)
+    is_tied = votes == max_votes[..., None]
+
+    extracted_is_tied = (is_tied & (validation_codes == extracted_codes[..., None])).any(axis=-1)
+    first_tied = np.take_along_axis(values[..., :n], is_tied.argmax(axis=-1)[..., None], axis=-1)[..., 0]
+    final_values = np.where(extracted_is_tied, values[..., n], first_tied)
+    confidence = max_votes / n
+
+    for i, column in enumerate(columns):
+        data[f'final_{column}'] = pd.Series(final_values[:, i], index=data.index).infer_objects()
+        data[f'confidence_{column}'] = confidence[:, i]